@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Description:
+A persistent priority queue of the waiting and running jobs
+
+The queue is an SQLite database kept in path_log next to runjob_log.log. It
+is maintained by CreateRunJoblog, which only recomputes the priority of jobs
+whose inputs to the priority changed, e.g. when the job mix of the user
+changed, and it is read by the scheduler with GetRunJobDict() in priority
+order, without parsing runjob_log.log again. Jobs with the same priority are
+kept in the order of submission.
+
+Author: Nanjiang Shu (nanjiang.shu@scilifelab.se)
+
+Address: Science for Life Laboratory Stockholm, Box 1031, 17121 Solna, Sweden
+"""
+
+import os
+import sys
+import time
+import sqlite3
+from collections import OrderedDict
+from . import myfunc
+from . import timeparser
+
+STATUS_ORDER_LIST = ["Wait", "Running"]  # order of jobs in GetRunJobDict()
+# jobs with the same priority are ordered by submission, jobs without a valid
+# submit date last
+ORDER_BY = "priority DESC, submit_epoch IS NULL, submit_epoch, jobid"
+
+
+def GetSubmitEpoch(record):  # {{{
+    """Return the submit date of the runjob_log.log line record in epoch,
+    None if it can not be parsed
+    """
+    try:
+        return timeparser.ParseDateTimeToEpoch(record.split("\t")[7])
+    except (IndexError, ValueError, TypeError):
+        return None
+# }}}
+
+
+class JobQueue(object):  # {{{
+    """Persistent priority queue of jobs stored in an SQLite database
+
+    Each job is stored with its status, priority, numseq_this_user, the key of
+    the inputs that the priority was computed from (prio_key), the fields of
+    the job as written to runjob_log.log and its submit date in epoch, which
+    orders the jobs with the same priority.
+
+    Usage:
+        jobq = JobQueue(dbfile)
+        jobq.Insert(jobid, status, priority, numseq_this_user, prio_key, record)
+        jobq.UpdatePriority(jobid, priority, numseq_this_user, prio_key)
+        li = jobq.Peek("Wait")
+        li = jobq.Pop("Wait")
+        runjob_dict = jobq.GetRunJobDict()
+        jobq.close()
+
+    When the database can not be opened, self.failure is set to True, the
+    queue is then empty and all updates are ignored.
+    """
+    def __init__(self, dbfile):  # {{{
+        self.failure = False
+        self.dbfile = dbfile
+        self.con = None
+        try:
+            self.con = sqlite3.connect(dbfile, timeout=30,
+                                       isolation_level=None)
+            self.con.execute("PRAGMA journal_mode=WAL")
+            self.con.execute("PRAGMA synchronous=NORMAL")
+            self.con.execute("""
+                CREATE TABLE IF NOT EXISTS jobqueue
+                (
+                    jobid TEXT NOT NULL PRIMARY KEY,
+                    status TEXT,
+                    priority REAL,
+                    numseq_this_user INTEGER,
+                    prio_key TEXT,
+                    record TEXT,
+                    submit_epoch REAL
+                )""")
+            self.con.execute("""
+                CREATE INDEX IF NOT EXISTS idx_jobqueue_priority
+                ON jobqueue(status, priority DESC, submit_epoch IS NULL,
+                            submit_epoch, jobid)""")
+            self.con.execute("""
+                CREATE TABLE IF NOT EXISTS meta
+                (
+                    key TEXT NOT NULL PRIMARY KEY,
+                    value TEXT
+                )""")
+        except sqlite3.Error as e:
+            print("Failed to open job queue %s with errmsg=%s" % (
+                dbfile, str(e)), file=sys.stderr)
+            self.failure = True
+            self.con = None
+# }}}
+
+    def GetTimeBase(self):  # {{{
+        """Return the epoch time that all priorities in the queue are computed
+        at, it is pinned when the queue is created, so that the priorities
+        computed in different loops are comparable
+        """
+        if self.failure:
+            return time.time()
+        row = self.con.execute("SELECT value FROM meta WHERE key = 'time_base'"
+                               ).fetchone()
+        if row is not None:
+            try:
+                return float(row[0])
+            except ValueError:
+                pass
+        time_base = time.time()
+        self.con.execute("INSERT OR REPLACE INTO meta(key, value)"
+                         " VALUES('time_base', ?)", (str(time_base),))
+        return time_base
+# }}}
+
+    def LoadAll(self):  # {{{
+        """Return a dictionary {jobid: (status, priority, numseq_this_user,
+        prio_key, record)} of all jobs in the queue
+        """
+        dt = {}
+        if self.failure:
+            return dt
+        for row in self.con.execute("SELECT jobid, status, priority,"
+                                    " numseq_this_user, prio_key, record"
+                                    " FROM jobqueue"):
+            dt[row[0]] = row[1:]
+        return dt
+# }}}
+
+    def Insert(self, jobid, status, priority, numseq_this_user, prio_key,
+               record):  # {{{
+        """Insert a job, or replace it if it is already in the queue"""
+        self.InsertMany([(jobid, status, priority, numseq_this_user,
+                          prio_key, record)])
+# }}}
+
+    def InsertMany(self, jobList):  # {{{
+        """Insert or replace many jobs in one transaction, each item of
+        jobList is (jobid, status, priority, numseq_this_user, prio_key,
+        record)
+        """
+        if self.failure or len(jobList) == 0:
+            return
+        with self.con:
+            self.con.execute("BEGIN")
+            self.con.executemany(
+                "INSERT OR REPLACE INTO jobqueue(jobid, status, priority,"
+                " numseq_this_user, prio_key, record, submit_epoch)"
+                " VALUES(?, ?, ?, ?, ?, ?, ?)",
+                [tuple(x) + (GetSubmitEpoch(x[5]),) for x in jobList])
+# }}}
+
+    def UpdatePriority(self, jobid, priority, numseq_this_user,
+                       prio_key):  # {{{
+        """Update the priority of a job in the queue"""
+        if self.failure:
+            return
+        self.con.execute("UPDATE jobqueue SET priority = ?,"
+                         " numseq_this_user = ?, prio_key = ? WHERE jobid = ?",
+                         (priority, numseq_this_user, prio_key, jobid))
+# }}}
+
+    def DeleteJobs(self, jobidList):  # {{{
+        """Remove jobs from the queue"""
+        if self.failure or len(jobidList) == 0:
+            return
+        with self.con:
+            self.con.execute("BEGIN")
+            self.con.executemany("DELETE FROM jobqueue WHERE jobid = ?",
+                                 [(x,) for x in jobidList])
+# }}}
+
+    def Peek(self, status="Wait"):  # {{{
+        """Return the job with the highest priority with status as
+        [jobid, priority, numseq_this_user, record], None if there is none
+        """
+        if self.failure:
+            return None
+        row = self.con.execute("SELECT jobid, priority, numseq_this_user,"
+                               " record FROM jobqueue WHERE status = ?"
+                               " ORDER BY " + ORDER_BY + " LIMIT 1",
+                               (status,)).fetchone()
+        if row is None:
+            return None
+        return list(row)
+# }}}
+
+    def Pop(self, status="Wait"):  # {{{
+        """Remove and return the job with the highest priority with status,
+        see Peek()
+        """
+        if self.failure:
+            return None
+        with self.con:
+            self.con.execute("BEGIN IMMEDIATE")
+            li = self.Peek(status)
+            if li is not None:
+                self.con.execute("DELETE FROM jobqueue WHERE jobid = ?",
+                                 (li[0],))
+        return li
+# }}}
+
+    def IterOrdered(self):  # {{{
+        """Iterate (jobid, priority, record) of the jobs, the waiting jobs
+        first and then the running jobs, each in descending order of priority
+        and then in the order of submission
+        """
+        if self.failure:
+            return
+        for status in STATUS_ORDER_LIST:
+            for row in self.con.execute("SELECT jobid, priority, record"
+                                        " FROM jobqueue WHERE status = ?"
+                                        " ORDER BY " + ORDER_BY,
+                                        (status,)).fetchall():
+                yield row
+# }}}
+
+    def GetRecordList(self):  # {{{
+        """Return the lines of runjob_log.log in the order of IterOrdered()"""
+        return [row[2] for row in self.IterOrdered()]
+# }}}
+
+    def GetRunJobDict(self):  # {{{
+        """Return the jobs in the same format as myfunc.ReadRunJobLog, in the
+        order of IterOrdered()
+        """
+        dt = OrderedDict()
+        for row in self.IterOrdered():
+            items = row[2].split("\t")
+            if len(items) < 12:
+                continue
+            try:
+                numseq = int(items[5])
+            except ValueError:
+                numseq = 1
+            try:
+                total_numseq_of_user = int(items[11])
+            except ValueError:
+                total_numseq_of_user = 1
+            dt[row[0]] = items[1:5] + [numseq] + items[6:11] + [
+                total_numseq_of_user, row[1]]
+        return dt
+# }}}
+
+    def close(self):  # {{{
+        if self.con is not None:
+            try:
+                self.con.close()
+            except sqlite3.Error:
+                pass
+            self.con = None
+# }}}
+# }}}
+
+
+def GetRunJobDict(path_log):  # {{{
+    """Return the waiting and running jobs in priority order in the format of
+    myfunc.ReadRunJobLog, read from the job queue maintained by
+    CreateRunJoblog, or from runjob_log.log if there is no job queue
+    """
+    dbfile = os.path.join(path_log, "jobqueue.sqlite3")
+    if os.path.exists(dbfile):
+        jobq = JobQueue(dbfile)
+        if not jobq.failure:
+            dt = jobq.GetRunJobDict()
+            jobq.close()
+            return dt
+    return myfunc.ReadRunJobLog(os.path.join(path_log, "runjob_log.log"))
+# }}}
@@ -0,0 +1,423 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Description:
+A persistent index of job states used by the qd_fe.py
+
+The index is an SQLite database kept in path_log. For each job listed in
+submitted_seq.log it records the last known status together with a signature
+of the job folder, so that CreateRunJoblog only needs to probe the jobs whose
+state could have changed since the last loop. It also keeps the digests of the
+log files rewritten by CreateRunJoblog, so that unchanged files are not
+rewritten, and the jobids already appended to the all_*.log files.
+
+The job counters shown on the web pages are materialised in the same database,
+one row per client IP plus one row (JOBCOUNTER_ALL) for super users. They are
+written by CreateRunJoblog and read by the web pages with ReadJobCounter().
+The lists of finished and failed jobs are read page by page with QueryJobs().
+
+Author: Nanjiang Shu (nanjiang.shu@scilifelab.se)
+
+Address: Science for Life Laboratory Stockholm, Box 1031, 17121 Solna, Sweden
+"""
+
+import os
+import sys
+import time
+import json
+import sqlite3
+import hashlib
+from . import myfunc
+from . import timeparser
+
+FINAL_STATUS_LIST = ["Finished", "Failed"]
+# fields of a job record, in the order of the table columns
+JOB_FIELD_LIST = ["jobid", "status", "signature", "jobname", "ip", "email",
+                  "numseq", "method_submission", "submit_date", "start_date",
+                  "finish_date", "app_type", "updated_epoch", "submit_epoch"]
+JOBCOUNTER_ALL = "*"  # key of the job counter of all jobs, for super users
+DEFAULT_MAX_DAYS_TO_SHOW = 30  # days of jobs counted in the job counters
+JOBCOUNTER_MAX_AGE = 600  # job counters older than this (seconds) are stale
+
+
+def GetJobDirSignature(rstdir):  # {{{
+    """Return a signature of the job folder
+
+    The signature changes whenever a tag file (runjob.start, runjob.finish,
+    runjob.failed) is created or deleted in rstdir, or when
+    torun_seqindex.txt is rewritten. Return "" if the job folder does not
+    exist.
+    """
+    try:
+        st = os.stat(rstdir)
+    except OSError:
+        return ""
+    signature = "%d" % (st.st_mtime_ns)
+    try:
+        st2 = os.stat(os.path.join(rstdir, "torun_seqindex.txt"))
+        signature += ":%d:%d" % (st2.st_mtime_ns, st2.st_size)
+    except OSError:
+        pass
+    return signature
+# }}}
+
+
+def GetSubmitEpoch(submit_date_str, default_epoch):  # {{{
+    """Return the submit date in epoch, default_epoch if it can not be parsed
+    """
+    try:
+        return timeparser.ParseDateTimeToEpoch(submit_date_str)
+    except (ValueError, TypeError):
+        return default_epoch
+# }}}
+
+
+class JobStateIndex(object):  # {{{
+    """Persistent index of job states stored in an SQLite database
+
+    Usage:
+        jsidx = JobStateIndex(dbfile)
+        state_dict = jsidx.LoadAll()
+        ...
+        jsidx.UpdateJobs(recordList)
+        jsidx.WriteFileIfChanged(content, outfile)
+        jsidx.close()
+
+    When the database can not be opened, self.failure is set to True and all
+    methods fall back to the behavior without the index, i.e. nothing is
+    cached and all files are rewritten.
+    """
+    def __init__(self, dbfile):  # {{{
+        self.failure = False
+        self.dbfile = dbfile
+        self.con = None
+        try:
+            self.con = sqlite3.connect(dbfile, timeout=30,
+                                       isolation_level=None)
+            self.con.execute("PRAGMA journal_mode=WAL")
+            self.con.execute("PRAGMA synchronous=NORMAL")
+            self.CreateTables()
+        except sqlite3.Error as e:
+            print("Failed to open job state index %s with errmsg=%s" % (
+                dbfile, str(e)), file=sys.stderr)
+            self.failure = True
+            self.con = None
+# }}}
+
+    def CreateTables(self):  # {{{
+        cur = self.con.cursor()
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS jobstate
+            (
+                jobid TEXT NOT NULL PRIMARY KEY,
+                status TEXT,
+                signature TEXT,
+                jobname TEXT,
+                ip TEXT,
+                email TEXT,
+                numseq INTEGER,
+                method_submission TEXT,
+                submit_date TEXT,
+                start_date TEXT,
+                finish_date TEXT,
+                app_type TEXT,
+                updated_epoch REAL,
+                submit_epoch REAL
+            )""")
+        columnList = [x[1] for x in cur.execute("PRAGMA table_info(jobstate)")]
+        if "submit_epoch" not in columnList:
+            # index created by an older version, add and fill submit_epoch
+            try:
+                cur.execute("ALTER TABLE jobstate ADD COLUMN submit_epoch REAL")
+            except sqlite3.OperationalError:
+                pass  # added by another process meanwhile
+            rowList = cur.execute("SELECT jobid, submit_date, updated_epoch"
+                                  " FROM jobstate WHERE submit_epoch IS NULL"
+                                  ).fetchall()
+            cur.executemany("UPDATE jobstate SET submit_epoch = ?"
+                            " WHERE jobid = ?",
+                            [(GetSubmitEpoch(x[1], x[2]), x[0])
+                             for x in rowList])
+        cur.execute("""
+            CREATE INDEX IF NOT EXISTS idx_jobstate_status_ip_submit
+            ON jobstate(status, ip, submit_epoch)""")
+        cur.execute("""
+            CREATE INDEX IF NOT EXISTS idx_jobstate_status_submit
+            ON jobstate(status, submit_epoch)""")
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS filedigest
+            (
+                filename TEXT NOT NULL PRIMARY KEY,
+                md5 TEXT,
+                size INTEGER,
+                mtime_ns INTEGER
+            )""")
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS loggedjob
+            (
+                logname TEXT NOT NULL,
+                jobid TEXT NOT NULL,
+                PRIMARY KEY (logname, jobid)
+            )""")
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS jobcounter
+            (
+                ip TEXT NOT NULL PRIMARY KEY,
+                counter TEXT
+            )""")
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS meta
+            (
+                key TEXT NOT NULL PRIMARY KEY,
+                value TEXT
+            )""")
+# }}}
+
+    def LoadAll(self):  # {{{
+        """Return a dictionary {'jobid': {field: value}} of all indexed jobs
+        """
+        dt = {}
+        if self.failure:
+            return dt
+        sql = "SELECT %s FROM jobstate" % (", ".join(JOB_FIELD_LIST))
+        for row in self.con.execute(sql):
+            dt[row[0]] = dict(zip(JOB_FIELD_LIST, row))
+        return dt
+# }}}
+
+    def UpdateJobs(self, recordList):  # {{{
+        """Insert or replace job records in one transaction
+        each record is a dictionary with the keys in JOB_FIELD_LIST
+        """
+        if self.failure or len(recordList) == 0:
+            return
+        now = time.time()
+        data = []
+        for rd in recordList:
+            rd['updated_epoch'] = now
+            rd['submit_epoch'] = GetSubmitEpoch(rd.get('submit_date', ""), now)
+            data.append(tuple(rd.get(x, "") for x in JOB_FIELD_LIST))
+        sql = "INSERT OR REPLACE INTO jobstate(%s) VALUES(%s)" % (
+            ", ".join(JOB_FIELD_LIST), ", ".join(["?"]*len(JOB_FIELD_LIST)))
+        with self.con:
+            self.con.execute("BEGIN")
+            self.con.executemany(sql, data)
+# }}}
+
+    def DeleteJobs(self, jobidList):  # {{{
+        """Delete the records of jobs, e.g. those no longer in
+        submitted_seq.log"""
+        if self.failure or len(jobidList) == 0:
+            return
+        with self.con:
+            self.con.execute("BEGIN")
+            self.con.executemany("DELETE FROM jobstate WHERE jobid = ?",
+                                 [(x,) for x in jobidList])
+# }}}
+
+    def WriteFileIfChanged(self, content, outfile):  # {{{
+        """Write content to outfile only when it differs from what was written
+        last time and the file has not been modified by others since then.
+        Return True if the file is (re)written
+        """
+        if self.failure:
+            myfunc.WriteFile(content, outfile, "w", True)
+            return True
+        md5_key = hashlib.md5(content.encode('utf-8')).hexdigest()
+        row = self.con.execute(
+            "SELECT md5, size, mtime_ns FROM filedigest WHERE filename = ?",
+            (outfile,)).fetchone()
+        if row is not None and row[0] == md5_key:
+            try:
+                st = os.stat(outfile)
+                if st.st_size == row[1] and st.st_mtime_ns == row[2]:
+                    return False
+            except OSError:
+                pass
+        myfunc.WriteFile(content, outfile, "w", True)
+        try:
+            st = os.stat(outfile)
+        except OSError:
+            return True
+        self.con.execute(
+            "INSERT OR REPLACE INTO filedigest(filename, md5, size, mtime_ns)"
+            " VALUES(?, ?, ?, ?)",
+            (outfile, md5_key, st.st_size, st.st_mtime_ns))
+        return True
+# }}}
+
+    def FilterNewJobID(self, logname, logfile, jobidList, col=0,
+                       delim="\t"):  # {{{
+        """Return jobids in jobidList that are not yet written to logfile
+
+        The set of logged jobids is seeded once from logfile (the column col),
+        after that only the index is queried.
+        """
+        if self.failure:
+            logged_set = set(myfunc.ReadIDList2(logfile, col=col,
+                                                delim=delim))
+            return [x for x in jobidList if x not in logged_set]
+
+        metakey = "seeded_%s" % (logname)
+        row = self.con.execute("SELECT value FROM meta WHERE key = ?",
+                               (metakey,)).fetchone()
+        if row is None:
+            idlist = myfunc.ReadIDList2(logfile, col=col, delim=delim)
+            self.MarkLogged(logname, idlist)
+            self.con.execute(
+                "INSERT OR REPLACE INTO meta(key, value) VALUES(?, ?)",
+                (metakey, str(time.time())))
+
+        newList = []
+        for jobid in jobidList:
+            row = self.con.execute(
+                "SELECT 1 FROM loggedjob WHERE logname = ? AND jobid = ?",
+                (logname, jobid)).fetchone()
+            if row is None:
+                newList.append(jobid)
+        return newList
+# }}}
+
+    def MarkLogged(self, logname, jobidList):  # {{{
+        """Record that jobids in jobidList are written to the log logname"""
+        if self.failure or len(jobidList) == 0:
+            return
+        with self.con:
+            self.con.execute("BEGIN")
+            self.con.executemany(
+                "INSERT OR IGNORE INTO loggedjob(logname, jobid)"
+                " VALUES(?, ?)", [(logname, x) for x in jobidList])
+# }}}
+
+    def UpdateJobCounters(self, counterDict, maxdays):  # {{{
+        """Store the job counters {ip: jobcounter}, counted over the jobs
+        submitted in the last maxdays days (all jobs for JOBCOUNTER_ALL).
+        Only the counters that changed are rewritten, the counters of IPs not
+        in counterDict are removed
+        """
+        if self.failure:
+            return
+        old_dict = {}
+        for row in self.con.execute("SELECT ip, counter FROM jobcounter"):
+            old_dict[row[0]] = row[1]
+        data = []
+        for ip in counterDict:
+            content = json.dumps(counterDict[ip], sort_keys=True)
+            if old_dict.get(ip, None) != content:
+                data.append((ip, content))
+        with self.con:
+            self.con.execute("BEGIN")
+            self.con.executemany(
+                "INSERT OR REPLACE INTO jobcounter(ip, counter) VALUES(?, ?)",
+                data)
+            self.con.executemany("DELETE FROM jobcounter WHERE ip = ?",
+                                 [(x,) for x in old_dict
+                                  if x not in counterDict])
+            self.con.executemany(
+                "INSERT OR REPLACE INTO meta(key, value) VALUES(?, ?)",
+                [("jobcounter_maxdays", str(maxdays)),
+                 ("jobcounter_updated_epoch", str(time.time()))])
+# }}}
+
+    def close(self):  # {{{
+        if self.con is not None:
+            try:
+                self.con.close()
+            except sqlite3.Error:
+                pass
+            self.con = None
+# }}}
+# }}}
+
+
+def OpenFreshIndex(path_log, maxdays=None):  # {{{
+    """Open the job state index in path_log for reading, return the
+    connection, or None if the index is missing, has not been updated by
+    CreateRunJoblog within JOBCOUNTER_MAX_AGE seconds, or its job counters
+    are counted over a number of days other than maxdays. maxdays is not
+    checked when it is None
+    """
+    dbfile = os.path.join(path_log, "jobstate.sqlite3")
+    if not os.path.exists(dbfile):
+        return None
+    try:
+        con = sqlite3.connect(dbfile, timeout=5)
+    except sqlite3.Error:
+        return None
+    try:
+        metaDict = dict(con.execute(
+            "SELECT key, value FROM meta WHERE key IN"
+            " ('jobcounter_maxdays', 'jobcounter_updated_epoch')"))
+        updated_epoch = float(metaDict['jobcounter_updated_epoch'])
+        if (time.time() - updated_epoch <= JOBCOUNTER_MAX_AGE
+                and (maxdays is None
+                     or metaDict.get('jobcounter_maxdays', None) == str(maxdays))):
+            return con
+    except (sqlite3.Error, KeyError, ValueError):
+        pass
+    con.close()
+    return None
+# }}}
+
+
+def ReadJobCounter(path_log, ip, maxdays=None):  # {{{
+    """Return the job counter of ip stored by CreateRunJoblog, {} if ip has no
+    jobs, or None if the index can not be used (see OpenFreshIndex), in which
+    case the caller should count the jobs itself
+    """
+    con = OpenFreshIndex(path_log, maxdays)
+    if con is None:
+        return None
+    try:
+        row = con.execute("SELECT counter FROM jobcounter WHERE ip = ?",
+                          (ip,)).fetchone()
+        if row is None:
+            return {}
+        return json.loads(row[0])
+    except (sqlite3.Error, ValueError):
+        return None
+    finally:
+        con.close()
+# }}}
+
+
+def QueryJobs(path_log, status, ip=None, submit_epoch_from=None,
+              submit_epoch_to=None, isDescending=False, offset=0,
+              limit=-1):  # {{{
+    """Return (numjob, recordList) of one page of the jobs with status, of
+    the client ip (all clients if ip is None), submitted in
+    [submit_epoch_from, submit_epoch_to), sorted by the submit date.
+    numjob is the number of all matching jobs, recordList has at most limit
+    (all if limit < 0) records from offset on, each a dictionary with the
+    keys in JOB_FIELD_LIST.
+    Return None if the index can not be used (see OpenFreshIndex)
+    """
+    con = OpenFreshIndex(path_log)
+    if con is None:
+        return None
+    where = "status = ?"
+    para = [status]
+    if ip is not None:
+        where += " AND ip = ?"
+        para.append(ip)
+    if submit_epoch_from is not None:
+        where += " AND submit_epoch >= ?"
+        para.append(submit_epoch_from)
+    if submit_epoch_to is not None:
+        where += " AND submit_epoch < ?"
+        para.append(submit_epoch_to)
+    order = "DESC" if isDescending else "ASC"
+    try:
+        numjob = con.execute("SELECT COUNT(*) FROM jobstate WHERE %s" % (
+            where), para).fetchone()[0]
+        sql = "SELECT %s FROM jobstate WHERE %s ORDER BY submit_epoch %s," \
+              " jobid %s LIMIT ? OFFSET ?" % (", ".join(JOB_FIELD_LIST),
+                                              where, order, order)
+        recordList = [dict(zip(JOB_FIELD_LIST, row)) for row in
+                      con.execute(sql, para + [limit, offset])]
+        return (numjob, recordList)
+    except sqlite3.Error:
+        return None
+    finally:
+        con.close()
+# }}}
@@ -1,22 +1,51 @@
 import os
 import sys
+import mmap
+import threading
+from array import array
 from . import mydb_common
+
+g_reopen_lock = threading.Lock()
+g_shared_mydb_dict = {}  # MyDB instances shared in this process
+def ResetLockAfterFork():#{{{
+    global g_reopen_lock
+    g_reopen_lock = threading.Lock()
+#}}}
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=ResetLockAfterFork)
 class MyDB: #{{{
 # Description:
 #   A class to handle a database of dumped data. The content for each query id
 #   can be accessed quickly by GetRecord(id)
 # variables:
 #     indexedIDList  :  list of record IDs
+#
+# The binary index file of version 1.5 (mydb_common.version_mmap) is accessed
+# by mmap and not loaded into memory, older index files are loaded as before
+# and can be converted by mydb_common.ConvertIndexToMmap(dbname)
 # 
 # Functions:
 #     GetRecord(id)  : retrieve record for id, 
 #                      return None if failed
+#     GetRecordView(id) : retrieve record for id as a memoryview, without copy
+#     GetRecords(idList) : retrieve records for idList, read sequentially
+#     iter_records() : iterate (id, record) of all records
 #     GetAllRecord() : retrieve all records in the form of list
+#
+# Records are read by slicing the db files mapped by mmap (access_mode =
+# ACCESS_MMAP) or by os.pread (ACCESS_PREAD), neither of which uses the file
+# position, so one instance can be shared by threads. In a forked child
+# process, the db files are re-opened on the first access, and an instance
+# sent to a multiprocessing worker by pickle is opened again in the worker.
 
     def __init__(self, dbname, index_format = mydb_common.FORMAT_BINARY,#{{{
-                    isPrintWarning = False):
+                    isPrintWarning = False,
+                    access_mode = mydb_common.ACCESS_MMAP):
 #        print "Init", dbname
         self.failure = False
+        self.pid = os.getpid()
+        self.access_mode = access_mode
+        self.init_args = (dbname, index_format, isPrintWarning, access_mode)
         self.index_type = mydb_common.TYPE_DICT
         self.dbname = dbname
         self.dbname_basename = os.path.basename(dbname)
@@ -26,10 +55,41 @@ class MyDB: #{{{
         self.index_format = index_format
         self.isPrintWarning = isPrintWarning
         self.fpdbList = []
+        self.mmdbList = []
+        self.compression = mydb_common.COMPRESSION_NONE
+        self.decompress = None
         (self.indexfile, self.index_format) =\
                         mydb_common.GetIndexFile(self.dbname_full,
                                         self.index_format)
-        if self.indexfile != "":
+        if (self.indexfile != "" and
+                self.index_format == mydb_common.FORMAT_BINARY and
+                mydb_common.IsMmapIndex(self.indexfile)):
+            self.index_type = mydb_common.TYPE_MMAP
+            self.mmindex = mydb_common.MmapIndex(self.indexfile)
+            if self.mmindex.failure:
+                msg = "Failed to read index file {}. Init database {} failed."
+                print(msg.format(self.indexfile,
+                                self.dbname_full), file=sys.stderr)
+                self.failure = True
+                return None
+            self.headerinfo = self.mmindex.headerinfo
+            self.compression = self.mmindex.headerDict.get('DEF_COMPRESSION',
+                    mydb_common.COMPRESSION_NONE)
+            if self.compression != mydb_common.COMPRESSION_NONE:
+                self.decompress = mydb_common.GetDecompressor(self.compression)
+                if self.decompress is None:
+                    msg = "Compression {} of database {} is not supported."
+                    print(msg.format(self.compression,
+                                    self.dbname_full), file=sys.stderr)
+                    self.failure = True
+                    return None
+            self.dbfileindexList = self.mmindex.dbfileindexList
+            if self.OpenDBFile() == 1:
+                self.failure = True
+                return None
+            self.indexedIDList = self.mmindex
+            self.numRecord = len(self.mmindex)
+        elif self.indexfile != "":
             (self.indexList, self.headerinfo, self.dbfileindexList) =\
                             self.ReadIndex(self.indexfile, self.index_format)
             if self.indexList == None:
@@ -55,13 +115,34 @@ class MyDB: #{{{
           #}}}
     def __del__(self):#{{{
 #        print "Leaving %s"%(self.dbname)
-        try: 
-            for fp in self.fpdbList:
-                fp.close()
-            return 0
-        except IOError:
-            print("Failed to close db file", file=sys.stderr)
+        self.close()
         #}}}
+    def __getstate__(self):#{{{
+        return {'init_args': self.init_args}
+#}}}
+    def __setstate__(self, state):#{{{
+        self.__init__(*state['init_args'])
+#}}}
+    def Reopen(self):#{{{
+        """Re-open the db files (and the mmap index) in a forked child
+        process, so that the handles of the parent are not shared
+        """
+        with g_reopen_lock:
+            if self.pid == os.getpid():
+                return 0
+            self.close()
+            if self.index_type == mydb_common.TYPE_MMAP:
+                self.mmindex = mydb_common.MmapIndex(self.indexfile)
+                if self.mmindex.failure:
+                    self.failure = True
+                    return 1
+                self.indexedIDList = self.mmindex
+            if self.OpenDBFile() == 1:
+                self.failure = True
+                return 1
+            self.pid = os.getpid()
+        return 0
+#}}}
     def ReadIndex(self, indexfile, index_format):#{{{
 # return (headerinfo, dbfileindexList, index, idList)
 # return (indexList, headerinfo, dbfileindexList)
@@ -71,52 +152,177 @@ class MyDB: #{{{
             return mydb_common.ReadIndex_binary(indexfile, self.isPrintWarning)
 #}}}
     def OpenDBFile(self):#{{{
+# the db files are mapped into memory, so that records are sliced from the
+# mapped files without seek and read
         for i in self.dbfileindexList:
             dbfile = self.dbname_full + "%d.db"%(i)
             try:
-                self.fpdbList.append(open(dbfile,"r"))
-            except IOError:
+                fpdb = open(dbfile,"rb")
+                self.fpdbList.append(fpdb)
+                if self.access_mode == mydb_common.ACCESS_PREAD:
+                    continue
+                if os.fstat(fpdb.fileno()).st_size > 0:
+                    self.mmdbList.append(mmap.mmap(fpdb.fileno(), 0,
+                        access=mmap.ACCESS_READ))
+                else: # empty files can not be mapped
+                    self.mmdbList.append(b"")
+            except (IOError, ValueError):
                 print("Failed to read dbfile %s"%(dbfile), file=sys.stderr)
                 return 1
         return 0
 #}}}
-    def GetRecordByIndexList(self, record_id):#{{{
+    def GetIndexItem(self, record_id):#{{{
+        """Return the index of the record in the index file, -1 if not found
+        """
+        if self.index_type == mydb_common.TYPE_MMAP:
+            return self.mmindex.Lookup(record_id)
+        elif self.index_type == mydb_common.TYPE_DICT:
+            return self.indexDict.get(record_id, -1)
+        else:
+            try:
+                return self.indexedIDList.index(record_id)
+            except ValueError:
+                return -1
+#}}}
+    def GetLocation(self, idxItem):#{{{
+        """Return (dbfileindex, offset, size) of the record at idxItem"""
+        if self.index_type == mydb_common.TYPE_MMAP:
+            return self.mmindex.GetEntry(idxItem)
+        else:
+            return (self.indexList[1][idxItem], self.indexList[2][idxItem],
+                    self.indexList[3][idxItem])
+#}}}
+    def ReadRecord(self, dbfileindex, offset, size):#{{{
+        """Return the record at offset of the db file as str, decompressed
+        if the database is compressed
+        """
+        if self.pid != os.getpid():
+            self.Reopen()
+        if self.access_mode == mydb_common.ACCESS_PREAD:
+            data = os.pread(self.fpdbList[dbfileindex].fileno(), size, offset)
+        else:
+            data = self.mmdbList[dbfileindex][offset:offset+size]
+        if self.decompress is not None:
+            data = self.decompress(data)
+        return data.decode()
+#}}}
+    def GetRecordByIndexItem(self, record_id, idxItem):#{{{
         try:
-            idxItem = self.indexedIDList.index(record_id);
-            fpdb = self.fpdbList[self.indexList[1][idxItem]];
-            fpdb.seek(self.indexList[2][idxItem]);
-            data = fpdb.read(self.indexList[3][idxItem]);
-            return data
-        except (IndexError, IOError):
+            if idxItem == -1:
+                raise KeyError(record_id)
+            return self.ReadRecord(*self.GetLocation(idxItem))
+        except ((KeyError, IndexError, ValueError, OSError)
+                + mydb_common.DECOMPRESS_ERRORS):
             print("Failed to retrieve record %s"%(record_id), file=sys.stderr)
             return None
 #}}}
-    def GetRecordByIndexDict(self, record_id):#{{{
+    def GetRecordByIndexList(self, record_id):#{{{
         try:
-            idxItem = self.indexDict[record_id]
-            fpdb = self.fpdbList[self.indexList[1][idxItem]];
-            fpdb.seek(self.indexList[2][idxItem]);
-            data = fpdb.read(self.indexList[3][idxItem]);
-            return data
-        except (KeyError, IndexError, IOError):
-            print("Failed to retrieve record %s"%(record_id), file=sys.stderr)
-            return None
+            idxItem = self.indexedIDList.index(record_id)
+        except ValueError:
+            idxItem = -1
+        return self.GetRecordByIndexItem(record_id, idxItem)
+#}}}
+    def GetRecordByIndexDict(self, record_id):#{{{
+        return self.GetRecordByIndexItem(record_id,
+                self.indexDict.get(record_id, -1))
+#}}}
+    def GetRecordByIndexMmap(self, record_id):#{{{
+        return self.GetRecordByIndexItem(record_id,
+                self.mmindex.Lookup(record_id))
 #}}}
     def GetRecord(self, record_id):#{{{
         if self.index_type == mydb_common.TYPE_LIST:
             return self.GetRecordByIndexList(record_id)
         elif self.index_type == mydb_common.TYPE_DICT:
             return self.GetRecordByIndexDict(record_id)
+        elif self.index_type == mydb_common.TYPE_MMAP:
+            return self.GetRecordByIndexMmap(record_id)
+#}}}
+    def GetRecordView(self, record_id):#{{{
+        """Return the record as a memoryview of the mapped db file without
+        copying, None if failed. The views must be released before close()
+        For compressed databases or with ACCESS_PREAD, the view is of a copy
+        """
+        if self.pid != os.getpid():
+            self.Reopen()
+        idxItem = self.GetIndexItem(record_id)
+        if idxItem == -1:
+            print("Failed to retrieve record %s"%(record_id), file=sys.stderr)
+            return None
+        (dbfileindex, offset, size) = self.GetLocation(idxItem)
+        try:
+            if self.access_mode == mydb_common.ACCESS_PREAD:
+                view = memoryview(os.pread(self.fpdbList[dbfileindex].fileno(),
+                    size, offset))
+            else:
+                view = memoryview(self.mmdbList[dbfileindex])[offset:offset+size]
+        except (IndexError, OSError):
+            print("Failed to retrieve record %s"%(record_id), file=sys.stderr)
+            return None
+        if self.decompress is not None:
+            try:
+                view = memoryview(self.decompress(view))
+            except mydb_common.DECOMPRESS_ERRORS:
+                print("Failed to retrieve record %s"%(record_id), file=sys.stderr)
+                return None
+        return view
+#}}}
+    def GetRecords(self, idList):#{{{
+        """Return the records of idList in the same order as idList, None for
+        records that are not found. The records are read in the order of
+        (dbfile, offset) so that the db files are read sequentially
+        """
+        locList = []
+        for i in range(len(idList)):
+            idxItem = self.GetIndexItem(idList[i])
+            if idxItem != -1:
+                locList.append(tuple(self.GetLocation(idxItem)) + (i,))
+        locList.sort()
+        recordList = [None]*len(idList)
+        for (dbfileindex, offset, size, i) in locList:
+            try:
+                recordList[i] = self.ReadRecord(dbfileindex, offset, size)
+            except ((IndexError, ValueError, OSError)
+                    + mydb_common.DECOMPRESS_ERRORS):
+                print("Failed to retrieve record %s"%(idList[i]), file=sys.stderr)
+        return recordList
+#}}}
+    def iter_records(self):#{{{
+        """Iterate (record_id, record) of all records in the order of the
+        index file, which is the order that the records are written
+        """
+        for idxItem in range(self.numRecord):
+            (dbfileindex, offset, size) = self.GetLocation(idxItem)
+            try:
+                record = self.ReadRecord(dbfileindex, offset, size)
+            except ((IndexError, ValueError, OSError)
+                    + mydb_common.DECOMPRESS_ERRORS):
+                record = None
+            yield (self.indexedIDList[idxItem], record)
 #}}}
     def GetAllRecord(self): #{{{
         recordList = []
-        for idd in self.idList:
-            recordList.append(self.GetRecord(idd))
+        for (record_id, record) in self.iter_records():
+            recordList.append(record)
         return recordList
+#}}}
     def close(self):#{{{
         try: 
+            for mm in self.mmdbList:
+                if isinstance(mm, mmap.mmap):
+                    try:
+                        mm.close()
+                    except BufferError:
+                        # views from GetRecordView are still in use, the map
+                        # is released when they are released
+                        pass
+            self.mmdbList = []
             for fp in self.fpdbList:
                 fp.close()
+            self.fpdbList = []
+            if self.index_type == mydb_common.TYPE_MMAP:
+                self.mmindex.close()
             return 0
         except IOError:
             print("Failed to close db file", file=sys.stderr)
@@ -124,3 +330,123 @@ class MyDB: #{{{
         #}}}
     #}}}
 #}}}
+class MyDBBuilder: #{{{
+# Description:
+#   Build a database that can be read by MyDB from a stream of records. The
+#   records are written to the db files <dbname>0.db, <dbname>1.db, ..., a
+#   new db file is started when the current one would exceed
+#   max_dbfile_size, and the index file <dbname>.indexbin of version_mmap is
+#   written by close()
+#   Each record can be compressed with zlib or zstd (compression)
+#
+# Usage:
+#   builder = MyDBBuilder(dbname, compression="zlib")
+#   for (record_id, record) in records:
+#       builder.AddRecord(record_id, record)
+#   builder.close()
+#   db = MyDB(dbname)
+
+    def __init__(self, dbname, max_dbfile_size=mydb_common.LargeFileThresholdSize,#{{{
+            compression=mydb_common.COMPRESSION_NONE, level=None):
+        self.failure = False
+        self.dbname = dbname
+        self.dbname_basename = os.path.basename(dbname)
+        self.max_dbfile_size = max_dbfile_size
+        self.compression = compression
+        self.idList = []
+        self.v1 = array('I') # dbfile index
+        self.v2 = array('Q') # offset
+        self.v3 = array('I') # block size
+        self.fpdb = None
+        self.dbfileindex = -1
+        self.offset = 0
+        self.compress = mydb_common.GetCompressor(compression, level)
+        if self.compress is None:
+            msg = "Compression {} is not supported. Init database builder {} failed."
+            print(msg.format(compression, dbname), file=sys.stderr)
+            self.failure = True
+            return None
+        if self.OpenNextDBFile() == 1:
+            self.failure = True
+            return None
+#}}}
+    def __enter__(self):#{{{
+        return self
+#}}}
+    def __exit__(self, exc_type, exc_value, traceback):#{{{
+        self.close()
+#}}}
+    def OpenNextDBFile(self):#{{{
+        if self.fpdb is not None:
+            self.fpdb.close()
+        self.dbfileindex += 1
+        self.offset = 0
+        dbfile = self.dbname + "%d.db"%(self.dbfileindex)
+        try:
+            self.fpdb = open(dbfile, "wb")
+        except IOError:
+            print("Failed to write dbfile %s"%(dbfile), file=sys.stderr)
+            self.fpdb = None
+            return 1
+        return 0
+#}}}
+    def AddRecord(self, record_id, record):#{{{
+        """Append the record (str or bytes) with record_id to the database"""
+        if self.failure or self.fpdb is None:
+            return 1
+        if isinstance(record, str):
+            record = record.encode()
+        data = self.compress(record)
+        if self.offset > 0 and self.offset + len(data) > self.max_dbfile_size:
+            if self.OpenNextDBFile() == 1:
+                self.failure = True
+                return 1
+        try:
+            self.fpdb.write(data)
+        except IOError:
+            print("Failed to write record %s"%(record_id), file=sys.stderr)
+            self.failure = True
+            return 1
+        self.idList.append(record_id)
+        self.v1.append(self.dbfileindex)
+        self.v2.append(self.offset)
+        self.v3.append(len(data))
+        self.offset += len(data)
+        return 0
+#}}}
+    def close(self):#{{{
+        """Close the db file and write the index file, return 0 on success"""
+        if self.fpdb is None:
+            return 1
+        self.fpdb.close()
+        self.fpdb = None
+        if self.failure:
+            return 1
+        headerinfo = (self.dbname_basename, mydb_common.version_mmap, ".db",
+                self.dbname_basename)
+        return mydb_common.WriteIndex_mmap(self.dbname + ".indexbin",
+                headerinfo, [self.idList, self.v1, self.v2, self.v3],
+                compression=self.compression)
+#}}}
+#}}}
+def GetSharedMyDB(dbname, index_format = mydb_common.FORMAT_BINARY,#{{{
+        access_mode = mydb_common.ACCESS_MMAP):
+    """
+    Return the MyDB instance of dbname shared by all threads of this process,
+    opened on the first call in each process, None if failed
+    """
+    key = (dbname, index_format, access_mode, os.getpid())
+    db = g_shared_mydb_dict.get(key, None)
+    if db is None:
+        with g_reopen_lock:
+            db = g_shared_mydb_dict.get(key, None)
+            if db is None:
+                db = MyDB(dbname, index_format, access_mode=access_mode)
+                if db.failure:
+                    return None
+                # instances of the parent process are not used after fork
+                for k in [x for x in g_shared_mydb_dict if x[3] != os.getpid()]:
+                    del g_shared_mydb_dict[k]
+                g_shared_mydb_dict[key] = db
+    return db
+#}}}
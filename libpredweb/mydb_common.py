@@ -10,16 +10,57 @@
 
 import sys
 import os
+import mmap
+import struct
+import hashlib
+import zlib
+import threading
 from array import array
 from . import mybase
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 FORMAT_BINARY = 0
 FORMAT_TEXT = 1
 TYPE_DICT = 0
 TYPE_LIST = 1
+TYPE_MMAP = 2
+ACCESS_MMAP = 0   # records are sliced from the db files mapped by mmap
+ACCESS_PREAD = 1  # records are read by os.pread
 LargeFileThresholdSize = 1.5*1024*1024*1024
 version = "1.4"
 
+# Version 1.5 of the binary index file (.indexbin) is accessed by mmap, so that
+# the index is not loaded into memory and a record is looked up by probing a
+# hash table. The layout is (integers are little endian):
+#   uint32         length of the header text
+#   header text    DEF_VERSION, DEF_DBNAME, DEF_EXTENSION, DEF_PREFIX,
+#                  DEF_NUMRECORD, DEF_NUMSLOT, DEF_NUMDBFILE and
+#                  DEF_COMPRESSION
+#   padding        to a multiple of 8 bytes
+#   record table   DEF_NUMRECORD items of ENTRY_STRUCT, (id_offset, id_length,
+#                  dbfileindex, offset, size), in the order of the records
+#   hash table     DEF_NUMSLOT items of SLOT_STRUCT, 1 + the index to the
+#                  record table, 0 for an empty slot, with linear probing
+#   id table       the record IDs encoded in UTF-8, without separators
+version_mmap = "1.5"
+ENTRY_STRUCT = struct.Struct("<QIIQQ")
+SLOT_STRUCT = struct.Struct("<Q")
+
+# compression of the records, given by DEF_COMPRESSION in the header of the
+# index file of version_mmap, each record is compressed separately
+COMPRESSION_NONE = "none"
+COMPRESSION_ZLIB = "zlib"
+COMPRESSION_ZSTD = "zstd"
+COMPRESSION_LIST = [COMPRESSION_NONE, COMPRESSION_ZLIB, COMPRESSION_ZSTD]
+if zstandard is not None:
+    DECOMPRESS_ERRORS = (zlib.error, zstandard.ZstdError)
+else:
+    DECOMPRESS_ERRORS = (zlib.error,)
+g_zstd_local = threading.local() # zstd decompressors are per thread
+
 def GetIndexFileHeaderText(headerinfo):#{{{
     """
     Get the header information of the index file in ASCII format
@@ -76,7 +117,7 @@ def WriteIndexHeader(indexFileHeaderText, formatindex, fpindex):#{{{
         vI = array('I')
         vI.append(len(dumpedtext))
         vI.tofile(fpindex)
-        fpindex.write(dumpedtext)
+        fpindex.write(dumpedtext.encode())
 #}}}
 def WriteIndexContent(indexList, formatindex, fpindex):#{{{
     """
@@ -108,7 +149,7 @@ def WriteIndexContent(indexList, formatindex, fpindex):#{{{
         vI=array('I')
         vI.append(len(dumpedliststr))
         vI.tofile(fpindex)
-        fpindex.write(dumpedliststr)
+        fpindex.write(dumpedliststr.encode())
 
         vI=array('I')
         vI.append(numRecord)
@@ -132,7 +173,7 @@ def ReadIndex_binary(indexfile, isPrintWarning = False):#{{{
         vI = array('I')
         vI.fromfile(fpin,1)
         cntReadByte += vI.itemsize
-        dumpedtext = fpin.read(vI[0])
+        dumpedtext = fpin.read(vI[0]).decode()
         cntReadByte += vI[0]
 
         strs = dumpedtext.split("\n")
@@ -173,7 +214,7 @@ def ReadIndex_binary(indexfile, isPrintWarning = False):#{{{
         vI.fromfile(fpin,1)
         cntReadByte += vI.itemsize
 
-        dumpedidlist=fpin.read(vI[0])
+        dumpedidlist=fpin.read(vI[0]).decode()
         cntReadByte += vI[0]
 
         idlist = dumpedidlist.split("\n")
@@ -286,3 +327,253 @@ def ReadIndex_text(indexfile, isPrintWarning = False):#{{{
         print(msg.format(indexfile, sys._getframe().f_code.co_name), file=sys.stderr)
         return (None, None, None)
 #}}}
+def GetIDHash(idbyte):#{{{
+    """
+    Return the hash of the record ID (bytes) used in the hash table of the
+    index file of version_mmap
+    """
+    return int.from_bytes(hashlib.blake2b(idbyte, digest_size=8).digest(),
+            "little")
+#}}}
+def ReadIndexHeader_binary(fpin):#{{{
+    """
+    Read the header text of the index file of the binary format and return
+    (headerDict, cntReadByte), where headerDict is {'DEF_VERSION': '1.4', ...}
+    """
+    vI = array('I')
+    vI.fromfile(fpin,1)
+    dumpedtext = fpin.read(vI[0]).decode()
+    headerDict = {}
+    for line in dumpedtext.split("\n"):
+        if not line or line[0] == "#":
+            continue
+        ss = line.split()
+        if len(ss) >= 2:
+            headerDict[ss[0]] = ss[1]
+        else:
+            headerDict[ss[0]] = ""
+    return (headerDict, vI.itemsize + vI[0])
+#}}}
+def IsMmapIndex(indexfile):#{{{
+    """
+    Whether the index file is of the binary format of version_mmap or later
+    """
+    try:
+        with open(indexfile, "rb") as fpin:
+            (headerDict, cntReadByte) = ReadIndexHeader_binary(fpin)
+        return float(headerDict.get('DEF_VERSION', "0")) >= float(version_mmap)
+    except (IOError, EOFError, ValueError, UnicodeDecodeError):
+        return False
+#}}}
+def GetCompressor(compression, level=None):#{{{
+    """
+    Return the function that compresses a record (bytes) with compression,
+    None if the compression is not supported
+    """
+    if compression == COMPRESSION_NONE:
+        return bytes
+    elif compression == COMPRESSION_ZLIB:
+        if level is None:
+            level = 6
+        return lambda data: zlib.compress(data, level)
+    elif compression == COMPRESSION_ZSTD and zstandard is not None:
+        if level is None:
+            level = 3
+        return zstandard.ZstdCompressor(level=level).compress
+    return None
+#}}}
+def GetDecompressor(compression):#{{{
+    """
+    Return the function that decompresses a record with compression, None if
+    the compression is not supported
+    """
+    if compression == COMPRESSION_NONE:
+        return bytes
+    elif compression == COMPRESSION_ZLIB:
+        return zlib.decompress
+    elif compression == COMPRESSION_ZSTD and zstandard is not None:
+        return ZstdDecompress
+    return None
+#}}}
+def ZstdDecompress(data):#{{{
+    """
+    Decompress data with the zstd decompressor of this thread, since a
+    decompressor can not be used by several threads at the same time
+    """
+    dctx = getattr(g_zstd_local, "dctx", None)
+    if dctx is None:
+        dctx = zstandard.ZstdDecompressor()
+        g_zstd_local.dctx = dctx
+    return dctx.decompress(data)
+#}}}
+def WriteIndex_mmap(indexfile, headerinfo, indexList,#{{{
+        compression=COMPRESSION_NONE):
+    """
+    Write the index file of the binary format of version_mmap
+    indexList is [idList, v1, v2, v3] as returned by ReadIndex_binary, i.e.
+    the record IDs, dbfile index, offset and size of the records
+    The index file is first written to a temporary file and then renamed
+    """
+    (dbname, origversion, ext, prefix) = headerinfo
+    (idList, v1, v2, v3) = indexList
+    numRecord = len(idList)
+    numSlot = 8
+    while numSlot < 2*numRecord:
+        numSlot *= 2
+    numDBFile = max(v1)+1 if numRecord > 0 else 0
+
+    indexFileHeaderText = GetIndexFileHeaderText((dbname, version_mmap, ext,
+        prefix))
+    indexFileHeaderText.append("DEF_NUMRECORD %d"%(numRecord))
+    indexFileHeaderText.append("DEF_NUMSLOT %d"%(numSlot))
+    indexFileHeaderText.append("DEF_NUMDBFILE %d"%(numDBFile))
+    indexFileHeaderText.append("DEF_COMPRESSION %s"%(compression))
+    dumpedtext = '\n'.join(indexFileHeaderText).encode()
+    size_header = 4 + len(dumpedtext)
+    padding = (8 - size_header % 8) % 8
+
+    entries = bytearray(ENTRY_STRUCT.size*numRecord)
+    slots = array('Q', bytes(SLOT_STRUCT.size*numSlot))
+    idbyteList = []
+    id_offset = 0
+    mask = numSlot - 1
+    for i in range(numRecord):
+        idbyte = idList[i].encode()
+        idbyteList.append(idbyte)
+        ENTRY_STRUCT.pack_into(entries, i*ENTRY_STRUCT.size, id_offset,
+                len(idbyte), v1[i], v2[i], v3[i])
+        id_offset += len(idbyte)
+        # the later record of duplicated IDs replaces the earlier one, as for
+        # the dictionary index of MyDB
+        pos = GetIDHash(idbyte) & mask
+        while slots[pos] != 0 and idbyteList[slots[pos]-1] != idbyte:
+            pos = (pos + 1) & mask
+        slots[pos] = i + 1
+    if sys.byteorder != "little":
+        slots.byteswap()
+
+    tmpfile = indexfile + ".tmp.%d"%(os.getpid())
+    try:
+        with open(tmpfile, "wb") as fpindex:
+            vI = array('I')
+            vI.append(len(dumpedtext))
+            vI.tofile(fpindex)
+            fpindex.write(dumpedtext)
+            fpindex.write(b"\0"*padding)
+            fpindex.write(entries)
+            slots.tofile(fpindex)
+            fpindex.write(b"".join(idbyteList))
+        os.replace(tmpfile, indexfile)
+    except IOError:
+        msg = "Failed to write index file {} in function {}"
+        print(msg.format(indexfile, sys._getframe().f_code.co_name), file=sys.stderr)
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+        return 1
+    return 0
+#}}}
+def ConvertIndexToMmap(dbname, isPrintWarning = False):#{{{
+    """
+    Convert the index of the database dbname from the old text or binary
+    format to the binary format of version_mmap, written to dbname.indexbin
+    """
+    (indexfile, formatindex) = GetIndexFile(dbname, FORMAT_BINARY)
+    if indexfile == "":
+        return 1
+    if formatindex == FORMAT_BINARY and IsMmapIndex(indexfile):
+        return 0
+    if formatindex == FORMAT_TEXT:
+        (indexList, headerinfo, dbfileindexList) = ReadIndex_text(indexfile,
+                isPrintWarning)
+    else:
+        (indexList, headerinfo, dbfileindexList) = ReadIndex_binary(indexfile,
+                isPrintWarning)
+    if indexList == None:
+        return 1
+    return WriteIndex_mmap(dbname + ".indexbin", headerinfo, indexList)
+#}}}
+class MmapIndex:#{{{
+# Description:
+#   Read-only access to the index file of version_mmap by mmap, the index is
+#   not loaded into memory
+# Functions:
+#   Lookup(record_id) : return the index of the record, -1 if not found
+#   GetEntry(idx)     : return (dbfileindex, offset, size) of the record
+#   self[idx]         : return the ID of the record
+#   close()
+    def __init__(self, indexfile):#{{{
+        self.failure = False
+        self.indexfile = indexfile
+        self.mm = None
+        try:
+            with open(indexfile, "rb") as fpin:
+                (self.headerDict, size_header) = ReadIndexHeader_binary(fpin)
+                self.mm = mmap.mmap(fpin.fileno(), 0, access=mmap.ACCESS_READ)
+            self.numRecord = int(self.headerDict['DEF_NUMRECORD'])
+            self.numSlot = int(self.headerDict['DEF_NUMSLOT'])
+            numDBFile = int(self.headerDict.get('DEF_NUMDBFILE', "1"))
+        except (IOError, EOFError, ValueError, KeyError) as e:
+            msg = "Failed to read index file {} with errmsg={}"
+            print(msg.format(indexfile, str(e)), file=sys.stderr)
+            self.failure = True
+            return None
+        self.headerinfo = (self.headerDict.get('DEF_DBNAME', ""),
+                self.headerDict.get('DEF_VERSION', ""),
+                self.headerDict.get('DEF_EXTENSION', ""),
+                self.headerDict.get('DEF_PREFIX', ""))
+        self.dbfileindexList = list(range(numDBFile))
+        self.mask = self.numSlot - 1
+        self.pos_entry = size_header + (8 - size_header % 8) % 8
+        self.pos_slot = self.pos_entry + ENTRY_STRUCT.size*self.numRecord
+        self.pos_id = self.pos_slot + SLOT_STRUCT.size*self.numSlot
+        if self.pos_id > len(self.mm):
+            msg = "Index file {} is truncated"
+            print(msg.format(indexfile), file=sys.stderr)
+            self.close()
+            self.failure = True
+            return None
+#}}}
+    def __len__(self):#{{{
+        return self.numRecord
+#}}}
+    def __getitem__(self, idx):#{{{
+        if idx < 0:
+            idx += self.numRecord
+        if idx < 0 or idx >= self.numRecord:
+            raise IndexError("record index out of range")
+        (id_offset, id_length, dbfileindex, offset, size) =\
+                ENTRY_STRUCT.unpack_from(self.mm,
+                        self.pos_entry + idx*ENTRY_STRUCT.size)
+        pos = self.pos_id + id_offset
+        return self.mm[pos:pos+id_length].decode()
+#}}}
+    def GetEntry(self, idx):#{{{
+        return ENTRY_STRUCT.unpack_from(self.mm,
+                self.pos_entry + idx*ENTRY_STRUCT.size)[2:]
+#}}}
+    def Lookup(self, record_id):#{{{
+        if self.numRecord == 0:
+            return -1
+        idbyte = record_id.encode()
+        mm = self.mm
+        pos = GetIDHash(idbyte) & self.mask
+        while True:
+            idx = SLOT_STRUCT.unpack_from(mm,
+                    self.pos_slot + pos*SLOT_STRUCT.size)[0]
+            if idx == 0:
+                return -1
+            idx -= 1
+            (id_offset, id_length) = ENTRY_STRUCT.unpack_from(mm,
+                    self.pos_entry + idx*ENTRY_STRUCT.size)[:2]
+            if id_length == len(idbyte):
+                p = self.pos_id + id_offset
+                if mm[p:p+id_length] == idbyte:
+                    return idx
+            pos = (pos + 1) & self.mask
+#}}}
+    def close(self):#{{{
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+#}}}
+#}}}
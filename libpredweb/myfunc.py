@@ -11,6 +11,8 @@
 import sys
 import os
 import re
+import mmap
+import array
 import random
 import copy
 import subprocess
@@ -18,8 +20,13 @@ import requests
 import gzip
 import time
 import datetime
+import functools
+import threading
+import hashlib
+import base64
 GAP = "-"
 BLOCK_SIZE = 100000  # set a good value for reading text file by block reading
+g_thread_local = threading.local()
 aa_three2one = {'ALA': 'A', 'ARG': 'R', 'ASN': 'N', 'ASP': 'D',
                 'CYS': 'C', 'GLU': 'E', 'GLN': 'Q', 'GLY': 'G',
                 'HIS': 'H', 'ILE': 'I', 'LEU': 'L', 'LYS': 'K',
@@ -528,6 +535,25 @@ def WriteFile(content, outfile, mode="w", isFlush=False):#{{{
     except IOError:
         return "Failed to write to %s with mode \"%s\""%(outfile, mode)
 #}}}
+def WriteFileAtomic(content, outfile):#{{{
+    """Write content to outfile via a temporary file in the same folder, so
+    that readers see either the old or the new content but never a partially
+    written file
+    """
+    tmpfile = "%s.tmp.%d.%d"%(outfile, os.getpid(), threading.get_ident())
+    try:
+        with open(tmpfile, "w") as fpout:
+            fpout.write(content)
+            fpout.flush()
+        os.replace(tmpfile, outfile)
+        return ""
+    except (IOError, OSError):
+        try:
+            os.remove(tmpfile)
+        except OSError:
+            pass
+        return "Failed to write to %s"%(outfile)
+#}}}
 def ReadFile(infile, mode="r", encoding="utf-8"):#{{{
     """Read Content of File
     """
@@ -745,7 +771,7 @@ def GetSeqIDFromAnnotation(line, method_seqid=1):#{{{
     elif method_seqid == 1:
         seqID = ""
         try:
-            line = line.lstrip('>').split()[0]; #get the first word after '>'
+            line = line.lstrip('>').split(None, 1)[0]; #get the first word after '>'
             # if the annotation line has |, e.g. >sp|P0AE31|ARTM_ECOL6 Arginine ABC
             # transporter permease
         except:
@@ -987,224 +1013,325 @@ def GetRemainPos(segPosList, length):#{{{
     return remainPosList
 #}}}
 
+FASTA_DELETE_NEWLINE = b"\r\n "  # removed from sequences by ReadFasta
+FASTA_DELETE_WHITESPACE = b" \t\n\r\x0b\x0c"  # removed by ReadFastaFromBuffer
+
+def FindFastaRecord(buff, pos=0, endpos=None):#{{{
+    """
+    Iterate (beg, end) of the FASTA records in buff (bytes or mmap), a record
+    starts at the first '>' and at each '>' after a newline, the newline
+    before the next record is not included
+    """
+    if endpos is None:
+        endpos = len(buff)
+    find = buff.find
+    beg = find(b">", pos, endpos)
+    while beg >= 0:
+        end = find(b"\n>", beg+1, endpos)
+        if end < 0:
+            yield (beg, endpos)
+            return
+        yield (beg, end)
+        beg = end + 1
+#}}}
+def ParseFastaRecord(buff, beg, end, method_seqid=1, method_seq=0,#{{{
+        method_anno=0, deletechars=FASTA_DELETE_WHITESPACE,
+        isID=True, isAnno=True, isSeq=True):
+    """
+    Parse the FASTA record buff[beg:end], which starts with '>'
+    Return (seqID, anno, seq), items that are not requested are None
+    method_anno (default: 0)
+        0: anno is the description line without the first '>'
+        1: anno is the description line without all leading '>'
+    deletechars: characters removed from the sequence
+    the seqID is extracted only when isID is True
+    """
+    posAnnoEnd = buff.find(b"\n", beg, end)
+    if posAnnoEnd < 0:
+        posAnnoEnd = end
+    seqID = None
+    anno = None
+    seq = None
+    if isID or isAnno:
+        anno = buff[beg+1:posAnnoEnd].decode(errors="replace").rstrip("\r")
+        if method_anno == 1:
+            anno = anno.lstrip(">")
+        if isID:
+            seqID = GetSeqIDFromAnnotation(anno, method_seqid)
+        if not isAnno:
+            anno = None
+    if isSeq:
+        seq = buff[posAnnoEnd:end].translate(None, deletechars).decode(
+                errors="replace")
+        if method_seq == 1 and seq.find('{') >= 0:
+            seq = re.sub("{.*}", '', seq)
+    return (seqID, anno, seq)
+#}}}
+def ParseFastaBuffer(buff, pos=0, endpos=None, method_seqid=1, method_seq=0,#{{{
+        method_anno=0, deletechars=FASTA_DELETE_WHITESPACE,
+        isID=True, isAnno=True, isSeq=True):
+    """
+    Parse all FASTA records in buff[pos:endpos], buff is bytes or mmap
+    This is the parser used by ReadFasta, ReadFastaFromBuffer and the like
+    Return (idList, annotationList, seqList), lists that are not requested
+    are None, see ParseFastaRecord for the options
+    """
+    idList = [] if isID else None
+    annotationList = [] if isAnno else None
+    seqList = [] if isSeq else None
+    if endpos is None:
+        endpos = len(buff)
+    # the loop of FindFastaRecord and ParseFastaRecord inlined for speed
+    find = buff.find
+    isAnnoLine = isID or isAnno
+    beg = find(b">", pos, endpos)
+    while beg >= 0:
+        end = find(b"\n>", beg+1, endpos)
+        if end < 0:
+            end = endpos
+        posAnnoEnd = find(b"\n", beg, end)
+        if posAnnoEnd < 0:
+            posAnnoEnd = end
+        if isAnnoLine:
+            anno = buff[beg+1:posAnnoEnd].decode(errors="replace").rstrip("\r")
+            if method_anno == 1:
+                anno = anno.lstrip(">")
+            if isID:
+                idList.append(GetSeqIDFromAnnotation(anno, method_seqid))
+            if isAnno:
+                annotationList.append(anno)
+        if isSeq:
+            seq = buff[posAnnoEnd:end].translate(None, deletechars).decode(
+                    errors="replace")
+            if method_seq == 1 and seq.find('{') >= 0:
+                seq = re.sub("{.*}", '', seq)
+            seqList.append(seq)
+        if end >= endpos:
+            break
+        beg = end + 1
+    return (idList, annotationList, seqList)
+#}}}
+def ParseFastaFile(infile, **kwargs):#{{{
+    """
+    Parse all FASTA records in infile, which is mapped by mmap instead of
+    read into memory, the options are the same as ParseFastaBuffer
+    raise IOError if infile can not be read
+    """
+    with open(infile, "rb") as fpin:
+        if os.fstat(fpin.fileno()).st_size == 0:
+            return ParseFastaBuffer(b"", **kwargs)
+        mm = mmap.mmap(fpin.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return ParseFastaBuffer(mm, **kwargs)
+        finally:
+            mm.close()
+#}}}
 def ReadFasta(infile, BLOCK_SIZE=100000):#{{{
     """
     Read sequence file in FASTA format
     """
-    idList=[]
-    annotationList=[]
-    seqList=[]
-    fpin = None
     try:
-        fpin=open(infile,"r")
+        return ParseFastaFile(infile, method_anno=1,
+                deletechars=FASTA_DELETE_NEWLINE)
     except IOError:
         print("Failed to read fasta file %s "%(infile), file=sys.stderr)
         return ([], [], [])
-    buff = fpin.read(BLOCK_SIZE)
-    brokenSeqWithAnnoLine=""; ##for the annotation line broken by BLOCK read
-    while buff:
-        beg=0
-        end=0
-        while 1:
-            if brokenSeqWithAnnoLine:
-                if brokenSeqWithAnnoLine[len(brokenSeqWithAnnoLine)-1] == "\n":
-                    end=buff.find(">")
-                else:
-                    end=buff.find("\n>")
-                if end >= 0:
-                    seqWithAnno = brokenSeqWithAnnoLine + buff[0:end]
-
-                    idList.append( GetSeqIDFromAnnotation(seqWithAnno[0:seqWithAnno.find('\n')]))
-                    annotationList.append(seqWithAnno[0:seqWithAnno.find('\n')].lstrip('>').rstrip('\n'))
-                    seqList.append( seqWithAnno[seqWithAnno.find("\n"):].replace('\n','').replace(' ',''))
-
-                    brokenSeqWithAnnoLine = ""
-                    beg=end
-                else:
-                    brokenSeqWithAnnoLine += buff
-                    break
-
-            beg=buff.find(">",beg)
-            end=buff.find("\n>",beg+1)
-            if beg >= 0:
-                if end >=0:
-                    seqWithAnno=buff[beg:end]
-                    idList.append( GetSeqIDFromAnnotation(seqWithAnno[0:seqWithAnno.find('\n')]))
-                    annotationList.append(seqWithAnno[0:seqWithAnno.find('\n')].lstrip('>').rstrip('\n'))
-                    seqList.append( seqWithAnno[seqWithAnno.find("\n"):].replace('\n','').replace(' ',''))
-                    beg=end
-                else:
-                    brokenSeqWithAnnoLine=buff[beg:]
-                    break
-            else:
-                break
-        buff = fpin.read(BLOCK_SIZE)
-
-    if brokenSeqWithAnnoLine:
-        seqWithAnno=brokenSeqWithAnnoLine
-        idList.append( GetSeqIDFromAnnotation(seqWithAnno[0:seqWithAnno.find('\n')]))
-        annotationList.append(seqWithAnno[0:seqWithAnno.find('\n')].lstrip('>').rstrip('\n'))
-        seqList.append( seqWithAnno[seqWithAnno.find("\n"):].replace('\n','').replace(' ',''))
-    fpin.close()
-    return (idList, annotationList, seqList)
 #}}}
 def ReadFasta_without_annotation(infile, BLOCK_SIZE=100000):#{{{
-    idList=[]
-    seqList=[]
-    fpin = None
     try:
-        fpin=open(infile,"r")
+        (idList, annotationList, seqList) = ParseFastaFile(infile,
+                method_anno=1, deletechars=FASTA_DELETE_NEWLINE, isAnno=False)
+        return (idList, seqList)
     except IOError:
         print("Failed to read file %s."%(infile), file=sys.stderr)
         return (None, None)
-    buff = fpin.read(BLOCK_SIZE)
-    brokenSeqWithAnnoLine=""; ##for the annotation line broken by BLOCK read
-    while buff:
-        beg=0
-        end=0
-        while 1:
-            if brokenSeqWithAnnoLine:
-                if brokenSeqWithAnnoLine[len(brokenSeqWithAnnoLine)-1] == "\n":
-                    end=buff.find(">")
-                else:
-                    end=buff.find("\n>")
-                if end >= 0:
-                    seqWithAnno = brokenSeqWithAnnoLine + buff[0:end]
-
-                    idList.append( GetSeqIDFromAnnotation(seqWithAnno[0:seqWithAnno.find('\n')]))
-                    seqList.append( seqWithAnno[seqWithAnno.find("\n"):].replace('\n','').replace(' ',''))
-
-                    brokenSeqWithAnnoLine = ""
-                    beg=end
-                else:
-                    brokenSeqWithAnnoLine += buff
-                    break
-
-            beg=buff.find(">",beg)
-            end=buff.find("\n>",beg+1)
-            if beg >= 0:
-                if end >=0:
-                    seqWithAnno=buff[beg:end]
-                    idList.append( GetSeqIDFromAnnotation(seqWithAnno[0:seqWithAnno.find('\n')]))
-                    seqList.append( seqWithAnno[seqWithAnno.find("\n"):].replace('\n','').replace(' ',''))
-                    beg=end
-                else:
-                    brokenSeqWithAnnoLine=buff[beg:]
-                    break
-            else:
-                break
-        buff = fpin.read(BLOCK_SIZE)
-
-    if brokenSeqWithAnnoLine:
-        seqWithAnno=brokenSeqWithAnnoLine
-        idList.append( GetSeqIDFromAnnotation(seqWithAnno[0:seqWithAnno.find('\n')]))
-        seqList.append( seqWithAnno[seqWithAnno.find("\n"):].replace('\n','').replace(' ',''))
-    fpin.close();   
-    return (idList, seqList)
 #}}}
 def ReadFasta_without_id(infile, BLOCK_SIZE=100000):#{{{
-    annotationList=[]
-    seqList=[]
-    fpin = None
     try:
-        fpin=open(infile,"r")
+        (idList, annotationList, seqList) = ParseFastaFile(infile,
+                method_anno=1, deletechars=FASTA_DELETE_NEWLINE, isID=False)
+        return (annotationList, seqList)
     except IOError:
         print("Failed to open file %s for read"%(infile), file=sys.stderr)
         return (None, None)
-    buff = fpin.read(BLOCK_SIZE)
-    brokenSeqWithAnnoLine=""; ##for the annotation line broken by BLOCK read
-    while buff:
-        beg=0
-        end=0
-        while 1:
-            if brokenSeqWithAnnoLine:
-                if brokenSeqWithAnnoLine[len(brokenSeqWithAnnoLine)-1] == "\n":
-                    end=buff.find(">")
-                else:
-                    end=buff.find("\n>")
-                if end >= 0:
-                    seqWithAnno = brokenSeqWithAnnoLine + buff[0:end]
-
-                    annotationList.append(seqWithAnno[0:seqWithAnno.find('\n')].lstrip('>').rstrip('\n'))
-                    seqList.append( seqWithAnno[seqWithAnno.find("\n"):].replace('\n','').replace(' ',''))
-
-                    brokenSeqWithAnnoLine = ""
-                    beg=end
-                else:
-                    brokenSeqWithAnnoLine += buff
-                    break
-
-            beg=buff.find(">",beg)
-            end=buff.find("\n>",beg+1)
-            if beg >= 0:
-                if end >=0:
-                    seqWithAnno=buff[beg:end]
-                    annotationList.append(seqWithAnno[0:seqWithAnno.find('\n')].lstrip('>').rstrip('\n'))
-                    seqList.append( seqWithAnno[seqWithAnno.find("\n"):].replace('\n','').replace(' ',''))
-                    beg=end
-                else:
-                    brokenSeqWithAnnoLine=buff[beg:]
-                    break
-            else:
-                break
-        buff = fpin.read(BLOCK_SIZE)
-
-    if brokenSeqWithAnnoLine:
-        seqWithAnno=brokenSeqWithAnnoLine
-        annotationList.append(seqWithAnno[0:seqWithAnno.find('\n')].lstrip('>').rstrip('\n'))
-        seqList.append( seqWithAnno[seqWithAnno.find("\n"):].replace('\n','').replace(' ',''))
-    fpin.close();
-    return (annotationList, seqList)
 #}}}
 def ReadFasta_simple(infile, BLOCK_SIZE=100000):#{{{
-    seqList=[]
-    fpin = None
     try:
-        fpin=open(infile,"r")
+        return ParseFastaFile(infile, method_anno=1,
+                deletechars=FASTA_DELETE_NEWLINE, isID=False, isAnno=False)[2]
     except IOError:
         print("Failed to open file %s for read"%(infile), file=sys.stderr)
         return None
-    buff = fpin.read(BLOCK_SIZE)
-    brokenSeqWithAnnoLine=""; ##for the annotation line broken by BLOCK read
-    while buff:
-        beg=0
-        end=0
-        while 1:
-            if brokenSeqWithAnnoLine:
-                if brokenSeqWithAnnoLine[len(brokenSeqWithAnnoLine)-1] == "\n":
-                    end=buff.find(">")
-                else:
-                    end=buff.find("\n>")
-                if end >= 0:
-                    seqWithAnno = brokenSeqWithAnnoLine + buff[0:end]
-
-                    seqList.append( seqWithAnno[seqWithAnno.find("\n"):].replace('\n','').replace(' ',''))
-
-                    brokenSeqWithAnnoLine = ""
-                    beg=end
-                else:
-                    brokenSeqWithAnnoLine += buff
-                    break
-
-            beg=buff.find(">",beg)
-            end=buff.find("\n>",beg+1)
-            if beg >= 0:
-                if end >=0:
-                    seqWithAnno=buff[beg:end]
-                    seqList.append(seqWithAnno[seqWithAnno.find("\n"):].replace('\n','').replace(' ',''))
-                    beg=end
-                else:
-                    brokenSeqWithAnnoLine=buff[beg:]
-                    break
-            else:
-                break
-        buff = fpin.read(BLOCK_SIZE)
+#}}}
 
-    if brokenSeqWithAnnoLine:
-        seqWithAnno=brokenSeqWithAnnoLine
-        seqList.append(seqWithAnno[seqWithAnno.find("\n"):].replace('\n','').replace(' ',''))
-    fpin.close();   
-    return seqList
+class FastaFile:#{{{
+# Description: random access to the records of a FASTA file by index
+#   The offsets of the records are indexed on the first access by index, the
+#   index is an array of offsets which is saved to <infile>.idx, so that the
+#   file is scanned only once even by different processes. The saved index is
+#   used only when the size and modification time of infile are unchanged.
+#   The records are parsed the same way as ReadFasta, and read by os.pread,
+#   so that a FastaFile object can be shared by threads.
+# Function:
+#   len(handle)
+#   handle[i]  return (seqID, anno, seq) of the i-th record
+#   for (seqID, anno, seq) in handle:  iterate the records without indexing
+#   GetRecordText(i)  return the raw text of the i-th record
+#   close()
+#
+# Usage:
+# handle = FastaFile(infile)
+# if handle.failure:
+#   print "Failed to init FastaFile for file", infile
+#   return 1
+# (seqid, seqanno, seq) = handle[origIndex]
+# handle.close()
+    def __init__(self, infile, isSaveIndex=True, method_seqid=1,#{{{
+            method_seq=0):
+        self.failure = False
+        self.filename = infile
+        self.indexfile = "%s.idx"%(infile)
+        self.isSaveIndex = isSaveIndex
+        self.method_seqid = method_seqid
+        self.method_seq = method_seq
+        self.offsetList = None  # array of the start offsets of the records
+        self.lock = threading.Lock()
+        self.fd = -1
+        try:
+            self.fd = os.open(infile, os.O_RDONLY)
+            st = os.fstat(self.fd)
+        except OSError:
+            print("Failed to read file %s"%(self.filename), file=sys.stderr)
+            self.failure = True
+            return None
+        self.filesize = st.st_size
+        self.mtime_ns = st.st_mtime_ns
+#}}}
+    def __del__(self):#{{{
+        try:
+            self.close()
+        except AttributeError:
+            pass
+#}}}
+    def __enter__(self):#{{{
+        return self
+#}}}
+    def __exit__(self, exc_type, exc_value, traceback):#{{{
+        self.close()
+        return False
+#}}}
+    def ReadIndex(self):#{{{
+        """
+        Read the saved index, return None if it is missing or out of date
+        """
+        try:
+            with open(self.indexfile, "rb") as fpin:
+                header = array.array('Q')
+                header.fromfile(fpin, 3)
+                if (header[0] != self.filesize or
+                        header[1] != self.mtime_ns):
+                    return None
+                offsetList = array.array('Q')
+                offsetList.fromfile(fpin, header[2])
+                return offsetList
+        except (IOError, OSError, EOFError):
+            return None
+#}}}
+    def WriteIndex(self, offsetList):#{{{
+        """
+        Save the index, the index is written to a temporary file and renamed,
+        so that other processes never read a partial index
+        """
+        tmpfile = "%s.tmp.%d"%(self.indexfile, os.getpid())
+        header = array.array('Q', [self.filesize, self.mtime_ns,
+            len(offsetList)])
+        try:
+            with open(tmpfile, "wb") as fpout:
+                header.tofile(fpout)
+                offsetList.tofile(fpout)
+            os.replace(tmpfile, self.indexfile)
+        except (IOError, OSError) as e:
+            print("Failed to write index file %s with errmsg=%s"%(
+                self.indexfile, str(e)), file=sys.stderr)
+            try:
+                os.remove(tmpfile)
+            except OSError:
+                pass
+#}}}
+    def BuildIndex(self):#{{{
+        """
+        Scan the file and return the array of the start offsets of the records
+        """
+        offsetList = array.array('Q')
+        if self.filesize == 0:
+            return offsetList
+        mm = mmap.mmap(self.fd, 0, access=mmap.ACCESS_READ)
+        try:
+            offsetList.extend(beg for (beg, end) in FindFastaRecord(mm))
+        finally:
+            mm.close()
+        return offsetList
+#}}}
+    def GetOffsetList(self):#{{{
+        if self.offsetList is None:
+            with self.lock:
+                if self.offsetList is None:
+                    offsetList = self.ReadIndex()
+                    if offsetList is None:
+                        offsetList = self.BuildIndex()
+                        if self.isSaveIndex:
+                            self.WriteIndex(offsetList)
+                    self.offsetList = offsetList
+        return self.offsetList
+#}}}
+    def __len__(self):#{{{
+        if self.failure:
+            return 0
+        return len(self.GetOffsetList())
+#}}}
+    def GetRecordText(self, i):#{{{
+        """
+        Return the raw text (bytes) of the i-th record, the newline before the
+        next record is not included, raise IndexError if i is out of range
+        """
+        if self.failure:
+            raise IndexError("FastaFile index out of range")
+        offsetList = self.GetOffsetList()
+        num = len(offsetList)
+        if i < 0:
+            i += num
+        if i < 0 or i >= num:
+            raise IndexError("FastaFile index out of range")
+        beg = offsetList[i]
+        if i+1 < num:
+            end = offsetList[i+1] - 1
+        else:
+            end = self.filesize
+        return os.pread(self.fd, end-beg, beg)
+#}}}
+    def __getitem__(self, i):#{{{
+        buff = self.GetRecordText(i)
+        return ParseFastaRecord(buff, 0, len(buff), self.method_seqid,
+                self.method_seq, method_anno=1,
+                deletechars=FASTA_DELETE_NEWLINE)
+#}}}
+    def __iter__(self):#{{{
+        if self.failure or self.filesize == 0:
+            return
+        mm = mmap.mmap(self.fd, 0, access=mmap.ACCESS_READ)
+        try:
+            for (beg, end) in FindFastaRecord(mm):
+                yield ParseFastaRecord(mm, beg, end, self.method_seqid,
+                        self.method_seq, method_anno=1,
+                        deletechars=FASTA_DELETE_NEWLINE)
+        finally:
+            mm.close()
+#}}}
+    def close(self):#{{{
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+#}}}
 #}}}
 
 def ReadPDBTOSP(infile): #{{{
@@ -1290,27 +1417,10 @@ def ExtractFromSeqWithAnno(seqWithAnno, method_seqid=1, method_seq=0):#{{{
         1: extended fasta format, additional information may be added after
            sequence and enclosed by {}
     """
-    seqID = None
-    anno = None
-    seq = None
     if seqWithAnno and seqWithAnno[0] == '>':
-        posAnnoEnd = seqWithAnno.find('\n')
-        if posAnnoEnd >= 0:
-            anno = seqWithAnno[1:posAnnoEnd]
-            seqID = GetSeqIDFromAnnotation(anno, method_seqid)
-
-            seq = seqWithAnno[posAnnoEnd+1:]
-            seq = re.sub(r"\s+", '', seq)
-            if method_seq == 1:
-                if seq.find('{') >= 0:
-                    # re is much slower than find
-                    seq = re.sub("{.*}", '',seq);  
-        else:
-            anno = seqWithAnno[1:]
-            seqID = GetSeqIDFromAnnotation(anno, method_seqid)
-            seq = ""
-    return (seqID, anno, seq)
-
+        buff = seqWithAnno.encode()
+        return ParseFastaRecord(buff, 0, len(buff), method_seqid, method_seq)
+    return (None, None, None)
 #}}}
 def ExtractFromSeqWithAnno_MPA(seqWithAnno, method_seqid=1, method_seq=0):#{{{
     """
@@ -1389,6 +1499,7 @@ def ReadFastaFromBuffer(buff,recordList, isEOFreached, #{{{
 # 2015-04-13
     """
     Return (unprocessedBuffer)
+    buff is str or bytes, the unprocessedBuffer is of the same type
     method_seqid (default: 1):
         0: just get the first word in the description line
         1: more complicated way
@@ -1398,32 +1509,28 @@ def ReadFastaFromBuffer(buff,recordList, isEOFreached, #{{{
            sequence and enclosed by {}
     """
     if not buff:
-        return ""
-    unprocessedBuffer=""
-    beg=0
-    end=0
-    while 1:
-        beg=buff.find(">",beg)
-        if beg >= 0:
-            end=buff.find("\n>",beg+1)
-            if end >=0:
-                seqWithAnno=buff[beg:end]
-                (seqid, seqanno, seq) =  ExtractFromSeqWithAnno(seqWithAnno, method_seqid, method_seq)
-                if not seq is None:
-                    recordList.append((seqid, seqanno, seq))
-                beg=end
-            else:
-                unprocessedBuffer = buff[beg:]
-                break
-        else:
-            unprocessedBuffer=buff[end:]
-            break
-    if isEOFreached and unprocessedBuffer:
-        seqWithAnno = unprocessedBuffer
-        (seqid, seqanno, seq) =  ExtractFromSeqWithAnno(seqWithAnno, method_seqid, method_seq)
-        if not seq is None:
-            recordList.append((seqid, seqanno, seq))
-        unprocessedBuffer = ""
+        return buff[0:0]
+    isStr = isinstance(buff, str)
+    if isStr:
+        buff = buff.encode()
+    beg = buff.find(b">")
+    if beg < 0: # no record is started yet
+        unprocessedBuffer = b"" if isEOFreached else buff
+    elif isEOFreached:
+        endpos = len(buff)
+        unprocessedBuffer = b""
+    else: # the last record may be incomplete
+        endpos = buff.rfind(b"\n>") + 1
+        if endpos <= beg:
+            endpos = beg
+        unprocessedBuffer = buff[endpos:]
+        endpos = max(beg, endpos - 1)
+    if beg >= 0:
+        (idList, annotationList, seqList) = ParseFastaBuffer(buff, beg,
+                endpos, method_seqid, method_seq)
+        recordList.extend(zip(idList, annotationList, seqList))
+    if isStr:
+        return unprocessedBuffer.decode(errors="replace")
     return unprocessedBuffer
 #}}}
 def ReadMPAFromBuffer(buff,recordList, isEOFreached, #{{{
@@ -1945,7 +2052,9 @@ def check_output(*popenargs, **kwargs):#{{{
 
 def IsURLExist(url, timeout=2):#{{{
     try:
-        response = requests.get(url,timeout=timeout)
+        # stream=True so that only the header is fetched
+        response = GetRequestsSession().get(url, timeout=timeout, stream=True)
+        response.close()
         if response.status_code < 400:
             return True
         else:
@@ -1953,6 +2062,16 @@ def IsURLExist(url, timeout=2):#{{{
     except:
         return False
 #}}}
+def GetRequestsSession():#{{{
+    """Return a requests.Session for the current thread, so that connections
+    to the same host are kept alive and reused between calls
+    """
+    session = getattr(g_thread_local, 'requests_session', None)
+    if session is None:
+        session = requests.Session()
+        g_thread_local.requests_session = session
+    return session
+#}}}
 def urlretrieve(url, outfile, timeout=10):# {{{
     """Retrieve the file from url and save in outfile
     Default timeout is 10 seconds
@@ -1965,6 +2084,86 @@ def urlretrieve(url, outfile, timeout=10):# {{{
             # Write the chunk to the file
             fh.write(chunk)
 # }}}
+def FetchURL(url, outfile, timeout=10, max_try=3, md5_expected=""):# {{{
+    """Download url to outfile with a single streaming GET
+
+    The data is first written to outfile.part, if the transfer is interrupted,
+    the next try resumes from the end of outfile.part with a Range request.
+    The size is checked against Content-Length and the md5 checksum against
+    md5_expected, if given, or the Content-MD5 header sent by the server.
+    outfile is created only when the download is complete, outfile.part is
+    removed when all tries failed.
+
+    Return "" on success and an error message otherwise
+    """
+    partfile = outfile + ".part"
+    session = GetRequestsSession()
+    errmsg = ""
+    for cnttry in range(max_try):
+        size_part = 0
+        if os.path.exists(partfile):
+            size_part = os.path.getsize(partfile)
+        headers = {}
+        if size_part > 0:
+            headers['Range'] = "bytes=%d-"%(size_part)
+        try:
+            with session.get(url, timeout=timeout, stream=True,
+                             headers=headers) as response:
+                if response.status_code == 416:
+                    # the part file is already complete or is invalid,
+                    # restart from scratch
+                    os.remove(partfile)
+                    errmsg = "HTTP 416 for %s"%(url)
+                    continue
+                if response.status_code >= 400:
+                    errmsg = "HTTP %d for %s"%(response.status_code, url)
+                    break
+                if response.status_code == 206:
+                    mode = "ab"
+                else:
+                    mode = "wb"
+                    size_part = 0
+                size_expected = -1
+                length = response.headers.get('Content-Length', "")
+                if length.isdigit():
+                    size_expected = size_part + int(length)
+                with open(partfile, mode) as fh:
+                    for chunk in response.iter_content(1024 * 1024):
+                        fh.write(chunk)
+                content_md5 = response.headers.get('Content-MD5', "")
+        except Exception as e:
+            errmsg = "Failed to retrieve %s with errmsg=%s"%(url, str(e))
+            continue
+
+        size_got = os.path.getsize(partfile)
+        if size_expected >= 0 and size_got != size_expected:
+            errmsg = "Incomplete retrieval of %s, %d of %d bytes"%(url,
+                    size_got, size_expected)
+            continue
+
+        if md5_expected == "" and content_md5 != "":
+            try:
+                md5_expected = base64.b64decode(content_md5).hex()
+            except ValueError:
+                pass
+        if md5_expected != "":
+            md5 = hashlib.md5()
+            with open(partfile, "rb") as fpin:
+                for chunk in iter(lambda: fpin.read(1024 * 1024), b""):
+                    md5.update(chunk)
+            if md5.hexdigest() != md5_expected.lower():
+                os.remove(partfile)
+                errmsg = "md5 checksum mismatch for %s"%(url)
+                continue
+
+        os.replace(partfile, outfile)
+        return ""
+    try:
+        os.remove(partfile)
+    except OSError:
+        pass
+    return errmsg
+# }}}
 def Size_human2byte(s):#{{{
     if s.isdigit():
         return int(s)
@@ -2061,12 +2260,22 @@ def ArchiveFile(filename, maxsize):#{{{
 #     return prio
 # #}}}
 
-def GetSuqPriority(numseq_this_user):#{{{
-### the jobs queued for more than one day should have higher priority no matter how many sequences it is
-    year = datetime.datetime.today().year
+@functools.lru_cache(maxsize=8)
+def GetEpochOfLastYear(year):#{{{
+    """Return the epoch time of 1 January of the year before year, in local
+    time, the result is cached since it changes only once a year
+    """
     lastyear = year-1
-    epoch_time_lastyear = datetime.datetime.strptime(str(lastyear), '%Y').strftime('%s')
-    seconds_since_lastyear = time.time() - float(epoch_time_lastyear) 
+    return float(datetime.datetime.strptime(str(lastyear), '%Y').strftime('%s'))
+#}}}
+def GetSuqPriority(numseq_this_user, epoch_now=None):#{{{
+### the jobs queued for more than one day should have higher priority no matter how many sequences it is
+### epoch_now pins the time the priority is computed at, so that priorities
+### computed at different times can be compared
+    if epoch_now is None:
+        epoch_now = time.time()
+    year = datetime.datetime.fromtimestamp(epoch_now).year
+    seconds_since_lastyear = epoch_now - GetEpochOfLastYear(year)
     if numseq_this_user > 20000:
         numseq_this_user = 20000
     prio = int(( (1/seconds_since_lastyear*1e10) * 1e6 ) ) - int(numseq_this_user**1.35)
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Description:
+Priority scoring of the queued jobs
+
+PriorityScorer computes the time term of myfunc.GetSuqPriority once, at the
+time it is created, and then scores any number of jobs with it, in one
+vectorised pass with NumPy when NumPy is installed. It is used by
+CreateRunJoblog and can be used by analysis scripts as well, e.g.
+
+    scorer = PriorityScorer(blackiplist=[...], vip_user_list=[...])
+    (priority_list, numseq_this_user_list) = scorer.ScoreMany(
+            numseq_list, numseq_this_user_list, ip_list, email_list)
+
+Author: Nanjiang Shu (nanjiang.shu@scilifelab.se)
+
+Address: Science for Life Laboratory Stockholm, Box 1031, 17121 Solna, Sweden
+"""
+
+import math
+import time
+import datetime
+from . import myfunc
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MAX_NUMSEQ_THIS_USER = 20000   # numseq_this_user is capped at this value
+EXP_NUMSEQ_THIS_USER = 1.35
+PRIORITY_VIP = 999999999.0
+BLACKIP_DIVISOR = 1000.0
+
+
+class PriorityScorer(object):  # {{{
+    """Score the priority of jobs at a fixed time
+
+    The priority of a job is
+        (GetSuqPriority(numseq_this_user) - numseq) / sqrt(numseq)
+    divided by BLACKIP_DIVISOR for IPs in blackiplist, and PRIORITY_VIP for
+    IPs or emails in vip_user_list, for which numseq_this_user is set to 1.
+    """
+    def __init__(self, epoch_now=None, blackiplist=None,
+                 vip_user_list=None):  # {{{
+        if epoch_now is None:
+            epoch_now = time.time()
+        self.epoch_now = epoch_now
+        self.blackip_set = set(blackiplist) if blackiplist else set([])
+        self.vip_user_set = set(vip_user_list) if vip_user_list else set([])
+        year = datetime.datetime.fromtimestamp(epoch_now).year
+        seconds_since_lastyear = epoch_now - myfunc.GetEpochOfLastYear(year)
+        self.time_term = int(((1/seconds_since_lastyear*1e10) * 1e6))
+# }}}
+
+    def IsBlack(self, ip):  # {{{
+        return ip in self.blackip_set
+# }}}
+
+    def IsVip(self, ip, email):  # {{{
+        return email in self.vip_user_set or ip in self.vip_user_set
+# }}}
+
+    def GetSuqPriority(self, numseq_this_user):  # {{{
+        """Same as myfunc.GetSuqPriority at self.epoch_now"""
+        if numseq_this_user > MAX_NUMSEQ_THIS_USER:
+            numseq_this_user = MAX_NUMSEQ_THIS_USER
+        prio = self.time_term - int(numseq_this_user**EXP_NUMSEQ_THIS_USER)
+        if prio < 0:
+            prio = 0
+        return prio
+# }}}
+
+    def Score(self, numseq, numseq_this_user, ip="", email=""):  # {{{
+        """Return (priority, numseq_this_user) of one job"""
+        if self.IsVip(ip, email):
+            return (PRIORITY_VIP, 1)
+        try:
+            priority = myfunc.FloatDivision(
+                    self.GetSuqPriority(numseq_this_user) - numseq,
+                    math.sqrt(numseq))
+        except ValueError:
+            priority = 0.0
+        if self.IsBlack(ip):
+            priority = priority/BLACKIP_DIVISOR
+        return (priority, numseq_this_user)
+# }}}
+
+    def ScoreMany(self, numseq_list, numseq_this_user_list, ip_list=None,
+                  email_list=None):  # {{{
+        """Return (priority_list, numseq_this_user_list) of many jobs, the
+        items of the input lists are for the same job at the same index
+        """
+        numjob = len(numseq_list)
+        if ip_list is None:
+            ip_list = [""]*numjob
+        if email_list is None:
+            email_list = [""]*numjob
+        if numpy is None or numjob == 0:
+            priority_list = []
+            new_numseq_this_user_list = []
+            for i in range(numjob):
+                (priority, numseq_this_user) = self.Score(
+                        numseq_list[i], numseq_this_user_list[i],
+                        ip_list[i], email_list[i])
+                priority_list.append(priority)
+                new_numseq_this_user_list.append(numseq_this_user)
+            return (priority_list, new_numseq_this_user_list)
+
+        numseq = numpy.asarray(numseq_list, dtype=numpy.float64)
+        numseq_this_user = numpy.asarray(numseq_this_user_list,
+                                         dtype=numpy.int64)
+        isBlack = numpy.fromiter((x in self.blackip_set for x in ip_list),
+                                 dtype=bool, count=numjob)
+        isVip = numpy.fromiter((self.IsVip(ip_list[i], email_list[i])
+                                for i in range(numjob)),
+                               dtype=bool, count=numjob)
+
+        capped = numpy.minimum(numseq_this_user, MAX_NUMSEQ_THIS_USER)
+        suq_prio = self.time_term - numpy.trunc(
+                capped.astype(numpy.float64)**EXP_NUMSEQ_THIS_USER)
+        suq_prio = numpy.maximum(suq_prio, 0.0)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            priority = (suq_prio - numseq)/numpy.sqrt(numseq)
+        priority = numpy.where(numseq > 0, priority, 0.0)
+        priority = numpy.where(isBlack, priority/BLACKIP_DIVISOR, priority)
+        priority = numpy.where(isVip, PRIORITY_VIP, priority)
+        numseq_this_user = numpy.where(isVip, 1, numseq_this_user)
+        return (priority.tolist(), numseq_this_user.tolist())
+# }}}
+# }}}
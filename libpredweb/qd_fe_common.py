@@ -12,18 +12,206 @@ Address: Science for Life Laboratory Stockholm, Box 1031, 17121 Solna, Sweden
 import os
 from . import myfunc
 from . import webserver_common as webcom
-import math
-import random
+from . import jobstate
+from . import jobqueue
+from . import priority
+from . import resultcache
 import time
 from datetime import datetime
 # from pytz import timezone
 import shutil
 from suds.client import Client
 import json
-import hashlib
+import zipfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from .timeit import timeit
 
 
+class WSDLClientPool(object):  # {{{
+    """A process wide pool of suds clients for the compute nodes
+
+    The WSDL of each node is fetched and parsed only once per process, further
+    clients of the same node are cloned from the first one and share the
+    parsed WSDL. A suds client is not thread-safe, so each client is leased
+    to one thread at a time by Acquire() and returned by Release().
+    """
+    def __init__(self, timeout=30):  # {{{
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.templateDict = {}  # {node: client with the parsed WSDL}
+        self.idleDict = {}  # {node: [idle clients]}
+# }}}
+
+    def Acquire(self, node):  # {{{
+        """Lease a client for node, raise an exception if the WSDL of the
+        node is not accessible"""
+        with self.lock:
+            idle_list = self.idleDict.get(node, [])
+            if len(idle_list) > 0:
+                return idle_list.pop()
+            template = self.templateDict.get(node, None)
+        if template is None:
+            wsdl_url = f"http://{node}/pred/api_submitseq/?wsdl"
+            template = Client(wsdl_url, cache=None, timeout=self.timeout)
+            with self.lock:
+                template = self.templateDict.setdefault(node, template)
+        return template.clone()
+# }}}
+
+    def Release(self, node, client):  # {{{
+        """Return a leased client to the pool"""
+        with self.lock:
+            if node in self.templateDict:
+                self.idleDict.setdefault(node, []).append(client)
+# }}}
+
+    def Invalidate(self, node):  # {{{
+        """Drop the clients of node, e.g. when the node is not accessible,
+        the WSDL will be fetched again at the next Acquire()"""
+        with self.lock:
+            self.templateDict.pop(node, None)
+            self.idleDict.pop(node, None)
+# }}}
+# }}}
+
+
+g_wsdl_client_pool = WSDLClientPool(timeout=30)
+g_result_cache_dict = {}  # {path_cache: ResultCache}
+g_result_cache_lock = threading.Lock()
+
+
+def IsWSDLMethodSupported(myclient, name_method):  # {{{
+    """Check whether the web service of myclient provides the method
+    name_method, e.g. checkjob_batch is not provided by older nodes
+    """
+    try:
+        getattr(myclient.service, name_method)
+        return True
+    except Exception:
+        return False
+# }}}
+
+
+def CheckJobBatch(myclient, remote_jobid_list, batch_size=500,
+                  isBatchSupported=None):  # {{{
+    """Query the status of many remote jobs on the same node
+
+    When the node provides checkjob_batch, the remote_jobids are sent in
+    chunks of batch_size, separated by comma, and the node returns a list of
+    [remote_jobid, status, result_url, errinfo]. Otherwise, or when a batch
+    call fails, checkjob is called for each remote_jobid.
+
+    Return a dictionary {remote_jobid: rtValue}, where rtValue is in the same
+    format as returned by checkjob, i.e. [[status, result_url, errinfo]]. The
+    rtValue is [] if the status could not be retrieved, so that the caller
+    does not query the node again.
+    """
+    dt = {}
+    if isBatchSupported is None:
+        isBatchSupported = IsWSDLMethodSupported(myclient, "checkjob_batch")
+    todo_list = []  # remote_jobids not answered by checkjob_batch
+    if isBatchSupported:
+        for i in range(0, len(remote_jobid_list), batch_size):
+            sub_list = remote_jobid_list[i:i+batch_size]
+            try:
+                rtValue = myclient.service.checkjob_batch(",".join(sub_list))
+            except Exception:
+                todo_list += sub_list
+                continue
+            for ss2 in rtValue:
+                if len(ss2) >= 4:
+                    dt[ss2[0]] = [[ss2[1], ss2[2], ss2[3]]]
+            for remote_jobid in sub_list:
+                if remote_jobid not in dt:
+                    todo_list.append(remote_jobid)
+    else:
+        todo_list = remote_jobid_list
+
+    for remote_jobid in todo_list:
+        try:
+            dt[remote_jobid] = myclient.service.checkjob(remote_jobid)
+        except Exception:
+            dt[remote_jobid] = []
+    return dt
+# }}}
+
+
+def ExtractResultZip(zipfile_result, mapList, outpath):  # {{{
+    """Extract parts of the result archive zipfile_result into outpath
+
+    mapList is a list of archive names, a name ending with "/" is a folder,
+    its content is extracted directly into outpath, otherwise it is a single
+    file extracted to outpath. The archive is checked by CRC before
+    extraction. The files are first extracted to a temporary folder next to
+    outpath, which is then renamed to outpath, replacing the existing one.
+
+    Return "" on success and an error message otherwise
+    """
+    tmp_outpath = "%s.tmp.%d.%d"%(outpath, os.getpid(), threading.get_ident())
+    try:
+        with zipfile.ZipFile(zipfile_result) as zipfp:
+            badfile = zipfp.testzip()
+            if badfile is not None:
+                return f"Bad CRC for {badfile} in {zipfile_result}"
+            cnt_extracted = 0
+            zinfoList = zipfp.infolist()
+            for arcname in mapList:
+                isFolder = arcname.endswith("/")
+                for zinfo in zinfoList:
+                    if isFolder and zinfo.filename.startswith(arcname):
+                        relpath = zinfo.filename[len(arcname):]
+                    elif not isFolder and zinfo.filename == arcname:
+                        relpath = os.path.basename(arcname)
+                    else:
+                        continue
+                    if relpath == "":
+                        continue
+                    target = os.path.normpath(os.path.join(tmp_outpath, relpath))
+                    if not target.startswith(tmp_outpath + os.sep):
+                        continue  # ignore names like ../../x
+                    if zinfo.is_dir():
+                        os.makedirs(target, exist_ok=True)
+                        continue
+                    if not isFolder and os.path.exists(target):
+                        continue  # do not overwrite files from the folder
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    with zipfp.open(zinfo) as fpin, open(target, "wb") as fpout:
+                        shutil.copyfileobj(fpin, fpout, 1024*1024)
+                    mode = (zinfo.external_attr >> 16) & 0o777
+                    if mode:
+                        os.chmod(target, mode)
+                    cnt_extracted += 1
+            if cnt_extracted == 0:
+                return f"No result found in {zipfile_result}"
+
+        if os.path.islink(outpath):
+            os.unlink(outpath)
+        elif os.path.exists(outpath):
+            shutil.rmtree(outpath)
+        os.rename(tmp_outpath, outpath)
+        return ""
+    except (zipfile.BadZipFile, OSError) as e:
+        return f"Failed to extract {zipfile_result} with errmsg {e}"
+    finally:
+        if os.path.exists(tmp_outpath):
+            shutil.rmtree(tmp_outpath, ignore_errors=True)
+# }}}
+
+def GetResultCache(g_params):  # {{{
+    """Return the ResultCache of g_params['path_cache'], one per process"""
+    path_cache = g_params['path_cache']
+    with g_result_cache_lock:
+        if path_cache not in g_result_cache_dict:
+            link_mode = "reflink"
+            if 'CACHE_LINK_MODE' in g_params and g_params['CACHE_LINK_MODE']:
+                link_mode = g_params['CACHE_LINK_MODE']
+            g_result_cache_dict[path_cache] = resultcache.ResultCache(
+                path_cache, link_mode=link_mode)
+        return g_result_cache_dict[path_cache]
+# }}}
+
+
 @timeit
 def RunStatistics(g_params):  # {{{
     """Server usage analysis"""
@@ -85,6 +273,8 @@ def CreateRunJoblog(loop, isOldRstdirDeleted, g_params):#{{{
     submitjoblogfile = f"{path_log}/submitted_seq.log"
     runjoblogfile = f"{path_log}/runjob_log.log"
     finishedjoblogfile = f"{path_log}/finished_job.log"
+    jobstate_db = f"{path_log}/jobstate.sqlite3"
+    jobqueue_db = f"{path_log}/jobqueue.sqlite3"
 
     # Read entries from submitjoblogfile, checking in the result folder and
     # generate two logfiles:
@@ -99,19 +289,29 @@ def CreateRunJoblog(loop, isOldRstdirDeleted, g_params):#{{{
     if os.path.exists(finishedjoblogfile):
         finished_job_dict = myfunc.ReadFinishedJobLog(finishedjoblogfile)
 
+    # the job state index keeps the status of each job from the last loop, so
+    # that only jobs with changed job folders are probed again
+    jsidx = jobstate.JobStateIndex(jobstate_db)
+    state_dict = jsidx.LoadAll()
+    updated_state_list = []
+
     # these two list try to update the finished list and submitted list so that
     # deleted jobs will not be included, there is a separate list started with
     # all_xxx which keeps also the historical jobs
     new_finished_list = []  # Finished or Failed
     new_submitted_list = []
+    cnt_dropped_line = 0  # number of lines removed from submitjoblogfile
 
     new_runjob_list = []    # Running
     new_waitjob_list = []    # Queued
+    counter_job_list = []  # [(jobid, ip, category, submit_date_str)]
     lines = hdl.readlines()
     while lines is not None:
         for line in lines:
             strs = line.split("\t")
             if len(strs) < 8:
+                if line.strip() != "":
+                    cnt_dropped_line += 1
                 continue
             submit_date_str = strs[0]
             jobid = strs[1]
@@ -136,36 +336,85 @@ def CreateRunJoblog(loop, isOldRstdirDeleted, g_params):#{{{
 
             if isRstFolderExist:
                 new_submitted_list.append([jobid, line])
+            else:
+                cnt_dropped_line += 1
 
+            state = state_dict.get(jobid, None)
             if jobid in finished_job_dict:
+                category = finished_job_dict[jobid][0].lower()
+                if category in ["finished", "failed"]:
+                    counter_job_list.append((jobid, ip, category, submit_date_str))
                 if isRstFolderExist:
                     li = [jobid] + finished_job_dict[jobid]
                     new_finished_list.append(li)
+                    if state is None or state['status'] != li[1]:
+                        updated_state_list.append({
+                            'jobid': jobid, 'status': li[1], 'signature': "",
+                            'jobname': li[2], 'ip': li[3], 'email': li[4],
+                            'numseq': li[5], 'method_submission': li[6],
+                            'submit_date': li[7], 'start_date': li[8],
+                            'finish_date': li[9], 'app_type': li[10]})
                 continue
 
-            status = webcom.get_job_status(jobid, numseq, path_result)
-            if 'DEBUG_JOB_STATUS' in g_params and g_params['DEBUG_JOB_STATUS']:
-                webcom.loginfo("status(%s): %s"%(jobid, status), gen_logfile)
-
-            starttagfile = "%s/%s"%(rstdir, "runjob.start")
-            finishtagfile = "%s/%s"%(rstdir, "runjob.finish")
-            if os.path.exists(starttagfile):
-                start_date_str = myfunc.ReadFile(starttagfile).strip().rstrip("CEST")
-            if os.path.exists(finishtagfile):
-                finish_date_str = myfunc.ReadFile(finishtagfile).strip().rstrip("CEST")
+            signature = jobstate.GetJobDirSignature(rstdir)
+            isJobDirExist = (signature != "")
+            if (state is not None and signature != ""
+                    and state['signature'] == signature):
+                # nothing has changed in the job folder since the last loop
+                status = state['status']
+                start_date_str = state['start_date']
+                finish_date_str = state['finish_date']
+                app_type = state['app_type']
+            else:
+                status = webcom.get_job_status(jobid, numseq, path_result)
+                if 'DEBUG_JOB_STATUS' in g_params and g_params['DEBUG_JOB_STATUS']:
+                    webcom.loginfo("status(%s): %s"%(jobid, status), gen_logfile)
+
+                starttagfile = "%s/%s"%(rstdir, "runjob.start")
+                finishtagfile = "%s/%s"%(rstdir, "runjob.finish")
+                isStartTagExist = os.path.exists(starttagfile)
+                isFinishTagExist = os.path.exists(finishtagfile)
+                if isStartTagExist:
+                    start_date_str = myfunc.ReadFile(starttagfile).strip().rstrip("CEST")
+                if isFinishTagExist:
+                    finish_date_str = myfunc.ReadFile(finishtagfile).strip().rstrip("CEST")
+                jobinfofile = os.path.join(rstdir, "jobinfo")
+                app_type = "None"
+                if name_server.lower() == "scampi2":
+                    app_type = webcom.GetScampiAppType(jobinfofile)
+
+                # the tag file may be caught after it is created but before
+                # the date is written, do not trust the signature then
+                if ((isStartTagExist and start_date_str == "")
+                        or (isFinishTagExist and finish_date_str == "")):
+                    signature = ""
+                updated_state_list.append({
+                    'jobid': jobid, 'status': status, 'signature': signature,
+                    'jobname': jobname, 'ip': ip, 'email': email,
+                    'numseq': numseq, 'method_submission': method_submission,
+                    'submit_date': submit_date_str,
+                    'start_date': start_date_str,
+                    'finish_date': finish_date_str, 'app_type': app_type})
 
             li = [jobid, status, jobname, ip, email, numseq_str,
                     method_submission, submit_date_str, start_date_str,
                     finish_date_str]
-            jobinfofile = os.path.join(rstdir, "jobinfo")
-            app_type = "None"
-            if name_server.lower() == "scampi2":
-                app_type = webcom.GetScampiAppType(jobinfofile)
             li.append(app_type) # 11th item
 
             if status in ["Finished", "Failed"]:
                 new_finished_list.append(li)
 
+            # the same categories as in webcom.GetJobCounter
+            if not isJobDirExist:
+                category = "nojobfolder"
+            elif status in ["Finished", "Failed"]:
+                category = status.lower()
+            elif start_date_str != "":
+                category = "running"
+            else:
+                category = "queued"
+            counter_job_list.append((jobid, ip, category, submit_date_str))
+
             isValidSubmitDate = True
             try:
                 submit_date = webcom.datetime_str_to_time(submit_date_str)
@@ -191,14 +440,29 @@ def CreateRunJoblog(loop, isOldRstdirDeleted, g_params):#{{{
         lines = hdl.readlines()
     hdl.close()
 
-# rewrite logs of submitted jobs
-    li_str = []
-    for li in new_submitted_list:
-        li_str.append(li[1])
-    if len(li_str)>0:
-        myfunc.WriteFile("\n".join(li_str)+"\n", submitjoblogfile, "w", True)
+# update the job state index
+    jsidx.UpdateJobs(updated_state_list)
+    submitted_jobid_set = set([li[0] for li in new_submitted_list])
+    jsidx.DeleteJobs([x for x in state_dict if x not in submitted_jobid_set])
+
+# update the job counters shown on the web pages
+    if 'MAX_DAYS_TO_SHOW' in g_params:
+        maxdaystoshow = g_params['MAX_DAYS_TO_SHOW']
     else:
-        myfunc.WriteFile("", submitjoblogfile, "w", True)
+        maxdaystoshow = jobstate.DEFAULT_MAX_DAYS_TO_SHOW
+    jsidx.UpdateJobCounters(webcom.GetJobCounterDict(counter_job_list,
+        maxdaystoshow), maxdaystoshow)
+
+# rewrite logs of submitted jobs, only when some of the lines are removed, so
+# that jobs appended by the web-server in the meantime are not lost
+    if cnt_dropped_line > 0:
+        li_str = []
+        for li in new_submitted_list:
+            li_str.append(li[1])
+        if len(li_str)>0:
+            myfunc.WriteFile("\n".join(li_str)+"\n", submitjoblogfile, "w", True)
+        else:
+            myfunc.WriteFile("", submitjoblogfile, "w", True)
 
 # rewrite logs of finished jobs
     li_str = []
@@ -206,9 +470,9 @@ def CreateRunJoblog(loop, isOldRstdirDeleted, g_params):#{{{
         li = [str(x) for x in li]
         li_str.append("\t".join(li))
     if len(li_str) > 0:
-        myfunc.WriteFile("\n".join(li_str)+"\n", finishedjoblogfile, "w", True)
+        jsidx.WriteFileIfChanged("\n".join(li_str)+"\n", finishedjoblogfile)
     else:
-        myfunc.WriteFile("", finishedjoblogfile, "w", True)
+        jsidx.WriteFileIfChanged("", finishedjoblogfile)
 # rewrite logs of finished jobs for each IP
     new_finished_dict = {}
     for li in new_finished_list:
@@ -224,32 +488,38 @@ def CreateRunJoblog(loop, isOldRstdirDeleted, g_params):#{{{
             li = [str(x) for x in li]
             li_str.append("\t".join(li))
         if len(li_str)>0:
-            myfunc.WriteFile("\n".join(li_str)+"\n", divide_finishedjoblogfile, "w", True)
+            jsidx.WriteFileIfChanged("\n".join(li_str)+"\n", divide_finishedjoblogfile)
         else:
-            myfunc.WriteFile("", divide_finishedjoblogfile, "w", True)
+            jsidx.WriteFileIfChanged("", divide_finishedjoblogfile)
 
 # update allfinished jobs
     allfinishedjoblogfile = "%s/all_finished_job.log"%(path_log)
-    allfinished_jobid_set = set(myfunc.ReadIDList2(allfinishedjoblogfile, col=0, delim="\t"))
+    new_jobid_set = set(jsidx.FilterNewJobID(
+        "all_finished_job", allfinishedjoblogfile,
+        [li[0] for li in new_finished_list], col=0, delim="\t"))
     li_str = []
     for li in new_finished_list:
         li = [str(x) for x in li]
         jobid = li[0]
-        if not jobid in allfinished_jobid_set:
+        if jobid in new_jobid_set:
             li_str.append("\t".join(li))
     if len(li_str)>0:
         myfunc.WriteFile("\n".join(li_str)+"\n", allfinishedjoblogfile, "a", True)
+        jsidx.MarkLogged("all_finished_job", list(new_jobid_set))
 
 # update all_submitted jobs
     allsubmitjoblogfile = "%s/all_submitted_seq.log"%(path_log)
-    allsubmitted_jobid_set = set(myfunc.ReadIDList2(allsubmitjoblogfile, col=1, delim="\t"))
+    new_jobid_set = set(jsidx.FilterNewJobID(
+        "all_submitted_seq", allsubmitjoblogfile,
+        [li[0] for li in new_submitted_list], col=1, delim="\t"))
     li_str = []
     for li in new_submitted_list:
         jobid = li[0]
-        if not jobid in allsubmitted_jobid_set:
+        if jobid in new_jobid_set:
             li_str.append(li[1])
     if len(li_str)>0:
         myfunc.WriteFile("\n".join(li_str)+"\n", allsubmitjoblogfile, "a", True)
+        jsidx.MarkLogged("all_submitted_seq", list(new_jobid_set))
 
 # write logs of running and queuing jobs
 # the queuing jobs are sorted in descending order by the suq priority
@@ -259,6 +529,18 @@ def CreateRunJoblog(loop, isOldRstdirDeleted, g_params):#{{{
 
 # now append numseq_this_user and priority score to new_waitjob_list and
 # new_runjob_list
+# the priorities are kept in the persistent job queue, all computed at the
+# pinned time_base of the queue, and recomputed only for jobs of which the
+# inputs to the priority (prio_key) have changed, e.g. when the job mix of the
+# user changed
+    jobq = jobqueue.JobQueue(jobqueue_db)
+    queue_dict = jobq.LoadAll()
+    scorer = priority.PriorityScorer(epoch_now=jobq.GetTimeBase(),
+                                     blackiplist=g_params['blackiplist'],
+                                     vip_user_list=g_params['vip_user_list'])
+    prio_key_dict = {}
+    toscore_list = []
+    updated_queue_list = []
 
     for joblist in [new_waitjob_list, new_runjob_list]:
         for li in joblist:
@@ -284,7 +566,7 @@ def CreateRunJoblog(loop, isOldRstdirDeleted, g_params):#{{{
                 finished_seqs_idset = set(finished_seqs_idlist)
                 finished_info_list = []
                 queryfile = "%s/query.fa"%(rstdir)
-                (seqIDList, seqAnnoList, seqList) = myfunc.ReadFasta(queryfile)
+                hdl_queryfile = myfunc.FastaFile(queryfile)
                 try:
                     dirlist = os.listdir(outpath_result)
                 except Exception as e:
@@ -301,23 +583,25 @@ def CreateRunJoblog(loop, isOldRstdirDeleted, g_params):#{{{
                         runtime = webcom.ReadRuntimeFromFile(timefile, default_runtime=0.0)
                         # get origIndex and then read description the description list
                         try:
-                            description = seqAnnoList[origIndex].replace('\t', ' ')
-                        except:
+                            (seqid, seqanno, seq) = hdl_queryfile[origIndex]
+                            description = seqanno.replace('\t', ' ')
+                        except IndexError:
                             description = "seq_%d"%(origIndex)
-                        try:
-                            seq = seqList[origIndex]
-                        except:
                             seq = ""
                         info_finish = webcom.GetInfoFinish(name_server, outpath_this_seq,
                                 origIndex, len(seq), description,
                                 source_result="newrun", runtime=runtime)
                         finished_info_list.append("\t".join(info_finish))
+                hdl_queryfile.close()
                 if len(finished_info_list)>0:
                     myfunc.WriteFile("\n".join(finished_info_list)+"\n", finished_seq_file, "a", True)
+                progressDict = webcom.ReadJobProgress(rstdir)
                 if len(finished_idx_set) > 0:
                     myfunc.WriteFile("\n".join(list(finished_idx_set))+"\n", finished_idx_file, "w", True)
                 else:
                     myfunc.WriteFile("", finished_idx_file, "w", True)
+                webcom.UpdateJobProgress(rstdir, progressDict,
+                        setDict={'finished': len(finished_idx_set)})
             #}}}
 
             try:
@@ -330,38 +614,80 @@ def CreateRunJoblog(loop, isOldRstdirDeleted, g_params):#{{{
             except KeyError:
                 numseq_this_user = numseq
                 pass
-            # note that the priority is deducted by numseq so that for jobs
-            # from the same user, jobs with fewer sequences are placed with
-            # higher priority
-            priority = myfunc.FloatDivision( myfunc.GetSuqPriority(numseq_this_user) - numseq, math.sqrt(numseq))
-
-            if ip in g_params['blackiplist']:
-                priority = priority/1000.0
-
-            if email in g_params['vip_user_list'] or ip in g_params['vip_user_list']:
-                numseq_this_user = 1
-                priority = 999999999.0
-                webcom.loginfo("email/ip %s in vip_user_list"%(email), gen_logfile)
-
-            li.append(numseq_this_user) # 12th field
-            li.append(priority)         # 13th field
-
-    # sort the new_waitjob_list in descending order by priority
-    new_waitjob_list = sorted(new_waitjob_list, key=lambda x: x[12], reverse=True)
-    new_runjob_list = sorted(new_runjob_list, key=lambda x: x[12], reverse=True)
+            isBlack = scorer.IsBlack(ip)
+            isVip = scorer.IsVip(ip, email)
+            prio_key = f"{numseq}:{numseq_this_user}:{int(isBlack)}:{int(isVip)}"
 
-    # write to runjoblogfile
-    li_str = []
-    for joblist in [new_waitjob_list, new_runjob_list]:
-        for li in joblist:
-            li2 = li[:10]+[str(li[10]), str(li[11])]
-            li_str.append("\t".join(li2))
-#     print "write to", runjoblogfile
-#     print "\n".join(li_str)
+            if jobid in queue_dict and queue_dict[jobid][3] == prio_key:
+                li.append(queue_dict[jobid][2]) # 12th field, numseq_this_user
+                li.append(queue_dict[jobid][1]) # 13th field, priority
+            else:
+                if isVip:
+                    webcom.loginfo("email/ip %s in vip_user_list"%(email), gen_logfile)
+                toscore_list.append((li, numseq, numseq_this_user, ip, email))
+            prio_key_dict[jobid] = prio_key
+
+    # score the jobs with changed prio_key in one pass
+    # note that the priority is deducted by numseq so that for jobs
+    # from the same user, jobs with fewer sequences are placed with
+    # higher priority
+    (priority_list, numseq_this_user_list) = scorer.ScoreMany(
+            [x[1] for x in toscore_list], [x[2] for x in toscore_list],
+            [x[3] for x in toscore_list], [x[4] for x in toscore_list])
+    for i in range(len(toscore_list)):
+        li = toscore_list[i][0]
+        li.append(numseq_this_user_list[i]) # 12th field
+        li.append(priority_list[i])         # 13th field
+
+    for li in new_waitjob_list + new_runjob_list:
+        jobid = li[0]
+        status = li[1]
+        (numseq_this_user, prio) = (li[11], li[12])
+        prio_key = prio_key_dict[jobid]
+        record = "\t".join(li[:10]+[str(li[10]), str(li[11])])
+        if (jobid not in queue_dict
+                or queue_dict[jobid] != (status, prio,
+                                         numseq_this_user, prio_key,
+                                         record)):
+            updated_queue_list.append((jobid, status, prio,
+                                       numseq_this_user, prio_key, record))
+
+    # update the job queue with the changed jobs and remove jobs that are
+    # neither waiting nor running anymore
+    current_jobid_set = set([li[0] for li in new_waitjob_list + new_runjob_list])
+    jobq.InsertMany(updated_queue_list)
+    jobq.DeleteJobs([x for x in queue_dict if x not in current_jobid_set])
+
+    # write to runjoblogfile, in the order of the job queue, i.e. the waiting
+    # jobs and then the running jobs, in descending order by priority
+    if not jobq.failure:
+        li_str = jobq.GetRecordList()
+    else:
+        new_waitjob_list = sorted(new_waitjob_list, key=lambda x: x[12], reverse=True)
+        new_runjob_list = sorted(new_runjob_list, key=lambda x: x[12], reverse=True)
+        li_str = []
+        for joblist in [new_waitjob_list, new_runjob_list]:
+            for li in joblist:
+                li2 = li[:10]+[str(li[10]), str(li[11])]
+                li_str.append("\t".join(li2))
+    jobq.close()
     if len(li_str) > 0:
-        myfunc.WriteFile("\n".join(li_str)+"\n", runjoblogfile, "w", True)
+        jsidx.WriteFileIfChanged("\n".join(li_str)+"\n", runjoblogfile)
+    else:
+        jsidx.WriteFileIfChanged("", runjoblogfile)
+    jsidx.close()
+
+# refresh the snapshot of the server status shown by get_serverstatus, now and
+# then, since building it reads the whole job history
+    if 'SERVERSTATUS_UPDATE_INTERVAL' in g_params:
+        interval = g_params['SERVERSTATUS_UPDATE_INTERVAL']
     else:
-        myfunc.WriteFile("", runjoblogfile, "w", True)
+        interval = webcom.SERVERSTATUS_UPDATE_INTERVAL
+    try:
+        if webcom.UpdateServerStatusSnapshot(path_static, g_params, interval):
+            webcom.loginfo("Server status snapshot updated", gen_logfile)
+    except Exception as e:
+        webcom.loginfo(f"Failed to update the server status snapshot with errmsg={e}", gen_logfile)
 
 # }}}
 
@@ -385,7 +711,6 @@ def SubmitJob(jobid, cntSubmitJobDict, numseq_this_user, g_params):  # {{{
     webcom.loginfo("SubmitJob for %s, numseq_this_user=%d"%(jobid, numseq_this_user), gen_logfile)
 
     path_static = g_params['path_static']
-    path_cache = g_params['path_cache']
 
     path_result = os.path.join(path_static, 'result')
     path_log = os.path.join(path_static, 'log')
@@ -422,6 +747,14 @@ def SubmitJob(jobid, cntSubmitJobDict, numseq_this_user, g_params):  # {{{
     else:
         isForceRun = False
 
+    # with USE_INDEXED_QUERY, the query sequences are read from query.fa by
+    # its offset index instead of from one file per sequence in splitaa, the
+    # option is applied when the job is initialized
+    if 'USE_INDEXED_QUERY' in g_params and g_params['USE_INDEXED_QUERY']:
+        isUseIndexedQuery = True
+    else:
+        isUseIndexedQuery = False
+
     finished_idx_list = []
     failed_idx_list = []    # [origIndex]
     if os.path.exists(finished_idx_file):
@@ -443,7 +776,8 @@ def SubmitJob(jobid, cntSubmitJobDict, numseq_this_user, g_params):  # {{{
 
     # the first time when the this jobid is processed, do the following
     # 1. generate a file with sorted seqindex
-    # 2. generate splitted sequence files named by the original seqindex
+    # 2. generate splitted sequence files named by the original seqindex, or
+    #    the offset index of query.fa with USE_INDEXED_QUERY
     if not os.path.exists(qdinittagfile): #initialization#{{{
         if not os.path.exists(tmpdir):
             os.mkdir(tmpdir)
@@ -474,75 +808,73 @@ def SubmitJob(jobid, cntSubmitJobDict, numseq_this_user, g_params):  # {{{
                 except:
                     lastprocessed_idx = -1
 
-            cnt_processed_cache = 0
-            for i in range(lastprocessed_idx+1, len(seqIDList)):
-                if i in finished_idx_set:
-                    continue
-                outpath_this_seq = "%s/%s"%(outpath_result, "seq_%d"%i)
-                subfoldername_this_seq = "seq_%d"%(i)
-                md5_key = hashlib.md5(seqList[i].encode('utf-8')).hexdigest()
-                subfoldername = md5_key[:2]
-                cachedir = "%s/%s/%s"%(path_cache, subfoldername, md5_key)
-                zipfile_cache = cachedir + ".zip"
-
-                if os.path.exists(cachedir) or os.path.exists(zipfile_cache):
-                    if os.path.exists(cachedir):
-                        try:
-                            shutil.copytree(cachedir, outpath_this_seq)
-                        except Exception as e:
-                            msg = "Failed to copytree  %s -> %s"%(cachedir, outpath_this_seq)
-                            webcom.loginfo("%s with errmsg=%s"%(msg, str(e)), runjob_errfile)
-                    elif os.path.exists(zipfile_cache):
-                        if os.path.getsize(zipfile_cache) == 0:
-                            os.remove(zipfile_cache)  # remove empty archived result zip file
-                        else:
-                            cmd = ["unzip", zipfile_cache, "-d", outpath_result]
-                            webcom.RunCmd(cmd, runjob_logfile, runjob_errfile)
-                            if os.path.exists(outpath_this_seq):
-                                shutil.rmtree(outpath_this_seq)
-                            if os.path.exists(os.path.join(outpath_result, md5_key)):
-                                shutil.move(os.path.join(outpath_result, md5_key), outpath_this_seq)
-
-                    fafile_this_seq = '%s/seq.fa'%(outpath_this_seq)
-                    if os.path.exists(outpath_this_seq) and webcom.IsCheckPredictionPassed(outpath_this_seq, name_server):
-                        myfunc.WriteFile('>%s\n%s\n'%(seqAnnoList[i], seqList[i]), fafile_this_seq, 'w', True)
-                        if not os.path.exists(starttagfile): #write start tagfile
-                            webcom.WriteDateTimeTagFile(starttagfile, runjob_logfile, runjob_errfile)
+            cache = GetResultCache(g_params)
+            cache_para = None
+            if name_server.lower() == "prodres" and query_para != {}:
+                cache_para = query_para
+            # look up the cache for all sequences at once and process all hits
+            # in this loop
+            todo_idx_list = [i for i in range(lastprocessed_idx+1, len(seqIDList))
+                             if str(i) not in finished_idx_set]
+            hitDict = cache.LookupMany([seqList[i] for i in todo_idx_list], cache_para)
+            if 'DEBUG' in g_params and g_params['DEBUG']:
+                webcom.loginfo(f"jobid = {jobid}, {len(hitDict)} of {len(todo_idx_list)} sequences found in cache", gen_logfile)
 
-                        info_finish = webcom.GetInfoFinish(name_server, outpath_this_seq,
-                                i, len(seqList[i]), seqAnnoList[i], source_result="cached", runtime=0.0)
-                        myfunc.WriteFile("\t".join(info_finish)+"\n",
-                                finished_seq_file, "a", isFlush=True)
-                        myfunc.WriteFile("%d\n"%(i), finished_idx_file, "a", True)
+            finished_info_list = []
+            finished_idx_list_cache = []
+            for j in sorted(hitDict.keys()):
+                i = todo_idx_list[j]
+                (md5_key, source) = hitDict[j]
+                outpath_this_seq = "%s/%s"%(outpath_result, "seq_%d"%i)
+                if not cache.MaterialiseFrom(md5_key, source, outpath_this_seq):
+                    continue
+                fafile_this_seq = '%s/seq.fa'%(outpath_this_seq)
+                if webcom.IsCheckPredictionPassed(outpath_this_seq, name_server):
+                    # seq.fa may be hard linked to the cache, replace
+                    # instead of overwriting it
+                    if os.path.exists(fafile_this_seq):
+                        os.remove(fafile_this_seq)
+                    myfunc.WriteFile('>%s\n%s\n'%(seqAnnoList[i], seqList[i]), fafile_this_seq, 'w', True)
+                    info_finish = webcom.GetInfoFinish(name_server, outpath_this_seq,
+                            i, len(seqList[i]), seqAnnoList[i], source_result="cached", runtime=0.0)
+                    finished_info_list.append("\t".join(info_finish))
+                    finished_idx_list_cache.append(str(i))
+                if 'DEBUG' in g_params and g_params['DEBUG']:
+                    webcom.loginfo("Get result from cache for seq_%d"%(i), gen_logfile)
 
-                    if 'DEBUG' in g_params and g_params['DEBUG']:
-                        webcom.loginfo("Get result from cache for seq_%d"%(i), gen_logfile)
-                    if cnt_processed_cache+1 >= g_params['MAX_CACHE_PROCESS']:
-                        myfunc.WriteFile(str(i), lastprocessed_cache_idx_file, "w", True)
-                        return 0
-                    cnt_processed_cache += 1
+            if len(finished_idx_list_cache) > 0:
+                if not os.path.exists(starttagfile): #write start tagfile
+                    webcom.WriteDateTimeTagFile(starttagfile, runjob_logfile, runjob_errfile)
+                myfunc.WriteFile("\n".join(finished_info_list)+"\n",
+                        finished_seq_file, "a", isFlush=True)
+                progressDict = webcom.ReadJobProgress(rstdir)
+                myfunc.WriteFile("\n".join(finished_idx_list_cache)+"\n",
+                        finished_idx_file, "a", True)
+                webcom.UpdateJobProgress(rstdir, progressDict,
+                        addDict={'finished': len(finished_idx_list_cache)})
+                processed_idx_set |= set(finished_idx_list_cache)
 
             webcom.WriteDateTimeTagFile(cache_process_finish_tagfile, runjob_logfile, runjob_errfile)
 
         # Regenerate toRunDict
         toRunDict = {}
         for i in range(len(seqIDList)):
-            if not i in processed_idx_set:
+            if not str(i) in processed_idx_set:
                 toRunDict[i] = [seqList[i], 0, seqAnnoList[i].replace('\t', ' ')]
 
         if name_server == "topcons2":
             webcom.ResetToRunDictByScampiSingle(toRunDict, g_params['script_scampi'], tmpdir, runjob_logfile, runjob_errfile)
         sortedlist = sorted(list(toRunDict.items()), key=lambda x:x[1][1], reverse=True)
 
-        # Write splitted fasta file and write a torunlist.txt
-        if not os.path.exists(split_seq_dir):
-            os.mkdir(split_seq_dir)
-
+        # write a torunlist.txt
         torun_index_str_list = [str(x[0]) for x in sortedlist]
+        progressDict = webcom.ReadJobProgress(rstdir)
         if len(torun_index_str_list)>0:
             myfunc.WriteFile("\n".join(torun_index_str_list)+"\n", torun_idx_file, "w", True)
         else:
             myfunc.WriteFile("", torun_idx_file, "w", True)
+        webcom.UpdateJobProgress(rstdir, progressDict,
+                setDict={'torun': len(torun_index_str_list)})
 
         # write cnttry file for each jobs to run
         cntTryDict = {}
@@ -550,13 +882,25 @@ def SubmitJob(jobid, cntSubmitJobDict, numseq_this_user, g_params):  # {{{
             cntTryDict[int(idx)] = 0
         json.dump(cntTryDict, open(cnttry_idx_file, "w"))
 
-        for item in sortedlist:
-            origIndex = item[0]
-            seq = item[1][0]
-            description = item[1][2]
-            seqfile_this_seq = "%s/%s"%(split_seq_dir, "query_%d.fa"%(origIndex))
-            seqcontent = ">%s\n%s\n"%(description, seq)
-            myfunc.WriteFile(seqcontent, seqfile_this_seq, "w", True)
+        if isUseIndexedQuery:
+            # build and save the offset index of query.fa once for the job,
+            # fall back to the split sequence files if it can not be used
+            with myfunc.FastaFile(fafile) as hdl_queryfile:
+                if len(hdl_queryfile) != len(seqIDList):
+                    webcom.loginfo("Failed to index %s, write the split sequence files instead"%(fafile), gen_logfile)
+                    isUseIndexedQuery = False
+
+        if not isUseIndexedQuery:
+            # Write splitted fasta file
+            if not os.path.exists(split_seq_dir):
+                os.mkdir(split_seq_dir)
+            for item in sortedlist:
+                origIndex = item[0]
+                seq = item[1][0]
+                description = item[1][2]
+                seqfile_this_seq = "%s/%s"%(split_seq_dir, "query_%d.fa"%(origIndex))
+                seqcontent = ">%s\n%s\n"%(description, seq)
+                myfunc.WriteFile(seqcontent, seqfile_this_seq, "w", True)
         # qdinit file is written at the end of initialization, to make sure
         # that initialization is either not started or completed
         webcom.WriteDateTimeTagFile(qdinittagfile, runjob_logfile, runjob_errfile)
@@ -564,6 +908,8 @@ def SubmitJob(jobid, cntSubmitJobDict, numseq_this_user, g_params):  # {{{
 
 
     # 3. try to submit the job 
+    # the free slots of all nodes are filled in parallel, one thread per node,
+    # and the threads take sequences from toRunIndexList in order
     toRunIndexList = [] # index in str
     processedIndexSet = set([]) #seq index set that are already processed
     submitted_loginfo_list = []
@@ -572,59 +918,59 @@ def SubmitJob(jobid, cntSubmitJobDict, numseq_this_user, g_params):  # {{{
         # unique the list but keep the order
         toRunIndexList = myfunc.uniquelist(toRunIndexList)
     if len(toRunIndexList) > 0:
-        iToRun = 0
         numToRun = len(toRunIndexList)
-        iNode = -1
-        for node in cntSubmitJobDict:
-            iNode += 1
-            if "DEBUG" in g_params and g_params['DEBUG']:
-                webcom.loginfo(f"Trying to submit job to the node {iNode}: {node}", gen_logfile)
-                webcom.loginfo(f"cntSubmitJobDict={cntSubmitJobDict}", gen_logfile)
-            if cntSubmitJobDict[node][3] == "OFF":
-                webcom.loginfo(f"node {node} is offline, try again in the next loop", gen_logfile)
-                continue
-            if iToRun >= numToRun:
+        lock = threading.Lock()
+        iToRunList = [0]  # shared position in toRunIndexList
+        # the split sequence files are written at initialization unless
+        # query.fa was indexed with USE_INDEXED_QUERY, follow that choice for
+        # the whole job even when USE_INDEXED_QUERY has changed since
+        isUseIndexedQuery = not os.path.exists(split_seq_dir)
+        # used when the split sequence files are not written or one of them
+        # is missing, shared by the threads
+        hdl_queryfile = myfunc.FastaFile("%s/query.fa"%(rstdir))
+
+        def GetNextToRun():  # {{{
+            """Return the next origIndex to run, None if all are taken"""
+            with lock:
+                while iToRunList[0] < numToRun:
+                    origIndex = int(toRunIndexList[iToRunList[0]])
+                    iToRunList[0] += 1
+                    # ignore already existing query seq, this is an ugly
+                    # solution, the generation of torunindexlist has a bug
+                    outpath_this_seq = "%s/%s"%(outpath_result, "seq_%d"%origIndex)
+                    if not os.path.exists(outpath_this_seq):
+                        return origIndex
                 if "DEBUG" in g_params and g_params['DEBUG']:
-                    webcom.loginfo(f"iToRun({iToRun}) >= numToRun({numToRun}). Stop SubmitJob for jobid={jobid}", gen_logfile)
-                break
-            wsdl_url = "http://%s/pred/api_submitseq/?wsdl"%(node)
-            try:
-                myclient = Client(wsdl_url, cache=None, timeout=30)
-            except Exception as e:
-                webcom.loginfo(f"Failed to access {wsdl_url}, detailed error: {e}", gen_logfile)
-                cntSubmitJobDict[node][3] = "OFF"
-                continue
+                    webcom.loginfo(f"iToRun({iToRunList[0]}) >= numToRun({numToRun}). Stop SubmitJob for jobid={jobid}", gen_logfile)
+                return None
+        # }}}
 
-            if "DEBUG" in g_params and g_params['DEBUG']:
-                webcom.loginfo(f"iToRun={iToRun}, numToRun={numToRun}", gen_logfile)
+        def SubmitToNode(node, myclient):  # {{{
+            """Submit sequences to node until its slots are full"""
             [cnt, maxnum, queue_method, node_status] = cntSubmitJobDict[node]
+            query_para_this_node = dict(query_para)
             cnttry = 0
-            while cnt < maxnum and iToRun < numToRun:
-                origIndex = int(toRunIndexList[iToRun])
+            origIndex = None
+            while cnt < maxnum:
+                if origIndex is None:
+                    origIndex = GetNextToRun()
+                    if origIndex is None:
+                        break
                 seqfile_this_seq = "%s/%s"%(split_seq_dir, "query_%d.fa"%(origIndex))
-                # ignore already existing query seq, this is an ugly solution,
-                # the generation of torunindexlist has a bug
-                outpath_this_seq = "%s/%s"%(outpath_result, "seq_%d"%origIndex)
-                if os.path.exists(outpath_this_seq):
-                    iToRun += 1
-                    continue
 
                 if 'DEBUG' in g_params and g_params['DEBUG']:
                     webcom.loginfo("DEBUG: cnt (%d) < maxnum (%d) "\
-                            "and iToRun(%d) < numToRun(%d)"%(cnt, maxnum, iToRun, numToRun), gen_logfile)
+                            "for origIndex %d on node %s"%(cnt, maxnum, origIndex, node), gen_logfile)
                 fastaseq = ""
                 seqid = ""
                 seqanno = ""
                 seq = ""
-                if not os.path.exists(seqfile_this_seq):
-                    all_seqfile = "%s/query.fa"%(rstdir)
+                if isUseIndexedQuery or not os.path.exists(seqfile_this_seq):
                     try:
-                        (allseqidlist, allannolist, allseqlist) = myfunc.ReadFasta(all_seqfile)
-                        seqid = allseqidlist[origIndex]
-                        seqanno = allannolist[origIndex]
-                        seq = allseqlist[origIndex]
+                        (seqid, seqanno, seq) = hdl_queryfile[origIndex]
+                        seqanno = seqanno.replace('\t', ' ')
                         fastaseq = ">%s\n%s\n" % (seqanno, seq)
-                    except KeyError:
+                    except IndexError:
                         pass
                 else:
                     fastaseq = myfunc.ReadFile(seqfile_this_seq)#seq text in fasta format
@@ -632,23 +978,21 @@ def SubmitJob(jobid, cntSubmitJobDict, numseq_this_user, g_params):  # {{{
 
                 isSubmitSuccess = False
                 if len(seq) > 0:
-                    query_para['name_software'] = webcom.GetNameSoftware(name_server.lower(), queue_method)
-                    query_para['queue_method'] = queue_method
+                    query_para_this_node['name_software'] = webcom.GetNameSoftware(name_server.lower(), queue_method)
+                    query_para_this_node['queue_method'] = queue_method
                     if name_server.lower() == "pathopred":
                         variant_text = myfunc.ReadFile(variant_file)
-                        query_para['variants'] = variant_text
+                        query_para_this_node['variants'] = variant_text
                         # also include the identifier name as a query parameter
-                        query_para['identifier_name'] = seqid
+                        query_para_this_node['identifier_name'] = seqid
 
-                    para_str = json.dumps(query_para, sort_keys=True)
+                    para_str = json.dumps(query_para_this_node, sort_keys=True)
                     jobname = ""
                     if email not in g_params['vip_user_list']:
                         useemail = ""
                     else:
                         useemail = email
                     try:
-                        myfunc.WriteFile("\tSubmitting seq %4d "%(origIndex),
-                                gen_logfile, "a", True)
                         rtValue = myclient.service.submitjob_remote(fastaseq, para_str,
                                 jobname, useemail, str(numseq_this_user), str(isForceRun))
                     except Exception as e:
@@ -656,7 +1000,6 @@ def SubmitJob(jobid, cntSubmitJobDict, numseq_this_user, g_params):  # {{{
                         rtValue = []
                         pass
 
-                    cnttry += 1
                     if len(rtValue) >= 1:
                         strs = rtValue[0]
                         if len(strs) >=5:
@@ -672,28 +1015,69 @@ def SubmitJob(jobid, cntSubmitJobDict, numseq_this_user, g_params):  # {{{
                                 txt =  "%d\t%s\t%s\t%s\t%s\t%f"%( origIndex,
                                         node, remote_jobid, seqanno.replace('\t', ' '), seq,
                                         epochtime)
-                                submitted_loginfo_list.append(txt)
-                                cnttry = 0  #reset cnttry to zero
+                                with lock:
+                                    submitted_loginfo_list.append(txt)
                         else:
                             webcom.loginfo("bad wsdl return value", gen_logfile)
+                # an empty sequence also counts as a try, otherwise it would
+                # be retried forever
+                cnttry += 1
 
                 if isSubmitSuccess:
                     cnt += 1
-                    myfunc.WriteFile(" succeeded on node %s\n"%(node), gen_logfile, "a", True)
+                    cnttry = 0  #reset cnttry to zero
+                    myfunc.WriteFile("\tSubmitting seq %4d succeeded on node %s\n"%(origIndex, node), gen_logfile, "a", True)
                 else:
-                    myfunc.WriteFile(" failed on node %s\n"%(node), gen_logfile, "a", True)
+                    myfunc.WriteFile("\tSubmitting seq %4d failed on node %s\n"%(origIndex, node), gen_logfile, "a", True)
 
                 if isSubmitSuccess or cnttry >= g_params['MAX_SUBMIT_TRY']:
-                    iToRun += 1
-                    processedIndexSet.add(str(origIndex))
+                    with lock:
+                        processedIndexSet.add(str(origIndex))
                     if 'DEBUG' in g_params and g_params['DEBUG']:
                         webcom.loginfo(f"DEBUG: jobid {jobid} processedIndexSet.add({origIndex})", gen_logfile)
+                    origIndex = None
             # update cntSubmitJobDict for this node
             cntSubmitJobDict[node][0] = cnt
+        # }}}
+
+        clientDict = {}
+        for node in cntSubmitJobDict:
+            if cntSubmitJobDict[node][3] == "OFF":
+                webcom.loginfo(f"node {node} is offline, try again in the next loop", gen_logfile)
+                continue
+            if cntSubmitJobDict[node][0] >= cntSubmitJobDict[node][1]:
+                continue
+            try:
+                clientDict[node] = g_wsdl_client_pool.Acquire(node)
+            except Exception as e:
+                webcom.loginfo(f"Failed to access the WSDL of {node}, detailed error: {e}", gen_logfile)
+                g_wsdl_client_pool.Invalidate(node)
+                cntSubmitJobDict[node][3] = "OFF"
+        if "DEBUG" in g_params and g_params['DEBUG']:
+            webcom.loginfo(f"Submit job {jobid} to the nodes {list(clientDict.keys())}", gen_logfile)
+            webcom.loginfo(f"cntSubmitJobDict={cntSubmitJobDict}", gen_logfile)
+
+        if len(clientDict) > 0:
+            max_workers = len(clientDict)
+            if 'MAX_SUBMIT_THREAD' in g_params and g_params['MAX_SUBMIT_THREAD'] > 0:
+                max_workers = min(max_workers, g_params['MAX_SUBMIT_THREAD'])
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futureDict = {}
+                for node in clientDict:
+                    futureDict[node] = executor.submit(SubmitToNode, node, clientDict[node])
+                for node in futureDict:
+                    try:
+                        futureDict[node].result()
+                    except Exception as e:
+                        webcom.loginfo(f"SubmitJob for {jobid} on node {node} failed with errmsg={e}", gen_logfile)
+            for node in clientDict:
+                g_wsdl_client_pool.Release(node, clientDict[node])
+        hdl_queryfile.close()
 
     # finally, append submitted_loginfo_list to remotequeue_idx_file 
     if 'DEBUG' in g_params and g_params['DEBUG']:
         webcom.loginfo(f"DEBUG: len(submitted_loginfo_list)={len(submitted_loginfo_list)}", gen_logfile)
+    progressDict = webcom.ReadJobProgress(rstdir)
     if len(submitted_loginfo_list)>0:
         myfunc.WriteFile("\n".join(submitted_loginfo_list)+"\n", remotequeue_idx_file, "a", True)
     # update torun_idx_file
@@ -708,6 +1092,9 @@ def SubmitJob(jobid, cntSubmitJobDict, numseq_this_user, g_params):  # {{{
         myfunc.WriteFile("\n".join(newToRunIndexList)+"\n", torun_idx_file, "w", True)
     else:
         myfunc.WriteFile("", torun_idx_file, "w", True)
+    webcom.UpdateJobProgress(rstdir, progressDict,
+            addDict={'remotequeue': len(submitted_loginfo_list)},
+            setDict={'torun': len(newToRunIndexList)})
 
     return 0
 # }}}
@@ -719,13 +1106,11 @@ def GetResult(jobid, g_params):  # {{{
     """
     # retrieving result from the remote server for this job
     gen_logfile = g_params['gen_logfile']
-    gen_errfile = g_params['gen_errfile']
 
     webcom.loginfo(f"GetResult for {jobid}.", gen_logfile)
 
     path_static = g_params['path_static']
     path_result = os.path.join(path_static, 'result')
-    path_cache = g_params['path_cache']
     finished_date_db = g_params['finished_date_db']
     name_server = g_params['name_server']
 
@@ -810,11 +1195,15 @@ def GetResult(jobid, g_params):  # {{{
                 except (ValueError, IndexError, KeyError):
                     cntTryDict[int(idx)] = 1
             myfunc.WriteFile("\n".join(torun_idx_str_list)+"\n", torun_idx_file, "w", True)
+            numtorun = len(torun_idx_str_list)
 
             if 'DEBUG' in g_params and g_params['DEBUG']:
                 webcom.loginfo(f"recreate torun_idx_file: jobid = {jobid}, numseq={numseq}, len(completed_idx_set)={len(completed_idx_set)}, len(torun_idx_str_list)={len(torun_idx_str_list)}", gen_logfile)
         else:
             myfunc.WriteFile("", torun_idx_file, "w", True)
+            numtorun = 0
+        webcom.UpdateJobProgress(rstdir, webcom.ReadJobProgress(rstdir),
+                setDict={'torun': numtorun})
     else:
         if 'DEBUG' in g_params and g_params['DEBUG']:
             webcom.loginfo(f"DEBUG: {jobid}: remotequeue_idx_file {remotequeue_idx_file} is not empty", gen_logfile)
@@ -827,30 +1216,10 @@ def GetResult(jobid, g_params):  # {{{
         return 1
     lines = text.split("\n")
 
+    recordList = []  # [(line, origIndex, node, remote_jobid, description, seq, submit_time_epoch)]
     nodeSet = set([])
     for i in range(len(lines)):
         line = lines[i]
-        if not line or line[0] == "#":
-            continue
-        strs = line.split("\t")
-        if len(strs) != 6:
-            continue
-        node = strs[1]
-        nodeSet.add(node)
-
-    myclientDict = {}
-    for node in nodeSet:
-        wsdl_url = f"http://{node}/pred/api_submitseq/?wsdl"
-        try:
-            myclient = Client(wsdl_url, cache=None, timeout=30)
-            myclientDict[node] = myclient
-        except Exception as e:
-            webcom.loginfo(f"Failed to access {wsdl_url} with errmsg {e}", gen_logfile)
-            pass
-
-    for i in range(len(lines)):  # {{{
-        line = lines[i]
-
         if 'DEBUG' in g_params and g_params['DEBUG']:
             myfunc.WriteFile(f"Process {line}\n", gen_logfile, "a", True)
         if not line or line[0] == "#":
@@ -868,26 +1237,49 @@ def GetResult(jobid, g_params):  # {{{
         description = strs[3]
         seq = strs[4]
         submit_time_epoch = float(strs[5])
-        subfoldername_this_seq = f"seq_{origIndex}"
-        outpath_this_seq = os.path.join(outpath_result, subfoldername_this_seq)
+        recordList.append((line, origIndex, node, remote_jobid, description,
+                           seq, submit_time_epoch))
+        nodeSet.add(node)
 
+    # make sure that the WSDL of each node is accessible, the workers will
+    # then use clones of the pooled client
+    availNodeSet = set([])
+    for node in nodeSet:
         try:
-            myclient = myclientDict[node]
-        except KeyError:
-            if 'DEBUG' in g_params and g_params['DEBUG']:
-                webcom.loginfo("DEBUG: node (%s) not found in myclientDict, ignore"%(node), gen_logfile)
-            keep_queueline_list.append(line)
-            continue
-        try:
-            rtValue = myclient.service.checkjob(remote_jobid)
+            myclient = g_wsdl_client_pool.Acquire(node)
+            g_wsdl_client_pool.Release(node, myclient)
+            availNodeSet.add(node)
         except Exception as e:
-            msg = "checkjob(%s) at node %s failed with errmsg %s"%(remote_jobid, node, str(e))
-            webcom.loginfo(msg, gen_logfile)
-            rtValue = []
+            webcom.loginfo(f"Failed to access the WSDL of {node} with errmsg {e}", gen_logfile)
+            g_wsdl_client_pool.Invalidate(node)
             pass
+
+    lock = threading.Lock()  # protect starttagfile
+    finish_date_recorder = webcom.GetFinishDateRecorder(finished_date_db)
+
+    def HarvestRecord(myclient, record, rtValue=None):  # {{{
+        """Check the status of one remote job and retrieve the result if it is
+        finished. rtValue is the status already returned by checkjob_batch, if
+        any. Return a dictionary with the outcome, the bookkeeping of the
+        index files is done by the caller
+        """
+        (line, origIndex, node, remote_jobid, description, seq,
+         submit_time_epoch) = record
+        subfoldername_this_seq = f"seq_{origIndex}"
+        outpath_this_seq = os.path.join(outpath_result, subfoldername_this_seq)
+        if rtValue is None:
+            try:
+                rtValue = myclient.service.checkjob(remote_jobid)
+            except Exception as e:
+                msg = "checkjob(%s) at node %s failed with errmsg %s"%(remote_jobid, node, str(e))
+                webcom.loginfo(msg, gen_logfile)
+                rtValue = []
+                pass
         isSuccess = False
         isFinish_remote = False
+        isKeepLine = False
         status = ""
+        info_finish = ""
         if len(rtValue) >= 1:
             ss2 = rtValue[0]
             if len(ss2) >= 3:
@@ -905,119 +1297,81 @@ def GetResult(jobid, g_params):  # {{{
                 if status == "Finished":  # {{{
                     isFinish_remote = True
                     outfile_zip = f"{tmpdir}/{remote_jobid}.zip"
-                    isRetrieveSuccess = False
-                    myfunc.WriteFile("\tFetching result for %s/seq_%d from %s " % (
-                        jobid, origIndex, result_url), gen_logfile, "a", True)
-                    if myfunc.IsURLExist(result_url, timeout=5):
-                        try:
-                            myfunc.urlretrieve(result_url, outfile_zip, timeout=10)
-                            isRetrieveSuccess = True
-                            myfunc.WriteFile(f" succeeded on node {node}\n", gen_logfile, "a", True)
-                        except Exception as e:
-                            myfunc.WriteFile(" failed with %s\n"%(str(e)), gen_logfile, "a", True)
-                            pass
-                    if os.path.exists(outfile_zip) and isRetrieveSuccess:
-                        cmd = ["unzip", outfile_zip, "-d", tmpdir]
-                        webcom.RunCmd(cmd, gen_logfile, gen_errfile)
-                        rst_fetched = os.path.join(tmpdir, remote_jobid)
+                    msg_fetch = "\tFetching result for %s/seq_%d from %s" % (
+                        jobid, origIndex, result_url)
+                    errmsg = myfunc.FetchURL(result_url, outfile_zip, timeout=10)
+                    if errmsg == "":
+                        myfunc.WriteFile(f"{msg_fetch} succeeded on node {node}\n", gen_logfile, "a", True)
+                        # map the result of this seq in the archive to
+                        # outpath_this_seq
                         if name_server.lower() == "pconsc3":
-                            rst_this_seq = rst_fetched
+                            mapList = [f"{remote_jobid}/"]
                         elif name_server.lower() == "boctopus2":
-                            rst_this_seq = os.path.join(rst_fetched, "seq_0", "seq_0")
-                            rst_this_seq_parent = os.path.join(rst_fetched, "seq_0")
+                            # move also seq.fa and time.txt for boctopus2
+                            mapList = [f"{remote_jobid}/seq_0/seq_0/",
+                                       f"{remote_jobid}/seq_0/seq.fa",
+                                       f"{remote_jobid}/seq_0/time.txt"]
                         else:
-                            rst_this_seq = os.path.join(rst_fetched, "seq_0")
-
-                        if os.path.islink(outpath_this_seq):
-                            os.unlink(outpath_this_seq)
-                        elif os.path.exists(outpath_this_seq):
-                            shutil.rmtree(outpath_this_seq)
-
-                        if os.path.exists(rst_this_seq) and not os.path.exists(outpath_this_seq):
-                            cmd = ["mv", "-f", rst_this_seq, outpath_this_seq]
-                            webcom.RunCmd(cmd, gen_logfile, gen_errfile)
-                            if name_server.lower() == "boctopus2":
-                                # move also seq.fa and time.txt for boctopus2
-                                file1 = os.path.join(rst_this_seq_parent, "seq.fa")
-                                file2 = os.path.join(rst_this_seq_parent, "time.txt")
-                                for f in [file1, file2]:
-                                    if os.path.exists(f):
-                                        try:
-                                            shutil.move(f, outpath_this_seq)
-                                        except:
-                                            pass
-
-                            fafile_this_seq = os.path.join(outpath_this_seq, "seq.fa")
-                            if webcom.IsCheckPredictionPassed(outpath_this_seq, name_server):
-                                # relpace the seq.fa with original description
-                                myfunc.WriteFile('>%s\n%s\n'%(description, seq), fafile_this_seq, 'w', True)
-                                isSuccess = True
-
-                            if isSuccess:
-                                # delete the data on the remote server
-                                try:
-                                    rtValue2 = myclient.service.deletejob(remote_jobid)
-                                except Exception as e:
-                                    msg = (f"Failed to delete the job {remote_jobid} on node {node}"
-                                           f" with error: {str(e)}")
-                                    webcom.loginfo(msg, gen_logfile)
-                                    rtValue2 = []
-                                    pass
-
-                                logmsg = ""
-                                if len(rtValue2) >= 1:
-                                    ss2 = rtValue2[0]
-                                    if len(ss2) >= 2:
-                                        status_job_delete = ss2[0]
-                                        errmsg = ss2[1]
-                                        if status_job_delete == "Succeeded":
-                                            logmsg = (f"Successfully deleted data on {node} "
-                                                      f"for {remote_jobid}")
-                                        else:
-                                            logmsg = (f"Failed to delete data on {node} for "
-                                                      f"{remote_jobid} with error: {errmsg}")
-                                else:
-                                    logmsg = f"Failed to call deletejob {remote_jobid} via WSDL on {node}\n"
-                                webcom.loginfo(logmsg, gen_logfile)
-
-                                # delete the downloaded temporary zip file and
-                                # extracted file
-                                if os.path.exists(outfile_zip):
-                                    os.remove(outfile_zip)
-                                if os.path.exists(rst_fetched):
-                                    shutil.rmtree(rst_fetched)
-
-                                # create or update the md5 cache
-                                if name_server.lower() == "prodres" and query_para != {}:
-                                    md5_key = hashlib.md5((seq+str(query_para)).encode('utf-8')).hexdigest()
-                                else:
-                                    md5_key = hashlib.md5(seq.encode('utf-8')).hexdigest()
-                                subfoldername = md5_key[:2]
-                                md5_subfolder = "%s/%s"%(path_cache, subfoldername)
-                                cachedir = "%s/%s/%s"%(path_cache, subfoldername, md5_key)
-
-                                # copy the zipped folder to the cache path
-                                origpath = os.getcwd()
-                                os.chdir(outpath_result)
-                                shutil.copytree("seq_%d"%(origIndex), md5_key)
-                                cmd = ["zip", "-rq", "%s.zip"%(md5_key), md5_key]
-                                webcom.RunCmd(cmd, runjob_logfile, runjob_errfile)
-                                if not os.path.exists(md5_subfolder):
-                                    os.makedirs(md5_subfolder)
-                                shutil.move("%s.zip"%(md5_key), "%s.zip"%(cachedir))
-                                shutil.rmtree(md5_key) # delete the temp folder named as md5 hash
-                                os.chdir(origpath)
-
-                                # Add the finished date to the database
-                                date_str = time.strftime(g_params['FORMAT_DATETIME'])
-                                MAX_TRY_INSERT_DB = 3
-                                cnttry = 0
-                                while cnttry < MAX_TRY_INSERT_DB:
-                                    t_rv = webcom.InsertFinishDateToDB(date_str, md5_key, seq, finished_date_db)
-                                    if t_rv == 0:
-                                        break
-                                    cnttry += 1
-                                    time.sleep(random.random()/1.0)
+                            mapList = [f"{remote_jobid}/seq_0/"]
+                        errmsg = ExtractResultZip(outfile_zip, mapList, outpath_this_seq)
+                        if errmsg != "":
+                            webcom.loginfo(errmsg, gen_logfile)
+                            # the archive is corrupt, fetch it again next time
+                            os.remove(outfile_zip)
+                    else:
+                        myfunc.WriteFile(f"{msg_fetch} failed with {errmsg}\n", gen_logfile, "a", True)
+
+                    if errmsg == "":
+                        fafile_this_seq = os.path.join(outpath_this_seq, "seq.fa")
+                        if webcom.IsCheckPredictionPassed(outpath_this_seq, name_server):
+                            # relpace the seq.fa with original description
+                            myfunc.WriteFile('>%s\n%s\n'%(description, seq), fafile_this_seq, 'w', True)
+                            isSuccess = True
+
+                        if isSuccess:
+                            # delete the data on the remote server
+                            try:
+                                rtValue2 = myclient.service.deletejob(remote_jobid)
+                            except Exception as e:
+                                msg = (f"Failed to delete the job {remote_jobid} on node {node}"
+                                       f" with error: {str(e)}")
+                                webcom.loginfo(msg, gen_logfile)
+                                rtValue2 = []
+                                pass
+
+                            logmsg = ""
+                            if len(rtValue2) >= 1:
+                                ss2 = rtValue2[0]
+                                if len(ss2) >= 2:
+                                    status_job_delete = ss2[0]
+                                    errmsg = ss2[1]
+                                    if status_job_delete == "Succeeded":
+                                        logmsg = (f"Successfully deleted data on {node} "
+                                                  f"for {remote_jobid}")
+                                    else:
+                                        logmsg = (f"Failed to delete data on {node} for "
+                                                  f"{remote_jobid} with error: {errmsg}")
+                            else:
+                                logmsg = f"Failed to call deletejob {remote_jobid} via WSDL on {node}\n"
+                            webcom.loginfo(logmsg, gen_logfile)
+
+                            # delete the downloaded temporary zip file
+                            if os.path.exists(outfile_zip):
+                                os.remove(outfile_zip)
+
+                            # create or update the cache
+                            cache_para = None
+                            if name_server.lower() == "prodres" and query_para != {}:
+                                cache_para = query_para
+                            md5_key = GetResultCache(g_params).put(seq, cache_para, outpath_this_seq)
+                            if md5_key == "":
+                                webcom.loginfo(f"Failed to cache the result {outpath_this_seq}", runjob_errfile)
+                                md5_key = resultcache.GetCacheKey(seq, cache_para)
+
+                            # Add the finished date to the database, the
+                            # records are written at the end of GetResult
+                            date_str = time.strftime(g_params['FORMAT_DATETIME'])
+                            finish_date_recorder.Add(date_str, md5_key, seq)
 
 # }}}
                 elif status in ["Failed", "None"]:
@@ -1026,37 +1380,22 @@ def GetResult(jobid, g_params):  # {{{
                     if 'DEBUG' in g_params and g_params['DEBUG']:
                         webcom.loginfo(f"DEBUG: {remote_jobid}, status = {status}", gen_logfile)
 
-                if status != "Wait" and not os.path.exists(starttagfile):
-                    webcom.WriteDateTimeTagFile(starttagfile, runjob_logfile, runjob_errfile)
+                if status != "Wait":
+                    with lock:
+                        if not os.path.exists(starttagfile):
+                            webcom.WriteDateTimeTagFile(starttagfile, runjob_logfile, runjob_errfile)
 
         if isSuccess:  # {{{
             time_now = time.time()
             runtime1 = time_now - submit_time_epoch  # in seconds
             timefile = os.path.join(outpath_this_seq, "time.txt")
             runtime = webcom.ReadRuntimeFromFile(timefile, default_runtime=runtime1)
-            info_finish = webcom.GetInfoFinish(
+            info_finish = "\t".join(webcom.GetInfoFinish(
                     name_server, outpath_this_seq,
                     origIndex, len(seq), description,
-                    source_result="newrun", runtime=runtime)
-            finished_info_list.append("\t".join(info_finish))
-            finished_idx_list.append(str(origIndex))
+                    source_result="newrun", runtime=runtime))
             # }}}
 
-        # if the job is finished on the remote but the prediction is failed,
-        # try resubmit a few times and if all failed, add the origIndex to the
-        # failed_idx_file
-        if isFinish_remote and not isSuccess:
-            cnttry = 1
-            try:
-                cnttry = cntTryDict[int(origIndex)]
-            except KeyError:
-                cnttry = 1
-            if cnttry < g_params['MAX_RESUBMIT']:
-                resubmit_idx_list.append(str(origIndex))
-                cntTryDict[int(origIndex)] = cnttry+1
-            else:
-                failed_idx_list.append(str(origIndex))
-
         if not isFinish_remote:
             time_in_remote_queue = time.time() - submit_time_epoch
             # for jobs queued in the remote queue more than one day (but not
@@ -1081,13 +1420,127 @@ def GetResult(jobid, g_params):  # {{{
                     rtValue2 = []
                     pass
             else:
-                keep_queueline_list.append(line)
+                isKeepLine = True
+
+        return {'isSuccess': isSuccess, 'isFinish_remote': isFinish_remote,
+                'isKeepLine': isKeepLine, 'info_finish': info_finish}
+    # }}}
+
+    def HarvestNode(node, subRecordList):  # {{{
+        """Harvest the records of one node in order with its own client"""
+        resultList = []
+        try:
+            myclient = g_wsdl_client_pool.Acquire(node)
+        except Exception as e:
+            webcom.loginfo(f"Failed to access the WSDL of {node} with errmsg {e}", gen_logfile)
+            return [(record, None) for record in subRecordList]
+        try:
+            # query the status of all records in one round trip if the node
+            # supports checkjob_batch, records without an answer fall back to
+            # checkjob in HarvestRecord
+            statusDict = {}
+            if (len(subRecordList) > 1 and
+                    IsWSDLMethodSupported(myclient, "checkjob_batch")):
+                statusDict = CheckJobBatch(myclient,
+                                           [x[3] for x in subRecordList],
+                                           batch_size, isBatchSupported=True)
+            for record in subRecordList:
+                try:
+                    resultList.append((record, HarvestRecord(
+                        myclient, record, statusDict.get(record[3], None))))
+                except Exception as e:
+                    webcom.loginfo(f"Failed to harvest {record[3]} on node {node} with errmsg {e}", gen_logfile)
+                    resultList.append((record, None))
+        finally:
+            g_wsdl_client_pool.Release(node, myclient)
+        return resultList
+    # }}}
+
+    # Records are harvested in parallel, with at most MAX_HARVEST_THREAD
+    # workers in total and MAX_HARVEST_THREAD_PER_NODE workers per node. The
+    # records of a node are split evenly among its workers.
+    max_thread = 16
+    if 'MAX_HARVEST_THREAD' in g_params and g_params['MAX_HARVEST_THREAD'] > 0:
+        max_thread = g_params['MAX_HARVEST_THREAD']
+    max_thread_per_node = 4
+    if ('MAX_HARVEST_THREAD_PER_NODE' in g_params
+            and g_params['MAX_HARVEST_THREAD_PER_NODE'] > 0):
+        max_thread_per_node = g_params['MAX_HARVEST_THREAD_PER_NODE']
+    batch_size = 500
+    if 'CHECKJOB_BATCH_SIZE' in g_params and g_params['CHECKJOB_BATCH_SIZE'] > 0:
+        batch_size = g_params['CHECKJOB_BATCH_SIZE']
+
+    nodeRecordDict = {}  # {node: [record]}
+    harvestList = []  # [(record, result)]
+    for record in recordList:
+        node = record[2]
+        if node in availNodeSet:
+            nodeRecordDict.setdefault(node, []).append(record)
+        else:
+            if 'DEBUG' in g_params and g_params['DEBUG']:
+                webcom.loginfo("DEBUG: node (%s) not accessible, ignore"%(node), gen_logfile)
+            harvestList.append((record, None))
+
+    # list the workers round-robin over nodes so that all nodes are served
+    # even when there are more workers than max_thread
+    workerListDict = {}
+    for node in nodeRecordDict:
+        subRecordList = nodeRecordDict[node]
+        numWorker = min(max_thread_per_node, len(subRecordList))
+        workerListDict[node] = [subRecordList[i::numWorker] for i in range(numWorker)]
+    taskList = []
+    for i in range(max_thread_per_node):
+        for node in workerListDict:
+            if i < len(workerListDict[node]):
+                taskList.append((node, workerListDict[node][i]))
+
+    if len(taskList) > 0:
+        with ThreadPoolExecutor(max_workers=min(max_thread, len(taskList))) as executor:
+            futureList = [executor.submit(HarvestNode, node, subRecordList)
+                          for (node, subRecordList) in taskList]
+            for future in futureList:
+                harvestList += future.result()
+
+    for (record, result) in harvestList:  # {{{
+        (line, origIndex, node, remote_jobid, description, seq,
+         submit_time_epoch) = record
+        if result is None:
+            # the node is not accessible, keep the record in the queue
+            keep_queueline_list.append(line)
+            continue
+        isSuccess = result['isSuccess']
+        isFinish_remote = result['isFinish_remote']
+        if isSuccess:
+            finished_info_list.append(result['info_finish'])
+            finished_idx_list.append(str(origIndex))
+
+        # if the job is finished on the remote but the prediction is failed,
+        # try resubmit a few times and if all failed, add the origIndex to the
+        # failed_idx_file
+        if isFinish_remote and not isSuccess:
+            cnttry = 1
+            try:
+                cnttry = cntTryDict[int(origIndex)]
+            except KeyError:
+                cnttry = 1
+            if cnttry < g_params['MAX_RESUBMIT']:
+                resubmit_idx_list.append(str(origIndex))
+                cntTryDict[int(origIndex)] = cnttry+1
+            else:
+                failed_idx_list.append(str(origIndex))
+
+        if result['isKeepLine']:
+            keep_queueline_list.append(line)
 # }}}
+    # write the finish dates of the newly cached results in one transaction
+    finish_date_recorder.Flush()
+
     # Finally, write log files
     finished_idx_list = list(set(finished_idx_list))
     failed_idx_list = list(set(failed_idx_list))
     resubmit_idx_list = list(set(resubmit_idx_list))
 
+    progressDict = webcom.ReadJobProgress(rstdir)
     if len(finished_info_list) > 0:
         myfunc.WriteFile("\n".join(finished_info_list)+"\n", finished_seq_file,
                          "a", True)
@@ -1102,14 +1555,18 @@ def GetResult(jobid, g_params):  # {{{
                          "a", True)
 
     if len(keep_queueline_list) > 0:
-        keep_queueline_list = list(set(keep_queueline_list))
-        myfunc.WriteFile("\n".join(keep_queueline_list)+"\n",
-                         remotequeue_idx_file, "w", True)
+        keep_queueline_list = myfunc.uniquelist(keep_queueline_list)
+        myfunc.WriteFileAtomic("\n".join(keep_queueline_list)+"\n",
+                               remotequeue_idx_file)
     else:
-        myfunc.WriteFile("", remotequeue_idx_file, "w", True)
-
-    with open(cnttry_idx_file, 'w') as fpout:
-        json.dump(cntTryDict, fpout)
+        myfunc.WriteFileAtomic("", remotequeue_idx_file)
+    webcom.UpdateJobProgress(rstdir, progressDict,
+            addDict={'finished': len(finished_idx_list),
+                     'failed': len(failed_idx_list),
+                     'torun': len(resubmit_idx_list)},
+            setDict={'remotequeue': len(keep_queueline_list)})
+
+    myfunc.WriteFileAtomic(json.dumps(cntTryDict), cnttry_idx_file)
 
     return 0
 # }}}
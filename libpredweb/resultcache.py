@@ -0,0 +1,386 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Description:
+A content-addressed cache of prediction results
+
+Each cached result folder is stored as a single zip archive (blob) under
+path_cache/blobs/<sha256[:2]>/<sha256>.zip, where sha256 is the checksum of
+the archive. The archives are built deterministically, so that identical
+results share the same blob. An SQLite index in path_cache maps the cache key,
+i.e. the md5 of the sequence (and the query parameters for prodres), to the
+blob.
+
+Results cached in the old layout path_cache/<md5[:2]>/<md5>(.zip) are still
+found by get() and materialise(), and removed by evict().
+
+Author: Nanjiang Shu (nanjiang.shu@scilifelab.se)
+
+Address: Science for Life Laboratory Stockholm, Box 1031, 17121 Solna, Sweden
+"""
+
+import os
+import sys
+import time
+import shutil
+import sqlite3
+import hashlib
+import zipfile
+import threading
+
+FICLONE = 0x40049409  # ioctl to clone a file on btrfs and xfs
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)  # fixed time stamp for reproducible blobs
+
+
+def GetCacheKey(seq, params=None):  # {{{
+    """Return the cache key for seq, params are included when given, this is
+    used by e.g. prodres for which the result depends on the parameters
+    """
+    if params:
+        return hashlib.md5((seq+str(params)).encode('utf-8')).hexdigest()
+    else:
+        return hashlib.md5(seq.encode('utf-8')).hexdigest()
+# }}}
+
+
+def CloneFile(src, dst, link_mode="reflink"):  # {{{
+    """Create dst with the content of src
+    link_mode:
+        hardlink: hard link dst to src, dst must then not be modified in place
+        reflink:  share the data blocks copy-on-write if the file system
+                  supports it, otherwise copy
+        copy:     copy the file
+    """
+    if link_mode == "hardlink":
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass
+    elif link_mode == "reflink":
+        try:
+            import fcntl
+            with open(src, "rb") as fpin, open(dst, "wb") as fpout:
+                fcntl.ioctl(fpout.fileno(), FICLONE, fpin.fileno())
+            shutil.copystat(src, dst)
+            return
+        except (OSError, ImportError):
+            pass
+    shutil.copy2(src, dst)
+# }}}
+
+
+class ResultCache(object):  # {{{
+    """Content-addressed cache of prediction results
+
+    Usage:
+        cache = ResultCache(path_cache)
+        if not cache.materialise(seq, params, outpath_this_seq):
+            ...
+        cache.put(seq, params, outpath_this_seq)
+        cache.evict(md5_key)
+        cache.close()
+
+    Blobs are written to a temporary file and then hard linked to their final
+    name, so concurrent writers never see a partially written blob, and the
+    index is updated in SQLite transactions.
+    """
+    def __init__(self, path_cache, link_mode="reflink"):  # {{{
+        self.failure = False
+        self.path_cache = path_cache
+        self.path_blob = os.path.join(path_cache, "blobs")
+        self.dbfile = os.path.join(path_cache, "cache_index.sqlite3")
+        self.link_mode = link_mode
+        self.con = None
+        self.lock = threading.Lock()
+        try:
+            os.makedirs(self.path_blob, exist_ok=True)
+            self.con = sqlite3.connect(self.dbfile, timeout=30,
+                                       isolation_level=None,
+                                       check_same_thread=False)
+            self.con.execute("PRAGMA journal_mode=WAL")
+            self.con.execute("PRAGMA synchronous=NORMAL")
+            self.con.execute("""
+                CREATE TABLE IF NOT EXISTS cache
+                (
+                    md5 TEXT NOT NULL PRIMARY KEY,
+                    sha256 TEXT NOT NULL,
+                    size INTEGER,
+                    created_epoch REAL
+                )""")
+            self.con.execute(
+                "CREATE INDEX IF NOT EXISTS idx_cache_sha256 ON cache(sha256)")
+        except (sqlite3.Error, OSError) as e:
+            print("Failed to open result cache %s with errmsg=%s" % (
+                path_cache, str(e)), file=sys.stderr)
+            self.failure = True
+            self.con = None
+# }}}
+
+    def GetBlobPath(self, sha256):  # {{{
+        return os.path.join(self.path_blob, sha256[:2], sha256 + ".zip")
+# }}}
+
+    def GetLegacyPath(self, md5_key):  # {{{
+        """Return the (folder, zipfile) of md5_key in the old layout"""
+        cachedir = os.path.join(self.path_cache, md5_key[:2], md5_key)
+        return (cachedir, cachedir + ".zip")
+# }}}
+
+    def LookupBlob(self, md5_key):  # {{{
+        """Return the path of the blob for md5_key, None if not indexed"""
+        if self.failure:
+            return None
+        with self.lock:
+            row = self.con.execute("SELECT sha256 FROM cache WHERE md5 = ?",
+                                   (md5_key,)).fetchone()
+        if row is None:
+            return None
+        blobfile = self.GetBlobPath(row[0])
+        if not os.path.exists(blobfile):
+            # the blob was removed, e.g. by an evict() racing with put()
+            with self.lock:
+                self.con.execute("DELETE FROM cache WHERE md5 = ?", (md5_key,))
+            return None
+        return blobfile
+# }}}
+
+    def get(self, seq, params=None):  # {{{
+        """Return the path of the cached result of seq, which is either a
+        blob, or a folder or a zip file in the old layout. Return None if
+        there is no cached result
+        """
+        md5_key = GetCacheKey(seq, params)
+        blobfile = self.LookupBlob(md5_key)
+        if blobfile is not None:
+            return blobfile
+        (cachedir, zipfile_cache) = self.GetLegacyPath(md5_key)
+        if os.path.exists(cachedir):
+            return cachedir
+        if os.path.exists(zipfile_cache) and os.path.getsize(zipfile_cache) > 0:
+            return zipfile_cache
+        return None
+# }}}
+
+    def LookupMany(self, seqList, params=None):  # {{{
+        """Look up the cached results of many sequences at once
+
+        The keys of all sequences are resolved against the index with one
+        query per chunk of keys, only the keys not in the index are checked in
+        the old layout. Return a dictionary {index_in_seqList: (md5_key,
+        source)}, where source is the path as returned by get(), only hits are
+        included
+        """
+        keyList = [GetCacheKey(seq, params) for seq in seqList]
+        blobDict = {}  # {md5_key: sha256}
+        if not self.failure:
+            uniq_keys = list(set(keyList))
+            chunk_size = 500  # below the limit of SQL variables in SQLite
+            with self.lock:
+                for i in range(0, len(uniq_keys), chunk_size):
+                    sub_keys = uniq_keys[i:i+chunk_size]
+                    sql = "SELECT md5, sha256 FROM cache WHERE md5 IN (%s)" % (
+                        ",".join(["?"]*len(sub_keys)))
+                    for row in self.con.execute(sql, sub_keys):
+                        blobDict[row[0]] = row[1]
+
+        hitDict = {}
+        sourceDict = {}  # {md5_key: source}, for duplicated sequences
+        for i in range(len(keyList)):
+            md5_key = keyList[i]
+            if md5_key not in sourceDict:
+                source = None
+                if md5_key in blobDict:
+                    blobfile = self.GetBlobPath(blobDict[md5_key])
+                    if os.path.exists(blobfile):
+                        source = blobfile
+                if source is None:
+                    (cachedir, zipfile_cache) = self.GetLegacyPath(md5_key)
+                    if os.path.exists(cachedir):
+                        source = cachedir
+                    elif (os.path.exists(zipfile_cache) and
+                            os.path.getsize(zipfile_cache) > 0):
+                        source = zipfile_cache
+                sourceDict[md5_key] = source
+            if sourceDict[md5_key] is not None:
+                hitDict[i] = (md5_key, sourceDict[md5_key])
+        return hitDict
+# }}}
+
+    def materialise(self, seq, params, outpath):  # {{{
+        """Write the cached result of seq to the folder outpath, replacing
+        the existing one. Return True on success and False if there is no
+        usable cached result
+        """
+        md5_key = GetCacheKey(seq, params)
+        source = self.get(seq, params)
+        if source is None:
+            return False
+        return self.MaterialiseFrom(md5_key, source, outpath)
+# }}}
+
+    def MaterialiseFrom(self, md5_key, source, outpath):  # {{{
+        """Write the cached result at source, as returned by get() or
+        LookupMany(), to the folder outpath, replacing the existing one.
+        Return True on success
+        """
+        tmp_outpath = "%s.tmp.%d.%d" % (outpath, os.getpid(),
+                                        threading.get_ident())
+        try:
+            (cachedir, zipfile_cache) = self.GetLegacyPath(md5_key)
+            if source == cachedir:
+                link_mode = self.link_mode
+
+                def copy_function(src, dst):
+                    CloneFile(src, dst, link_mode)
+                shutil.copytree(cachedir, tmp_outpath,
+                                copy_function=copy_function)
+            elif source == zipfile_cache:
+                if not self.ExtractZip(zipfile_cache, md5_key + "/",
+                                       tmp_outpath):
+                    return False
+            else:
+                if not self.ExtractZip(source, "", tmp_outpath):
+                    return False
+
+            if os.path.islink(outpath):
+                os.unlink(outpath)
+            elif os.path.exists(outpath):
+                shutil.rmtree(outpath)
+            os.rename(tmp_outpath, outpath)
+            return True
+        except (OSError, zipfile.BadZipFile, shutil.Error) as e:
+            print("Failed to materialise cached result %s to %s with errmsg=%s"
+                  % (md5_key, outpath, str(e)), file=sys.stderr)
+            return False
+        finally:
+            if os.path.exists(tmp_outpath):
+                shutil.rmtree(tmp_outpath, ignore_errors=True)
+# }}}
+
+    def ExtractZip(self, infile, prefix, outpath):  # {{{
+        """Extract the members under prefix in the zip file infile to outpath
+        Return True if anything is extracted
+        """
+        cnt = 0
+        with zipfile.ZipFile(infile) as zipfp:
+            for zinfo in zipfp.infolist():
+                if not zinfo.filename.startswith(prefix):
+                    continue
+                relpath = zinfo.filename[len(prefix):]
+                target = os.path.normpath(os.path.join(outpath, relpath))
+                if not target.startswith(outpath + os.sep):
+                    continue  # ignore names like ../../x
+                if zinfo.is_dir():
+                    os.makedirs(target, exist_ok=True)
+                    continue
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                with zipfp.open(zinfo) as fpin, open(target, "wb") as fpout:
+                    shutil.copyfileobj(fpin, fpout, 1024*1024)
+                mode = (zinfo.external_attr >> 16) & 0o777
+                if mode:
+                    os.chmod(target, mode)
+                cnt += 1
+        return cnt > 0
+# }}}
+
+    def put(self, seq, params, result_dir):  # {{{
+        """Store the result folder result_dir as the cached result of seq
+        Return the md5 key of the cached result, "" on failure
+        """
+        if self.failure:
+            return ""
+        md5_key = GetCacheKey(seq, params)
+        tmpfile = os.path.join(self.path_blob, "tmp.%d.%d.zip" % (
+            os.getpid(), threading.get_ident()))
+        try:
+            # build the archive deterministically, sorted names and fixed time
+            # stamps, so that identical results give identical blobs
+            with zipfile.ZipFile(tmpfile, "w", zipfile.ZIP_DEFLATED) as zipfp:
+                for root, dirs, files in os.walk(result_dir):
+                    dirs.sort()
+                    relroot = os.path.relpath(root, result_dir)
+                    for f in sorted(files):
+                        path = os.path.join(root, f)
+                        arcname = os.path.normpath(os.path.join(relroot, f))
+                        zinfo = zipfile.ZipInfo(arcname, ZIP_DATE_TIME)
+                        zinfo.external_attr = (os.stat(path).st_mode & 0o777) << 16
+                        zinfo.compress_type = zipfile.ZIP_DEFLATED
+                        with open(path, "rb") as fpin, \
+                                zipfp.open(zinfo, "w") as fpout:
+                            shutil.copyfileobj(fpin, fpout, 1024*1024)
+            sha = hashlib.sha256()
+            with open(tmpfile, "rb") as fpin:
+                for chunk in iter(lambda: fpin.read(1024*1024), b""):
+                    sha.update(chunk)
+            sha256 = sha.hexdigest()
+            blobfile = self.GetBlobPath(sha256)
+            os.makedirs(os.path.dirname(blobfile), exist_ok=True)
+            try:
+                os.link(tmpfile, blobfile)
+            except FileExistsError:
+                pass  # the same content is already stored
+            size = os.path.getsize(blobfile)
+            with self.lock:
+                self.con.execute(
+                    "INSERT OR REPLACE INTO cache(md5, sha256, size, created_epoch)"
+                    " VALUES(?, ?, ?, ?)", (md5_key, sha256, size, time.time()))
+            return md5_key
+        except (OSError, sqlite3.Error) as e:
+            print("Failed to cache %s with errmsg=%s" % (result_dir, str(e)),
+                  file=sys.stderr)
+            return ""
+        finally:
+            if os.path.exists(tmpfile):
+                os.remove(tmpfile)
+# }}}
+
+    def evict(self, md5_key):  # {{{
+        """Remove the cached result with the key md5_key, both in the new
+        and the old layout. The blob is deleted when no other key refers to
+        it. Return True if anything is removed
+        """
+        isRemoved = False
+        if not self.failure:
+            with self.lock:
+                with self.con:
+                    self.con.execute("BEGIN IMMEDIATE")
+                    row = self.con.execute(
+                        "SELECT sha256 FROM cache WHERE md5 = ?",
+                        (md5_key,)).fetchone()
+                    sha256 = None
+                    if row is not None:
+                        sha256 = row[0]
+                        self.con.execute("DELETE FROM cache WHERE md5 = ?",
+                                         (md5_key,))
+                        isRemoved = True
+                        row = self.con.execute(
+                            "SELECT 1 FROM cache WHERE sha256 = ? LIMIT 1",
+                            (sha256,)).fetchone()
+                        if row is not None:
+                            sha256 = None  # still in use by another key
+            if sha256 is not None:
+                try:
+                    os.remove(self.GetBlobPath(sha256))
+                except OSError:
+                    pass
+
+        (cachedir, zipfile_cache) = self.GetLegacyPath(md5_key)
+        if os.path.exists(zipfile_cache):
+            os.remove(zipfile_cache)
+            isRemoved = True
+        if os.path.exists(cachedir):
+            shutil.rmtree(cachedir)
+            isRemoved = True
+        return isRemoved
+# }}}
+
+    def close(self):  # {{{
+        if self.con is not None:
+            try:
+                self.con.close()
+            except sqlite3.Error:
+                pass
+            self.con = None
+# }}}
+# }}}
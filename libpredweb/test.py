@@ -3,6 +3,7 @@ import os
 import sys
 from libpredweb import webserver_common as webcom
 from libpredweb import myfunc
+import time
 if __name__ == '__main__':
     progname=os.path.basename(sys.argv[0])
     general_usage = """
@@ -34,3 +35,364 @@ if __name__ == '__main__':
         except Exception as e:
             print("retrieve %s failed with errmsg=%s"%(url, str(e)) )
 
+    if TESTMODE == "bench_checkjob_batch":
+        # benchmark checkjob_batch against checkjob with a local stub of the
+        # WSDL service, each call costs a round trip of latency seconds
+        from libpredweb import qd_fe_common
+        numjob = 2000
+        latency = 0.002
+        if numArgv > 2:
+            numjob = int(sys.argv[2])
+        if numArgv > 3:
+            latency = float(sys.argv[3])
+
+        class StubService(object):
+            def __init__(self, isBatchSupported):
+                self.cnt_call = 0
+                if isBatchSupported:
+                    self.checkjob_batch = self._checkjob_batch
+            def checkjob(self, remote_jobid):
+                self.cnt_call += 1
+                time.sleep(latency)
+                return [["Running", "", ""]]
+            def _checkjob_batch(self, remote_jobid_str):
+                self.cnt_call += 1
+                time.sleep(latency)
+                return [[x, "Running", "", ""] for x in remote_jobid_str.split(",")]
+
+        class StubClient(object):
+            def __init__(self, isBatchSupported):
+                self.service = StubService(isBatchSupported)
+
+        remote_jobid_list = ["rst_%d"%(i) for i in range(numjob)]
+        for isBatchSupported in [False, True]:
+            myclient = StubClient(isBatchSupported)
+            t0 = time.time()
+            dt = qd_fe_common.CheckJobBatch(myclient, remote_jobid_list)
+            t1 = time.time()
+            print("checkjob_batch=%s: %d status, %d calls, %.3f seconds"%(
+                isBatchSupported, len(dt), myclient.service.cnt_call, t1-t0))
+
+    if TESTMODE == "bench_timeparser":
+        # benchmark parsing the submit dates of all_submitted_seq.log with
+        # timeparser against dateutil
+        # usage: test.py bench_timeparser all_submitted_seq.log
+        from libpredweb import timeparser
+        from datetime import timezone
+        infile = sys.argv[2]
+        date_str_list = myfunc.ReadIDList2(infile, col=0, delim="\t")
+        print("%d date strings, %d unique"%(len(date_str_list),
+            len(set(date_str_list))))
+
+        def ToEpoch(dt):
+            # naive datetimes are taken as UTC
+            if dt is None:
+                return None
+            if dt.tzinfo is None:
+                dt = dt.replace(tzinfo=timezone.utc)
+            return dt.timestamp()
+
+        result_list = []
+        t0 = time.time()
+        for date_str in date_str_list:
+            try:
+                result_list.append(timeparser.ParseDateTime(date_str))
+            except ValueError:
+                result_list.append(None)
+        t1 = time.time()
+        print("timeparser: %.3f seconds, %s"%(t1-t0,
+            str(timeparser.ParseDateTime.cache_info())))
+        try:
+            from dateutil import parser as dtparser
+        except ImportError:
+            dtparser = None
+        if dtparser is not None:
+            ref_list = []
+            t0 = time.time()
+            for date_str in date_str_list:
+                strs = date_str.split()
+                if len(strs) == 2:
+                    date_str += " UTC"
+                if len(strs) == 3 and strs[2] == "U":
+                    date_str = date_str.replace("U", "UTC")
+                try:
+                    ref_list.append(dtparser.parse(date_str))
+                except ValueError:
+                    ref_list.append(None)
+            t1 = time.time()
+            cnt_diff = 0
+            for i in range(len(date_str_list)):
+                if ToEpoch(result_list[i]) != ToEpoch(ref_list[i]):
+                    cnt_diff += 1
+            print("dateutil: %.3f seconds, %d of %d differ from timeparser"%(
+                t1-t0, cnt_diff, len(date_str_list)))
+
+    if TESTMODE == "bench_numseq_same_user":
+        # scaling benchmark of webcom.GetNumSeqSameUserDict, the result is
+        # compared with the quadratic reference for the smallest size
+        import random
+        def GetNumSeqSameUserDict_ref(joblist):
+            dt = {}
+            for i in range(len(joblist)):
+                (jobid1, ip1, email1) = (joblist[i][0], joblist[i][3], joblist[i][4])
+                try:
+                    numseq1 = int(joblist[i][5])
+                except ValueError:
+                    numseq1 = 123
+                dt[jobid1] = dt.get(jobid1, 0) + numseq1
+                if ip1 == "" and email1 == "":
+                    continue
+                for j in range(len(joblist)):
+                    if i == j:
+                        continue
+                    (ip2, email2) = (joblist[j][3], joblist[j][4])
+                    try:
+                        numseq2 = int(joblist[j][5])
+                    except ValueError:
+                        numseq2 = 123
+                    if ((ip2 != "" and ip2 == ip1) or
+                            (email2 != "" and email2 == email1)):
+                        dt[jobid1] += numseq2
+            return dt
+
+        random.seed(0)
+        for numjob in [1000, 10000, 100000]:
+            joblist = []
+            for i in range(numjob):
+                ip = random.choice(["", "10.0.0.%d"%(random.randint(0, numjob//20))])
+                email = random.choice(["", "", "u%d@x.org"%(random.randint(0, numjob//50))])
+                numseq_str = random.choice(["1", "1", "5", "200", "bad"])
+                joblist.append(["rst_%d"%(i), "Queued", "", ip, email,
+                    numseq_str, "wsdl", "", "", ""])
+            t0 = time.time()
+            dt = webcom.GetNumSeqSameUserDict(joblist)
+            t1 = time.time()
+            msg = "numjob=%d: %.3f seconds"%(numjob, t1-t0)
+            if numjob <= 1000:
+                msg += ", same as reference: %s"%(
+                    str(dt == GetNumSeqSameUserDict_ref(joblist)))
+            print(msg)
+
+    if TESTMODE == "bench_priority":
+        # benchmark of priority.PriorityScorer.ScoreMany against scoring each
+        # job with myfunc.GetSuqPriority
+        import math
+        import random
+        from libpredweb import priority
+        random.seed(0)
+        epoch_now = time.time()
+        blackiplist = ["10.0.0.1"]
+        vip_user_list = ["vip@x.org"]
+        for numjob in [1000, 10000, 100000]:
+            numseq_list = [random.choice([1, 1, 5, 200, 3000]) for i in range(numjob)]
+            numseq_this_user_list = [x*random.randint(1, 50) for x in numseq_list]
+            ip_list = ["10.0.0.%d"%(random.randint(0, 20)) for i in range(numjob)]
+            email_list = [random.choice(["", "u@x.org", "vip@x.org"]) for i in range(numjob)]
+            t0 = time.time()
+            ref_list = []
+            for i in range(numjob):
+                prio = myfunc.FloatDivision(myfunc.GetSuqPriority(
+                    numseq_this_user_list[i], epoch_now) - numseq_list[i],
+                    math.sqrt(numseq_list[i]))
+                if ip_list[i] in blackiplist:
+                    prio = prio/1000.0
+                if email_list[i] in vip_user_list or ip_list[i] in vip_user_list:
+                    prio = 999999999.0
+                ref_list.append(prio)
+            t1 = time.time()
+            scorer = priority.PriorityScorer(epoch_now, blackiplist, vip_user_list)
+            (priority_list, n_list) = scorer.ScoreMany(numseq_list,
+                    numseq_this_user_list, ip_list, email_list)
+            t2 = time.time()
+            isSame = all(abs(priority_list[i]-ref_list[i]) <= 1e-9*abs(ref_list[i])
+                         for i in range(numjob))
+            print("numjob=%d: GetSuqPriority %.3f seconds, ScoreMany %.3f seconds"
+                  " (numpy=%s), same as reference: %s"%(numjob, t1-t0, t2-t1,
+                      str(priority.numpy is not None), str(isSame)))
+
+    if TESTMODE == "bench_mydb_concurrency":
+        # throughput of MyDB lookups with threads sharing one instance and
+        # with forked worker processes, for both access modes
+        # usage: test.py bench_mydb_concurrency [numrecord] [compression]
+        import random
+        import tempfile
+        import shutil
+        import multiprocessing
+        from concurrent.futures import ThreadPoolExecutor
+        from libpredweb import mydb
+        from libpredweb import mydb_common
+        numrecord = int(sys.argv[2]) if numArgv > 2 else 200000
+        compression = sys.argv[3] if numArgv > 3 else "none"
+        tmpdir = tempfile.mkdtemp()
+        dbname = os.path.join(tmpdir, "benchdb")
+        random.seed(0)
+        with mydb.MyDBBuilder(dbname, max_dbfile_size=64*1024*1024,
+                              compression=compression) as builder:
+            for i in range(numrecord):
+                builder.AddRecord("seq_%d"%(i), ">seq_%d\n%s\n"%(i,
+                    "".join(random.choice("ACDEFGHIKLMNPQRSTVWY")
+                            for j in range(random.randint(50, 400)))))
+        chunk_list = [["seq_%d"%(random.randint(0, numrecord-1))
+                       for j in range(2000)] for k in range(200)]
+        numlookup = sum(len(x) for x in chunk_list)
+
+        def LookupChunk(args):
+            (idList, access_mode) = args
+            db = mydb.GetSharedMyDB(dbname, access_mode=access_mode)
+            return sum(len(x) for x in db.GetRecords(idList))
+
+        for access_mode in [mydb_common.ACCESS_MMAP, mydb_common.ACCESS_PREAD]:
+            task_list = [(x, access_mode) for x in chunk_list]
+            ref = sum(LookupChunk(x) for x in task_list)
+            for numworker in [1, 2, 4, 8]:
+                t0 = time.time()
+                with ThreadPoolExecutor(max_workers=numworker) as executor:
+                    total = sum(executor.map(LookupChunk, task_list))
+                t1 = time.time()
+                with multiprocessing.get_context("fork").Pool(numworker) as pool:
+                    total2 = sum(pool.map(LookupChunk, task_list))
+                t2 = time.time()
+                print("access_mode=%d workers=%d: threads %.0f records/s,"
+                      " processes %.0f records/s, same as sequential: %s"%(
+                          access_mode, numworker, numlookup/(t1-t0),
+                          numlookup/(t2-t1), str(total == ref == total2)))
+
+        # a missing ID and a corrupt record must both give None
+        db = mydb.MyDB(dbname)
+        (dbfileindex, offset, size) = db.GetLocation(db.GetIndexItem("seq_1"))
+        with open(db.fpdbList[dbfileindex].name, "r+b") as fpout:
+            fpout.seek(offset)
+            fpout.write(b"\xff"*size)
+        db.close()
+        for access_mode in [mydb_common.ACCESS_MMAP, mydb_common.ACCESS_PREAD]:
+            db = mydb.MyDB(dbname, access_mode=access_mode)
+            isOK = (db.GetRecord("seq_missing") is None
+                    and db.GetRecord("seq_1") is None
+                    and db.GetRecords(["seq_missing", "seq_1", "seq_0"])[:2] == [None, None]
+                    and dict(db.iter_records())["seq_1"] is None
+                    and db.GetRecord("seq_0") is not None)
+            db.close()
+            print("access_mode=%d missing and corrupt records give None: %s"%(
+                access_mode, str(isOK)))
+        shutil.rmtree(tmpdir)
+
+    if TESTMODE == "bench_fasta":
+        # benchmark of the FASTA parser against the previous block reading
+        # implementations, on a synthetic file of the size of UniProtKB/Swiss-Prot
+        # usage: test.py bench_fasta [numseq] [fastafile]
+        import re
+        import random
+        import tempfile
+        def ReadFasta_ref(infile, BLOCK_SIZE=100000):
+            idList = []; annotationList = []; seqList = []
+            def AddRecord(seqWithAnno):
+                idList.append(myfunc.GetSeqIDFromAnnotation(seqWithAnno[0:seqWithAnno.find('\n')]))
+                annotationList.append(seqWithAnno[0:seqWithAnno.find('\n')].lstrip('>').rstrip('\n'))
+                seqList.append(seqWithAnno[seqWithAnno.find("\n"):].replace('\n','').replace(' ',''))
+            fpin = open(infile, "r")
+            buff = fpin.read(BLOCK_SIZE)
+            brokenSeqWithAnnoLine = ""
+            while buff:
+                beg = 0; end = 0
+                while 1:
+                    if brokenSeqWithAnnoLine:
+                        if brokenSeqWithAnnoLine[-1] == "\n":
+                            end = buff.find(">")
+                        else:
+                            end = buff.find("\n>")
+                        if end >= 0:
+                            AddRecord(brokenSeqWithAnnoLine + buff[0:end])
+                            brokenSeqWithAnnoLine = ""
+                            beg = end
+                        else:
+                            brokenSeqWithAnnoLine += buff
+                            break
+                    beg = buff.find(">", beg)
+                    end = buff.find("\n>", beg+1)
+                    if beg >= 0:
+                        if end >= 0:
+                            AddRecord(buff[beg:end])
+                            beg = end
+                        else:
+                            brokenSeqWithAnnoLine = buff[beg:]
+                            break
+                    else:
+                        break
+                buff = fpin.read(BLOCK_SIZE)
+            if brokenSeqWithAnnoLine:
+                AddRecord(brokenSeqWithAnnoLine)
+            fpin.close()
+            return (idList, annotationList, seqList)
+        def ReadFastaFromBuffer_ref(buff, recordList):
+            def Extract(seqWithAnno):
+                posAnnoEnd = seqWithAnno.find('\n')
+                anno = seqWithAnno[1:posAnnoEnd]
+                return (myfunc.GetSeqIDFromAnnotation(anno, 0), anno,
+                        re.sub(r"\s+", '', seqWithAnno[posAnnoEnd+1:]))
+            beg = 0
+            while 1:
+                beg = buff.find(">", beg)
+                if beg < 0:
+                    break
+                end = buff.find("\n>", beg+1)
+                if end < 0:
+                    recordList.append(Extract(buff[beg:]))
+                    break
+                recordList.append(Extract(buff[beg:end]))
+                beg = end
+
+        numseq = int(sys.argv[2]) if numArgv > 2 else 570000
+        if numArgv > 3:
+            fastafile = sys.argv[3]
+        else:
+            random.seed(0)
+            fastafile = tempfile.mktemp(suffix=".fa")
+            with open(fastafile, "w") as fpout:
+                alphabet = "ACDEFGHIKLMNPQRSTVWY"
+                for i in range(numseq):
+                    seq = "".join(random.choices(alphabet, k=random.randint(50, 700)))
+                    fpout.write(">sp|P%05d|PROT%d_HUMAN Protein %d OS=Homo sapiens"
+                            " OX=9606 GN=G%d PE=1 SV=1\n"%(i, i, i, i))
+                    fpout.write("\n".join(seq[j:j+60] for j in range(0, len(seq), 60)) + "\n")
+        print("file %s, %d bytes"%(fastafile, os.path.getsize(fastafile)))
+        t0 = time.time()
+        ref = ReadFasta_ref(fastafile)
+        t1 = time.time()
+        new = myfunc.ReadFasta(fastafile)
+        t2 = time.time()
+        seqList = myfunc.ReadFasta_simple(fastafile)
+        t3 = time.time()
+        print("ReadFasta: previous %.2f seconds, now %.2f seconds, same: %s"%(
+            t1-t0, t2-t1, str(ref == new)))
+        print("ReadFasta_simple: %.2f seconds, same: %s"%(t3-t2, str(seqList == ref[2])))
+        with open(fastafile) as fpin:
+            rawseq = fpin.read()
+        recordList_ref = []
+        recordList = []
+        t0 = time.time()
+        ReadFastaFromBuffer_ref(rawseq, recordList_ref)
+        t1 = time.time()
+        myfunc.ReadFastaFromBuffer(rawseq, recordList, True, 0, 0)
+        t2 = time.time()
+        print("ReadFastaFromBuffer: previous %.2f seconds, now %.2f seconds, same: %s"%(
+            t1-t0, t2-t1, str(recordList_ref == recordList)))
+        # random access by FastaFile, the index is built by the first handle
+        # and loaded from <fastafile>.idx by the second
+        idxList = [random.randrange(len(new[0])) for i in range(1000)]
+        t0 = time.time()
+        hdl = myfunc.FastaFile(fastafile)
+        rd = [hdl[i] for i in idxList]
+        hdl.close()
+        t1 = time.time()
+        hdl = myfunc.FastaFile(fastafile)
+        rd = [hdl[i] for i in idxList]
+        t2 = time.time()
+        isSame = (rd == [(new[0][i], new[1][i], new[2][i]) for i in idxList] and
+                list(hdl) == list(zip(*new)))
+        hdl.close()
+        print("FastaFile: %d lookups %.3f seconds with indexing, %.3f seconds"
+                " with saved index, same: %s"%(len(idxList), t1-t0, t2-t1,
+                    str(isSame)))
+        os.remove("%s.idx"%(fastafile))
+        if numArgv <= 3:
+            os.remove(fastafile)
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Description:
+Fast parsing of the date time strings written by the web servers
+
+Almost all date time strings in the log files are written with
+FORMAT_DATETIME ("%Y-%m-%d %H:%M:%S %Z"), e.g. "2023-05-04 10:11:12 CEST",
+sometimes without the zone or with the zone truncated to "U". These are
+parsed with a precompiled regular expression and a small table of zones,
+and the results of recent strings are memoised. Other strings fall back to
+dateutil, which is imported only when needed.
+
+Author: Nanjiang Shu (nanjiang.shu@scilifelab.se)
+
+Address: Science for Life Laboratory Stockholm, Box 1031, 17121 Solna, Sweden
+"""
+
+import re
+import functools
+from datetime import datetime, timezone, timedelta
+
+# zones used in the log files, a missing zone means UTC
+ZONE_DICT = {
+        "": timezone.utc,
+        "UTC": timezone.utc,
+        "U": timezone.utc,   # "UTC" truncated by .rstrip("CEST")
+        "GMT": timezone.utc,
+        "Z": timezone.utc,
+        "CET": timezone(timedelta(hours=1), "CET"),
+        "CEST": timezone(timedelta(hours=2), "CEST"),
+        }
+
+RE_DATETIME = re.compile(
+        r"^\s*(\d{4})-(\d{2})-(\d{2})[ T](\d{2}):(\d{2}):(\d{2})(?:\.(\d{1,6}))?"
+        r"(?:\s*([A-Za-z]+))?\s*$")
+
+
+@functools.lru_cache(maxsize=65536)
+def ParseDateTime(date_str):  # {{{
+    """Convert the date time string to an timezone aware datetime
+    raise ValueError if date_str can not be parsed
+    """
+    # fast path for FORMAT_DATETIME, with fixed positions
+    if (len(date_str) >= 19 and date_str[4] == "-" and date_str[7] == "-"
+            and date_str[10] == " " and date_str[13] == ":"
+            and date_str[16] == ":"):
+        tzinfo = ZONE_DICT.get(date_str[19:].strip(), None)
+        if tzinfo is not None:
+            try:
+                return datetime(int(date_str[0:4]), int(date_str[5:7]),
+                                int(date_str[8:10]), int(date_str[11:13]),
+                                int(date_str[14:16]), int(date_str[17:19]),
+                                tzinfo=tzinfo)
+            except ValueError:
+                pass
+    m = RE_DATETIME.match(date_str)
+    if m is not None:
+        zone = m.group(8) or ""
+        tzinfo = ZONE_DICT.get(zone.upper(), None)
+        if tzinfo is not None:
+            microsecond = 0
+            if m.group(7):
+                microsecond = int(m.group(7).ljust(6, "0"))
+            return datetime(int(m.group(1)), int(m.group(2)), int(m.group(3)),
+                            int(m.group(4)), int(m.group(5)), int(m.group(6)),
+                            microsecond, tzinfo=tzinfo)
+    return ParseDateTime_dateutil(date_str)
+# }}}
+
+
+def ParseDateTime_dateutil(date_str):  # {{{
+    """Parse odd date time strings with dateutil
+    raise ValueError if date_str can not be parsed
+    """
+    from dateutil import parser as dtparser
+    strs = date_str.split()
+    if len(strs) == 2:
+        date_str += " UTC"
+    try:
+        dt = dtparser.parse(date_str)
+    except (ValueError, OverflowError) as e:
+        raise ValueError(str(e))
+    return dt
+# }}}
+
+
+def ParseDateTimeToEpoch(date_str):  # {{{
+    """Convert the date time string to epoch in seconds
+    raise ValueError if date_str can not be parsed
+    """
+    dt = ParseDateTime(date_str)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.timestamp()
+# }}}
@@ -13,9 +13,11 @@ import os
 import sys
 import re
 from . import myfunc
+from . import timeparser
+from . import jobqueue
+from . import jobstate
 import time
 from datetime import datetime
-from dateutil import parser as dtparser
 from pytz import timezone
 import tabulate
 import shutil
@@ -23,6 +25,9 @@ import logging
 import subprocess
 import sqlite3
 import json
+import threading
+import atexit
+import random
 from geoip import geolite2
 import pycountry
 import requests
@@ -99,6 +104,81 @@ def get_job_status(jobid, numseq, path_result):# {{{
 
     return status.value
 # }}}
+JOB_PROGRESS_FILE = "progress.json"  # per-job sidecar with the progress counters
+JOB_PROGRESS_ITEM_DICT = {
+        'finished': "finished_seqindex.txt",
+        'failed': "failed_seqindex.txt",
+        'remotequeue': "remotequeue_seqindex.txt",
+        'torun': "torun_seqindex.txt",
+        }
+def CountJobIndexFile(rstdir, item):#{{{
+    """Count the entries, one per line, of the index file of item in rstdir
+    """
+    infile = os.path.join(rstdir, JOB_PROGRESS_ITEM_DICT[item])
+    if not os.path.exists(infile):
+        return 0
+    return len([x for x in myfunc.ReadFile(infile).split("\n") if x.strip() != ""])
+#}}}
+def ReadJobProgress(rstdir):#{{{
+    """Read the progress counters of the job in rstdir, return a dict
+    {item: number of entries in the index file of item}, e.g.
+    {'finished': 120, 'failed': 2, 'remotequeue': 30, 'torun': 48}
+    A counter is valid only if the size of its index file is the same as when
+    the counter was written, otherwise the item is left out and the caller
+    should count the index file itself
+    """
+    infile = os.path.join(rstdir, JOB_PROGRESS_FILE)
+    try:
+        with open(infile, "r") as fpin:
+            progress = json.load(fpin)
+    except (IOError, OSError, ValueError):
+        return {}
+    if not isinstance(progress, dict):
+        return {}
+    countDict = {}
+    for item in JOB_PROGRESS_ITEM_DICT:
+        try:
+            (size, count) = progress[item]
+        except (KeyError, TypeError, ValueError):
+            continue
+        idxfile = os.path.join(rstdir, JOB_PROGRESS_ITEM_DICT[item])
+        try:
+            cursize = os.path.getsize(idxfile)
+        except OSError:
+            cursize = 0
+        if cursize == size:
+            countDict[item] = count
+    return countDict
+#}}}
+def UpdateJobProgress(rstdir, countDict, addDict=None, setDict=None):#{{{
+    """Update the progress counters of the job in rstdir after its index files
+    have been written
+    countDict   the counters read by ReadJobProgress before the writes
+    addDict     {item: number of entries appended to the index file}
+    setDict     {item: number of entries of the rewritten index file}
+    An item appended to without a valid counter is counted from its index
+    file. countDict is updated in place and returned
+    """
+    if addDict:
+        for item in addDict:
+            if item in countDict:
+                countDict[item] += addDict[item]
+            else:
+                countDict[item] = CountJobIndexFile(rstdir, item)
+    if setDict:
+        countDict.update(setDict)
+
+    progress = {}
+    for item in countDict:
+        idxfile = os.path.join(rstdir, JOB_PROGRESS_ITEM_DICT[item])
+        try:
+            size = os.path.getsize(idxfile)
+        except OSError:
+            size = 0
+        progress[item] = [size, countDict[item]]
+    myfunc.WriteFileAtomic(json.dumps(progress), os.path.join(rstdir, JOB_PROGRESS_FILE))
+    return countDict
+#}}}
 def get_external_ip(timeout=5):# {{{
     """Return external IP of the host
     """
@@ -1138,7 +1218,7 @@ def datetime_str_to_epoch(date_str):# {{{
     return the epoch time of the current time when conversion failed
     """
     try:
-        return dtparser.parse(date_str).strftime("%s")
+        return str(int(timeparser.ParseDateTimeToEpoch(date_str)))
     except:
         return time.strftime('%s')
 # }}}
@@ -1149,13 +1229,7 @@ def datetime_str_to_time(date_str, isSetDefault=True):# {{{
     otherwise return None when conversion failed
     """
     try:
-        strs = date_str.split()
-        if len(strs) == 2:
-            date_str += " UTC"
-        if len(strs) == 3 and strs[2] == "U":
-            date_str = date_str.replace("U", "UTC")
-        dt = dtparser.parse(date_str)
-        return dt
+        return timeparser.ParseDateTime(date_str)
     except:
         if isSetDefault:
             return datetime.now(timezone(TZ))
@@ -1541,31 +1615,146 @@ def ValidateVariants(rawvariants, seqinfo, g_params):#{{{
     seqinfo['errinfo'] = seqinfo['errinfo_br'] + seqinfo['errinfo_content']
     return filtered_variants
 #}}}
-def InsertFinishDateToDB(date_str, md5_key, seq, outdb):# {{{
-    """ Insert the finish date to the sqlite3 database
+def InitFinishDateDB(con, tbname_content="data"):# {{{
+    """Set up the database of the finish dates of cached results
+
+    The table is created if it does not exist, and the column finish_epoch
+    (the finish date in epoch) with an index is added to tables created by
+    older versions. New databases use incremental auto vacuum.
     """
-    tbname_content = "data"
-    try:
-        con = sqlite3.connect(outdb)
-    except Exception as e:
-        print(("Failed to connect to the database outdb %s"%(outdb)))
-    with con:
-        cur = con.cursor()
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS %s
-            (
-                md5 TEXT PRIMARY KEY,
-                seq TEXT,
-                date_finish TEXT
-            )"""%(tbname_content))
-        cmd =  "INSERT OR REPLACE INTO %s(md5,  seq, date_finish) VALUES('%s', '%s','%s')"%(tbname_content, md5_key, seq, date_str)
+    con.execute("PRAGMA journal_mode=WAL")
+    con.execute("PRAGMA synchronous=NORMAL")
+    if con.execute("PRAGMA page_count").fetchone()[0] == 0:
+        # only effective before the first table is created
+        con.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS %s
+        (
+            md5 TEXT PRIMARY KEY,
+            seq TEXT,
+            date_finish TEXT,
+            finish_epoch INTEGER
+        )"""%(tbname_content))
+    columnList = [row[1] for row in con.execute("PRAGMA table_info(%s)"%(tbname_content))]
+    if not "finish_epoch" in columnList:
         try:
-            cur.execute(cmd)
-            return 0
-        except Exception as e:
-            print("Exception %s"%(str(e)), file=sys.stderr)
-            return 1
+            con.execute("ALTER TABLE %s ADD COLUMN finish_epoch INTEGER"%(tbname_content))
+        except sqlite3.OperationalError:
+            pass  # added by another process meanwhile
+    con.execute("CREATE INDEX IF NOT EXISTS idx_%s_finish_epoch ON %s(finish_epoch)"%(
+        tbname_content, tbname_content))
+# }}}
+class FinishDateRecorder(object):# {{{
+    """Record the finish date of cached sequences to the sqlite3 database
+
+    One connection in WAL mode is kept for each process. Records are queued
+    by Add() and written by Flush() in one transaction with executemany, so
+    that there is one fsync per flush instead of one per sequence. Records
+    that can not be written are kept for the next Flush(). Pending records
+    are also flushed when the process exits.
+
+    Usage:
+        recorder = GetFinishDateRecorder(outdb)
+        recorder.Add(date_str, md5_key, seq)
+        ...
+        recorder.Flush()
+    """
+    tbname_content = "data"
 
+    def __init__(self, outdb):# {{{
+        self.outdb = outdb
+        self.pid = os.getpid()
+        self.con = None
+        self.lock = threading.Lock()
+        self.pendingList = []  # [(md5, seq, date_finish, finish_epoch)]
+# }}}
+    def GetConnection(self):# {{{
+        """Return the connection of this process, open it if needed"""
+        if self.con is not None and self.pid == os.getpid():
+            return self.con
+        # the connection can not be shared with a forked child process
+        self.pid = os.getpid()
+        self.con = sqlite3.connect(self.outdb, timeout=30,
+                isolation_level=None, check_same_thread=False)
+        InitFinishDateDB(self.con, self.tbname_content)
+        return self.con
+# }}}
+    def Add(self, date_str, md5_key, seq, finish_epoch=None):# {{{
+        """Queue a record, it is written at the next Flush()
+        finish_epoch is the finish date in epoch, the current time by default
+        """
+        if finish_epoch is None:
+            finish_epoch = time.time()
+        with self.lock:
+            self.pendingList.append((md5_key, seq, date_str, int(finish_epoch)))
+# }}}
+    def Flush(self, max_try=3):# {{{
+        """Write all queued records in one transaction
+        Return the number of records written, -1 on failure
+        """
+        with self.lock:
+            if len(self.pendingList) == 0:
+                return 0
+            dataList = self.pendingList
+            self.pendingList = []
+            sql = ("INSERT OR REPLACE INTO %s(md5, seq, date_finish, finish_epoch)"
+                   " VALUES(?, ?, ?, ?)"%(self.tbname_content))
+            for cnttry in range(max_try):
+                try:
+                    con = self.GetConnection()
+                    with con:
+                        con.execute("BEGIN IMMEDIATE")
+                        con.executemany(sql, dataList)
+                    return len(dataList)
+                except sqlite3.Error as e:
+                    print("Failed to write %d records to %s with errmsg=%s"%(
+                        len(dataList), self.outdb, str(e)), file=sys.stderr)
+                    time.sleep(random.random())
+            # keep the records for the next flush
+            self.pendingList = dataList + self.pendingList
+            return -1
+# }}}
+    def close(self):# {{{
+        self.Flush()
+        if self.con is not None and self.pid == os.getpid():
+            try:
+                self.con.close()
+            except sqlite3.Error:
+                pass
+        self.con = None
+# }}}
+# }}}
+
+g_finish_date_recorder_dict = {}  # {outdb: FinishDateRecorder}
+g_finish_date_recorder_lock = threading.Lock()
+
+def GetFinishDateRecorder(outdb):# {{{
+    """Return the FinishDateRecorder for outdb, one per process"""
+    with g_finish_date_recorder_lock:
+        if outdb not in g_finish_date_recorder_dict:
+            g_finish_date_recorder_dict[outdb] = FinishDateRecorder(outdb)
+        return g_finish_date_recorder_dict[outdb]
+# }}}
+def FlushFinishDateRecorder():# {{{
+    """Flush all FinishDateRecorders, called also at exit"""
+    with g_finish_date_recorder_lock:
+        recorderList = list(g_finish_date_recorder_dict.values())
+    for recorder in recorderList:
+        recorder.Flush()
+# }}}
+atexit.register(FlushFinishDateRecorder)
+
+def InsertFinishDateToDB(date_str, md5_key, seq, outdb):# {{{
+    """ Insert the finish date to the sqlite3 database
+    The record is written immediately, use GetFinishDateRecorder() to write
+    many records in one transaction
+    """
+    recorder = GetFinishDateRecorder(outdb)
+    recorder.Add(date_str, md5_key, seq)
+    if recorder.Flush() >= 0:
+        return 0
+    else:
+        return 1
 # }}}
 
 def GetInfoFinish(name_server, outpath_this_seq, origIndex, seqLength, seqAnno, source_result="", runtime=0.0):# {{{
@@ -1680,41 +1869,54 @@ def GetNumSeqSameUserDict(joblist):#{{{
     finish_date_str]
 
     the return value is a dictionary {'jobid': total_num_seq}
+
+    Two jobs are of the same user if they share the IP or the email (not
+    transitively). The total is computed in linear time from the sums of
+    numseq per IP, per email and per (IP, email), since for a job with IP a
+    and email b, the jobs sharing a or b sum up to
+        sum_ip[a] + sum_email[b] - sum_ip_email[(a, b)]
     """
     # Fixed error for getting numseq at 2015-04-11
-    numseq_user_dict = {}
-    for i in range(len(joblist)):
-        li1 = joblist[i]
-        jobid1 = li1[0]
-        ip1 = li1[3]
-        email1 = li1[4]
+    numseqList = []
+    sum_ip_dict = {}
+    sum_email_dict = {}
+    sum_ip_email_dict = {}
+    for li in joblist:
+        ip = li[3]
+        email = li[4]
         try:
-            numseq1 = int(li1[5])
+            numseq = int(li[5])
         except:
-            numseq1 = 123
+            numseq = 123
             pass
-        if not jobid1 in numseq_user_dict:
-            numseq_user_dict[jobid1] = 0
-        numseq_user_dict[jobid1] += numseq1
-        if ip1 == "" and email1 == "":
-            continue
+        numseqList.append(numseq)
+        if ip != "":
+            sum_ip_dict[ip] = sum_ip_dict.get(ip, 0) + numseq
+        if email != "":
+            sum_email_dict[email] = sum_email_dict.get(email, 0) + numseq
+        if ip != "" and email != "":
+            sum_ip_email_dict[(ip, email)] = sum_ip_email_dict.get((ip, email), 0) + numseq
 
-        for j in range(len(joblist)):
-            li2 = joblist[j]
-            if i == j:
-                continue
-
-            jobid2 = li2[0]
-            ip2 = li2[3]
-            email2 = li2[4]
-            try:
-                numseq2 = int(li2[5])
-            except:
-                numseq2 = 123
-                pass
-            if ((ip2 != "" and ip2 == ip1) or
-                    (email2 != "" and email2 == email1)):
-                numseq_user_dict[jobid1] += numseq2
+    numseq_user_dict = {}
+    for i in range(len(joblist)):
+        li = joblist[i]
+        jobid = li[0]
+        ip = li[3]
+        email = li[4]
+        if ip == "" and email == "":
+            total = numseqList[i]
+        else:
+            # the job itself is included once in the sums
+            total = 0
+            if ip != "":
+                total += sum_ip_dict[ip]
+            if email != "":
+                total += sum_email_dict[email]
+            if ip != "" and email != "":
+                total -= sum_ip_email_dict[(ip, email)]
+        if not jobid in numseq_user_dict:
+            numseq_user_dict[jobid] = 0
+        numseq_user_dict[jobid] += total
     return numseq_user_dict
 #}}}
 def GetRefreshInterval(queuetime_in_sec, runtime_in_sec, method_submission):# {{{
@@ -1822,19 +2024,8 @@ Attached below is the error message:
         return 0
 # }}}
 
-@timeit
-def GetJobCounter(info): #{{{
-# get job counter for the client_ip
-# get the table from runlog, 
-# for queued or running jobs, if source=web and numseq=1, check again the tag file in
-# each individual folder, since they are queued locally
-    logfile_query = info['divided_logfile_query']
-    logfile_finished_jobid = info['divided_logfile_finished_jobid']
-    isSuperUser = info['isSuperUser']
-    client_ip = info['client_ip']
-    maxdaystoshow = info['MAX_DAYS_TO_SHOW']
-    path_result = info['path_result']
-
+def InitJobCounter(): #{{{
+    """Return an empty job counter"""
     jobcounter = {}
 
     jobcounter['queued'] = 0
@@ -1848,75 +2039,264 @@ def GetJobCounter(info): #{{{
     jobcounter['finished_idlist'] = []
     jobcounter['failed_idlist'] = []
     jobcounter['nojobfolder_idlist'] = []
+    return jobcounter
+#}}}
+def GetJobCounterDict(jobList, maxdaystoshow):#{{{
+    """Count the jobs for each client IP, as GetJobCounter does
+    jobList: [(jobid, ip, category, submit_date_str)], in the order of
+             submission, category is one of "queued", "running", "finished",
+             "failed" and "nojobfolder"
+    Return {ip: jobcounter}, the jobs submitted more than maxdaystoshow days
+    ago are not counted, except in the job counter of all jobs with the key
+    jobstate.JOBCOUNTER_ALL
+    """
+    counterDict = {jobstate.JOBCOUNTER_ALL: InitJobCounter()}
+    epoch_now = time.time()
+    for (jobid, ip, category, submit_date_str) in jobList:
+        jobcounter = counterDict[jobstate.JOBCOUNTER_ALL]
+        jobcounter[category] += 1
+        jobcounter['%s_idlist'%(category)].append(jobid)
+        submit_date = datetime_str_to_time(submit_date_str)
+        diff_days = int((epoch_now - submit_date.timestamp())//86400)
+        if diff_days > maxdaystoshow:
+            continue
+        if not ip in counterDict:
+            counterDict[ip] = InitJobCounter()
+        jobcounter = counterDict[ip]
+        jobcounter[category] += 1
+        jobcounter['%s_idlist'%(category)].append(jobid)
+    return counterDict
+#}}}
+JOBLIST_CACHE_TTL = 10  # seconds the classified jobs of a client are cached
+g_joblist_cache_dict = {}  # {key: (signature, expire_epoch, joblisting)}
+g_joblist_cache_lock = threading.Lock()
+
+def GetFileSignature(infile):# {{{
+    """Return (mtime_ns, size) of infile, None if it does not exist"""
+    try:
+        st = os.stat(infile)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+# }}}
+def ClassifyJobs(info):# {{{
+    """Classify the jobs of the client in info, as set by set_basic_config,
+    in one pass over info['divided_logfile_query']. This is shared by the
+    job lists get_queue, get_running, get_finished_job, get_failed_job and
+    by GetJobCounter.
+
+    Return a dictionary
+        'jobList': [(jobid, category, isWithinDays, submit_epoch)] in the
+                   order of submission, category is one of "queued",
+                   "running", "finished", "failed", "nojobfolder" or None,
+                   isWithinDays is True if the job was submitted within
+                   info['MAX_DAYS_TO_SHOW'] days
+        'finished_job_dict': read from info['divided_logfile_finished_jobid']
+                   by myfunc.ReadFinishedJobLog
+    or None if the log of submitted jobs can not be read.
+    The result is cached for JOBLIST_CACHE_TTL seconds, as long as the two
+    log files are not changed, it must not be modified by the caller
+    """
+    logfile_query = info['divided_logfile_query']
+    logfile_finished_jobid = info['divided_logfile_finished_jobid']
+    isSuperUser = info['isSuperUser']
+    client_ip = info['client_ip']
+    maxdaystoshow = info['MAX_DAYS_TO_SHOW']
+    path_result = info['path_result']
+
+    key = (logfile_query, logfile_finished_jobid, isSuperUser, client_ip,
+            maxdaystoshow, path_result)
+    signature = (GetFileSignature(logfile_query),
+            GetFileSignature(logfile_finished_jobid))
+    epoch_now = time.time()
+    with g_joblist_cache_lock:
+        if key in g_joblist_cache_dict:
+            (cached_signature, expire_epoch, joblisting) = g_joblist_cache_dict[key]
+            if cached_signature == signature and epoch_now < expire_epoch:
+                return joblisting
 
     hdl = myfunc.ReadLineByBlock(logfile_query)
     if hdl.failure:
-        return jobcounter
-    else:
-        finished_job_dict = myfunc.ReadFinishedJobLog(logfile_finished_jobid)
-        finished_jobid_set = set([])
-        failed_jobid_set = set([])
-        for jobid in finished_job_dict:
-            status = finished_job_dict[jobid][0]
-            rstdir = "%s/%s"%(path_result, jobid)
-            if status == "Finished":
-                finished_jobid_set.add(jobid)
-            elif status == "Failed":
-                failed_jobid_set.add(jobid)
-        lines = hdl.readlines()
-        while lines != None:
-            for line in lines:
-                strs = line.split("\t")
-                if len(strs) < 7:
-                    continue
-                ip = strs[2]
-                if not isSuperUser and ip != client_ip:
-                    continue
+        return None
+    finished_job_dict = myfunc.ReadFinishedJobLog(logfile_finished_jobid)
+    jobList = []
+    lines = hdl.readlines()
+    while lines != None:
+        for line in lines:
+            strs = line.split("\t")
+            if len(strs) < 7:
+                continue
+            ip = strs[2]
+            if not isSuperUser and ip != client_ip:
+                continue
+            jobid = strs[1]
+            submit_epoch = datetime_str_to_time(strs[0]).timestamp()
+            diff_days = int((epoch_now - submit_epoch)//86400)
+            isWithinDays = (diff_days <= maxdaystoshow)
 
-                submit_date_str = strs[0]
-                isValidSubmitDate = True
-                try:
-                    submit_date = datetime_str_to_time(submit_date_str)
-                except ValueError:
-                    isValidSubmitDate = False
+            category = None
+            if jobid in finished_job_dict:
+                status = finished_job_dict[jobid][0]
+                if status in ["Finished", "Failed"]:
+                    category = status.lower()
+            else:
+                rstdir = "%s/%s"%(path_result, jobid)
+                if not os.path.exists(rstdir):
+                    category = "nojobfolder"
+                elif os.path.exists("%s/%s"%(rstdir, "runjob.failed")):
+                    category = "failed"
+                elif os.path.exists("%s/%s"%(rstdir, "runjob.finish")):
+                    category = "finished"
+                elif os.path.exists("%s/%s"%(rstdir, "runjob.start")):
+                    category = "running"
+                else:
+                    category = "queued"
+            jobList.append((jobid, category, isWithinDays, submit_epoch))
+        lines = hdl.readlines()
+    hdl.close()
+
+    joblisting = {'jobList': jobList, 'finished_job_dict': finished_job_dict}
+    with g_joblist_cache_lock:
+        for k in [k for k in g_joblist_cache_dict
+                if g_joblist_cache_dict[k][1] <= epoch_now]:
+            del g_joblist_cache_dict[k]
+        g_joblist_cache_dict[key] = (signature, epoch_now + JOBLIST_CACHE_TTL,
+                joblisting)
+    return joblisting
+# }}}
+def SelectJobID(joblisting, category, isWithinDays=False):# {{{
+    """Return the jobids of category from the result of ClassifyJobs, only
+    those submitted within MAX_DAYS_TO_SHOW days if isWithinDays is True
+    """
+    return [x[0] for x in joblisting['jobList']
+            if x[1] == category and (x[2] or not isWithinDays)]
+# }}}
+def GetJobListPage(request, info, status, g_params):# {{{
+    """Return (jobRecordList, finished_job_dict, offset) for one page of the
+    jobs with status ("Finished" or "Failed") of the client in info, as set
+    by set_basic_config, submitted within MAX_DAYS_TO_SHOW days. The page is
+    selected by the parameters of request.GET
+        page:      the page number, starting from 1 (default: 1)
+        pagesize:  the number of jobs per page, 0 for all jobs (default:
+                   g_params['JOBLIST_PAGE_SIZE'] or 0)
+        order:     "asc" or "desc", by the date of submission (default: asc)
+        date_from: only jobs submitted at or after this date, e.g. 2023-05-04
+        date_to:   only jobs submitted before this date
+    The jobs are queried from the job state index kept by CreateRunJoblog, so
+    that the cost is proportional to pagesize, and from ClassifyJobs if the
+    index is not available. finished_job_dict holds the records of the jobs
+    in the format of myfunc.ReadFinishedJobLog, offset is the number of jobs
+    before this page. info['page'], info['pagesize'], info['numpage'] and
+    info['numjob'] are set for the template.
+    Return None if the jobs can not be read
+    """
+    para = getattr(request, 'GET', {})
+    try:
+        page = max(1, int(para.get('page', 1)))
+    except ValueError:
+        page = 1
+    if 'JOBLIST_PAGE_SIZE' in g_params:
+        pagesize = g_params['JOBLIST_PAGE_SIZE']
+    else:
+        pagesize = 0
+    try:
+        pagesize = max(0, int(para.get('pagesize', pagesize)))
+    except ValueError:
+        pass
+    isDescending = (para.get('order', "asc") == "desc")
+    submit_epoch_from = time.time() - (info['MAX_DAYS_TO_SHOW']+1)*86400
+    submit_epoch_to = None
+    try:
+        submit_epoch_from = max(submit_epoch_from,
+                timeparser.ParseDateTimeToEpoch(para['date_from']))
+    except (KeyError, ValueError):
+        pass
+    try:
+        submit_epoch_to = timeparser.ParseDateTimeToEpoch(para['date_to'])
+    except (KeyError, ValueError):
+        pass
+    if pagesize > 0:
+        offset = (page-1)*pagesize
+        limit = pagesize
+    else:
+        offset = 0
+        limit = -1
 
-                if not isValidSubmitDate:
-                    continue
+    result = None
+    if 'path_log' in info:
+        if info['isSuperUser']:
+            ip = None
+        else:
+            ip = info['client_ip']
+        result = jobstate.QueryJobs(info['path_log'], status, ip,
+                submit_epoch_from, submit_epoch_to, isDescending, offset, limit)
+    if result is not None:
+        (numjob, recordList) = result
+        jobRecordList = []
+        finished_job_dict = {}
+        for rd in recordList:
+            jobRecordList.append(rd['jobid'])
+            finished_job_dict[rd['jobid']] = [rd['status'], rd['jobname'],
+                    rd['ip'], rd['email'], rd['numseq'],
+                    rd['method_submission'], rd['submit_date'],
+                    rd['start_date'], rd['finish_date'], rd['app_type']]
+    else:
+        joblisting = ClassifyJobs(info)
+        if joblisting is None:
+            return None
+        finished_job_dict = joblisting['finished_job_dict']
+        category = status.lower()
+        jobList = [x for x in joblisting['jobList'] if x[1] == category
+                and x[3] >= submit_epoch_from
+                and (submit_epoch_to is None or x[3] < submit_epoch_to)]
+        if isDescending:
+            jobList = sorted(jobList[::-1], key=lambda x:x[3], reverse=True)
+        else:
+            jobList = sorted(jobList, key=lambda x:x[3])
+        numjob = len(jobList)
+        if limit >= 0:
+            jobList = jobList[offset:offset+limit]
+        jobRecordList = [x[0] for x in jobList]
+
+    info['page'] = page
+    info['pagesize'] = pagesize
+    info['numjob'] = numjob
+    if pagesize > 0:
+        info['numpage'] = max(1, (numjob+pagesize-1)//pagesize)
+    else:
+        info['numpage'] = 1
+    return (jobRecordList, finished_job_dict, offset)
+# }}}
+@timeit
+def GetJobCounter(info): #{{{
+# get job counter for the client_ip
+# the job counters are read from the job state index, where they are kept up
+# to date by CreateRunJoblog, if they are not available, count the jobs
+# classified by ClassifyJobs
+    isSuperUser = info['isSuperUser']
+    client_ip = info['client_ip']
+    maxdaystoshow = info['MAX_DAYS_TO_SHOW']
 
-                current_time = datetime.now(submit_date.tzinfo)
-                diff_date = current_time - submit_date
-                if diff_date.days > maxdaystoshow:
-                    continue
-                jobid = strs[1]
-                rstdir = "%s/%s"%(path_result, jobid)
+    jobcounter = InitJobCounter()
 
-                if jobid in finished_jobid_set:
-                    jobcounter['finished'] += 1
-                    jobcounter['finished_idlist'].append(jobid)
-                elif jobid in failed_jobid_set:
-                    jobcounter['failed'] += 1
-                    jobcounter['failed_idlist'].append(jobid)
-                else:
-                    finishtagfile = "%s/%s"%(rstdir, "runjob.finish")
-                    failtagfile = "%s/%s"%(rstdir, "runjob.failed")
-                    starttagfile = "%s/%s"%(rstdir, "runjob.start")
-                    if not os.path.exists(rstdir):
-                        jobcounter['nojobfolder'] += 1
-                        jobcounter['nojobfolder_idlist'].append(jobid)
-                    elif os.path.exists(failtagfile):
-                        jobcounter['failed'] += 1
-                        jobcounter['failed_idlist'].append(jobid)
-                    elif os.path.exists(finishtagfile):
-                        jobcounter['finished'] += 1
-                        jobcounter['finished_idlist'].append(jobid)
-                    elif os.path.exists(starttagfile):
-                        jobcounter['running'] += 1
-                        jobcounter['running_idlist'].append(jobid)
-                    else:
-                        jobcounter['queued'] += 1
-                        jobcounter['queued_idlist'].append(jobid)
-            lines = hdl.readlines()
-        hdl.close()
+    if 'path_log' in info:
+        if isSuperUser:
+            stored_jobcounter = jobstate.ReadJobCounter(info['path_log'],
+                    jobstate.JOBCOUNTER_ALL)
+        else:
+            stored_jobcounter = jobstate.ReadJobCounter(info['path_log'],
+                    client_ip, maxdaystoshow)
+        if stored_jobcounter is not None:
+            jobcounter.update(stored_jobcounter)
+            return jobcounter
+
+    joblisting = ClassifyJobs(info)
+    if joblisting is None:
+        return jobcounter
+    for (jobid, category, isWithinDays, submit_epoch) in joblisting['jobList']:
+        if isWithinDays and category is not None:
+            jobcounter[category] += 1
+            jobcounter['%s_idlist'%(category)].append(jobid)
     return jobcounter
 #}}}
 
@@ -2353,6 +2733,7 @@ def set_basic_config(request, info, g_params):# {{{
     info['BASEURL'] = g_params['BASEURL']
     info['STATIC_URL'] = g_params['STATIC_URL']
     info['path_result'] = path_result
+    info['path_log'] = path_log
 # }}}
 def SetColorStatus(status):#{{{
     if status == "Finished":
@@ -2378,40 +2759,12 @@ def get_queue(request, g_params):#{{{
     if info['isSuperUser']:
         info['header'].insert(5, "Host")
 
-    hdl = myfunc.ReadLineByBlock(info['divided_logfile_query'])
-    if hdl.failure:
+    joblisting = ClassifyJobs(info)
+    if joblisting is None:
         info['errmsg'] = ""
         pass
     else:
-        finished_jobid_list = []
-        if os.path.exists(info['divided_logfile_finished_jobid']):
-            finished_jobid_list = myfunc.ReadIDList2(info['divided_logfile_finished_jobid'], 0, None)
-        finished_jobid_set = set(finished_jobid_list)
-        jobRecordList = []
-        lines = hdl.readlines()
-        while lines != None:
-            for line in lines:
-                strs = line.split("\t")
-                if len(strs) < 7:
-                    continue
-                ip = strs[2]
-                if not info['isSuperUser'] and ip != info['client_ip']:
-                    continue
-                jobid = strs[1]
-                if jobid in finished_jobid_set:
-                    continue
-
-                rstdir = "%s/%s"%(path_result, jobid)
-                starttagfile = "%s/%s"%(rstdir, "runjob.start")
-                failedtagfile = "%s/%s"%(rstdir, "runjob.failed")
-                finishtagfile = "%s/%s"%(rstdir, "runjob.finish")
-                if (os.path.exists(rstdir) and 
-                        not os.path.exists(starttagfile) and
-                        not os.path.exists(failedtagfile) and
-                        not os.path.exists(finishtagfile)):
-                    jobRecordList.append(jobid)
-            lines = hdl.readlines()
-        hdl.close()
+        jobRecordList = SelectJobID(joblisting, "queued")
 
         jobinfo_list = []
         rank = 0
@@ -2439,7 +2792,6 @@ def get_queue(request, g_params):#{{{
                 email = jobinfolist[6]
                 method_submission = jobinfolist[7]
 
-            starttagfile = "%s/runjob.start"%(rstdir)
             queuetime = ""
             runtime = ""
             isValidSubmitDate = True
@@ -2479,38 +2831,12 @@ def get_running(request, g_params):#{{{
     if info['isSuperUser']:
         info['header'].insert(6, "Host")
 
-    hdl = myfunc.ReadLineByBlock(info['divided_logfile_query'])
-    if hdl.failure:
+    joblisting = ClassifyJobs(info)
+    if joblisting is None:
         info['errmsg'] = ""
         pass
     else:
-        finished_jobid_list = []
-        if os.path.exists(info['divided_logfile_finished_jobid']):
-            finished_jobid_list = myfunc.ReadIDList2(info['divided_logfile_finished_jobid'], 0, None)
-        finished_jobid_set = set(finished_jobid_list)
-        jobRecordList = []
-        lines = hdl.readlines()
-        while lines != None:
-            for line in lines:
-                strs = line.split("\t")
-                if len(strs) < 7:
-                    continue
-                ip = strs[2]
-                if not info['isSuperUser'] and ip != info['client_ip']:
-                    continue
-                jobid = strs[1]
-                if jobid in finished_jobid_set:
-                    continue
-                rstdir = "%s/%s"%(path_result, jobid)
-                starttagfile = "%s/%s"%(rstdir, "runjob.start")
-                finishtagfile = "%s/%s"%(rstdir, "runjob.finish")
-                failedtagfile = "%s/%s"%(rstdir, "runjob.failed")
-                if (os.path.exists(rstdir) and os.path.exists(starttagfile) and (not
-                    os.path.exists(finishtagfile) and not
-                    os.path.exists(failedtagfile))):
-                    jobRecordList.append(jobid)
-            lines = hdl.readlines()
-        hdl.close()
+        jobRecordList = SelectJobID(joblisting, "running")
 
         jobinfo_list = []
         rank = 0
@@ -2591,54 +2917,15 @@ def get_finished_job(request, g_params):#{{{
     if info['isSuperUser']:
         info['header'].insert(5, "Host")
 
-    hdl = myfunc.ReadLineByBlock(info['divided_logfile_query'])
-    if hdl.failure:
+    jobpage = GetJobListPage(request, info, "Finished", g_params)
+    if jobpage is None:
         #info['errmsg'] = "Failed to retrieve finished job information!"
         info['errmsg'] = ""
         pass
     else:
-        finished_job_dict = myfunc.ReadFinishedJobLog(info['divided_logfile_finished_jobid'])
-        jobRecordList = []
-        lines = hdl.readlines()
-        while lines != None:
-            for line in lines:
-                strs = line.split("\t")
-                if len(strs) < 7:
-                    continue
-                ip = strs[2]
-                if not info['isSuperUser'] and ip != info['client_ip']:
-                    continue
-
-                submit_date_str = strs[0]
-                isValidSubmitDate = True
-                try:
-                    submit_date = datetime_str_to_time(submit_date_str)
-                except ValueError:
-                    isValidSubmitDate = False
-                if not isValidSubmitDate:
-                    continue
-
-                current_time = datetime.now(submit_date.tzinfo)
-                diff_date = current_time - submit_date
-                if diff_date.days > info['MAX_DAYS_TO_SHOW']:
-                    continue
-                jobid = strs[1]
-                rstdir = "%s/%s"%(path_result, jobid)
-                if jobid in finished_job_dict:
-                    status = finished_job_dict[jobid][0]
-                    if status == "Finished":
-                        jobRecordList.append(jobid)
-                else:
-                    finishtagfile = "%s/%s"%(rstdir, "runjob.finish")
-                    failedtagfile = "%s/%s"%(rstdir, "runjob.failed")
-                    if (os.path.exists(rstdir) and  os.path.exists(finishtagfile) and
-                            not os.path.exists(failedtagfile)):
-                        jobRecordList.append(jobid)
-            lines = hdl.readlines()
-        hdl.close()
+        (jobRecordList, finished_job_dict, rank) = jobpage
 
         jobinfo_list = []
-        rank = 0
         for jobid in jobRecordList:
             rank += 1
             ip =  ""
@@ -2727,47 +3014,15 @@ def get_failed_job(request, g_params):#{{{
     if info['isSuperUser']:
         info['header'].insert(5, "Host")
 
-    hdl = myfunc.ReadLineByBlock(info['divided_logfile_query'])
-    if hdl.failure:
+    jobpage = GetJobListPage(request, info, "Failed", g_params)
+    if jobpage is None:
 #         info['errmsg'] = "Failed to retrieve finished job information!"
         info['errmsg'] = ""
         pass
     else:
-        finished_job_dict = myfunc.ReadFinishedJobLog(info['divided_logfile_finished_jobid'])
-        jobRecordList = []
-        lines = hdl.readlines()
-        while lines != None:
-            for line in lines:
-                strs = line.split("\t")
-                if len(strs) < 7:
-                    continue
-                ip = strs[2]
-                if not info['isSuperUser'] and ip != info['client_ip']:
-                    continue
-
-                submit_date_str = strs[0]
-                submit_date = datetime_str_to_time(submit_date_str)
-                current_time = datetime.now(submit_date.tzinfo)
-                diff_date = current_time - submit_date
-                if diff_date.days > info['MAX_DAYS_TO_SHOW']:
-                    continue
-                jobid = strs[1]
-                rstdir = "%s/%s"%(path_result, jobid)
-
-                if jobid in finished_job_dict:
-                    status = finished_job_dict[jobid][0]
-                    if status == "Failed":
-                        jobRecordList.append(jobid)
-                else:
-                    failedtagfile = "%s/%s"%(rstdir, "runjob.failed")
-                    if os.path.exists(rstdir) and os.path.exists(failedtagfile):
-                        jobRecordList.append(jobid)
-            lines = hdl.readlines()
-        hdl.close()
-
+        (jobRecordList, finished_job_dict, rank) = jobpage
 
         jobinfo_list = []
-        rank = 0
         for jobid in jobRecordList:
             rank += 1
 
@@ -2941,15 +3196,27 @@ def help_wsdl_api(request, g_params):#{{{
     info['jobcounter'] = GetJobCounter(info)
     return info
 #}}}
-def get_serverstatus(request, g_params):#{{{
-    info = {}
-    set_basic_config(request, info, g_params)
-    path_log = os.path.join(g_params['SITE_ROOT'], 'static/log')
-    path_result = os.path.join(g_params['SITE_ROOT'], 'static/result')
+SERVERSTATUS_VERSION = 1  # version of the format of the server status snapshot
+SERVERSTATUS_MAX_AGE = 1800  # seconds after which the snapshot is stale
+SERVERSTATUS_UPDATE_INTERVAL = 600  # seconds between rebuilds by qd_fe
+DEFAULT_MAX_ACTIVE_USER = 100
+
+def BuildServerStatus(path_static, g_params):#{{{
+    """Collect the server status shown by get_serverstatus
+    Return a dictionary which can be serialised to JSON. This reads the whole
+    job history, it is run in the background by UpdateServerStatusSnapshot
+    instead of in the web request
+    """
+    status = {}
+    path_log = os.path.join(path_static, 'log')
+    path_result = os.path.join(path_static, 'result')
     path_stat = os.path.join(path_log, "stat")
+    if 'MAX_ACTIVE_USER' in g_params:
+        max_active_user = g_params['MAX_ACTIVE_USER']
+    else:
+        max_active_user = DEFAULT_MAX_ACTIVE_USER
 
     logfile_finished =  os.path.join(path_log, "finished_job.log")
-    logfile_runjob =  os.path.join(path_log, "runjob_log.log")
     logfile_country_job = os.path.join(path_log, "stat", "country_job_numseq.txt")
 
 
@@ -2971,19 +3238,19 @@ def get_serverstatus(request, g_params):#{{{
             loginfo("Run '%s' exit with error message: %s"%(cmdline, str(e)), g_params['gen_errfile'])
 
 # get jobs queued remotely ()
-    runjob_dict = {}
-    if os.path.exists(logfile_runjob):
-        runjob_dict = myfunc.ReadRunJobLog(logfile_runjob)
+    runjob_dict = jobqueue.GetRunJobDict(path_log)
     cntseq_in_remote_queue = 0
     for jobid in runjob_dict:
         li = runjob_dict[jobid]
         numseq = li[4]
         rstdir = "%s/%s"%(path_result, jobid)
-        finished_idx_file = "%s/finished_seqindex.txt"%(rstdir)
-        if os.path.exists(finished_idx_file):
-            num_finished = len(myfunc.ReadIDList(finished_idx_file))
-        else:
-            num_finished = 0
+        num_finished = ReadJobProgress(rstdir).get('finished', None)
+        if num_finished is None:
+            finished_idx_file = "%s/finished_seqindex.txt"%(rstdir)
+            if os.path.exists(finished_idx_file):
+                num_finished = len(myfunc.ReadIDList(finished_idx_file))
+            else:
+                num_finished = 0
 
         cntseq_in_remote_queue += (numseq - num_finished)
 
@@ -3091,7 +3358,7 @@ def get_serverstatus(request, g_params):#{{{
         except:
             pass
         activeuserli_njob.append([anonymize_ip_v4(ip), country, njob, nseq])
-        if cnt >= g_params['MAX_ACTIVE_USER']:
+        if cnt >= max_active_user:
             break
 
     # get most active users by num_seq
@@ -3111,7 +3378,7 @@ def get_serverstatus(request, g_params):#{{{
         except:
             pass
         activeuserli_nseq.append([anonymize_ip_v4(ip), country, njob, nseq])
-        if cnt >= g_params['MAX_ACTIVE_USER']:
+        if cnt >= max_active_user:
             break
 
 # get longest predicted seq
@@ -3168,39 +3435,41 @@ def get_serverstatus(request, g_params):#{{{
             lines = hdl.readlines()
         hdl.close()
 
-    info['longestruntime_str'] = myfunc.second_to_human(int(longestruntime+0.5))
-    info['mostTM_str'] = str(mostTM)
-    info['longestlength_str'] = str(longestlength)
-    info['total_num_finished_seq'] = total_num_finished_seq
-    info['total_num_finished_job'] = len(allfinished_job_dict)
-    info['num_unique_ip'] = len(uniq_iplist)
-    info['num_unique_country'] = len(uniq_countrylist)
-    info['num_finished_seqs_str'] = str(info['total_num_finished_seq'])
-    info['num_finished_jobs_str'] = str(info['total_num_finished_job'])
-    info['num_finished_jobs_web_str'] = str(numjob_wed)
-    info['num_finished_jobs_wsdl_str'] = str(numjob_wsdl)
-    info['num_unique_ip_str'] = str(info['num_unique_ip'])
-    info['num_unique_country_str'] = str(info['num_unique_country'])
-    info['num_seq_in_local_queue'] = num_seq_in_local_queue
-    info['num_seq_in_remote_queue'] = cntseq_in_remote_queue
-    info['activeuserli_nseq_header'] = activeuserli_nseq_header
-    info['activeuserli_njob_header'] = activeuserli_njob_header
-    info['li_countjob_country_header'] = li_countjob_country_header
-    info['li_countjob_country'] = li_countjob_country
-    info['activeuserli_njob_header'] = activeuserli_njob_header
-    info['activeuserli_nseq'] = activeuserli_nseq
-    info['activeuserli_njob'] = activeuserli_njob
-    info['li_longestruntime'] = li_longestruntime
-    info['li_longestseq'] = li_longestseq
-    info['li_mostTM'] = li_mostTM
-
-    info['startdate'] = startdate
-    info['jobcounter'] = GetJobCounter(info)
+    status['longestruntime_str'] = myfunc.second_to_human(int(longestruntime+0.5))
+    status['mostTM_str'] = str(mostTM)
+    status['longestlength_str'] = str(longestlength)
+    status['total_num_finished_seq'] = total_num_finished_seq
+    status['total_num_finished_job'] = len(allfinished_job_dict)
+    status['num_unique_ip'] = len(uniq_iplist)
+    status['num_unique_country'] = len(uniq_countrylist)
+    status['num_finished_seqs_str'] = str(status['total_num_finished_seq'])
+    status['num_finished_jobs_str'] = str(status['total_num_finished_job'])
+    status['num_finished_jobs_web_str'] = str(numjob_wed)
+    status['num_finished_jobs_wsdl_str'] = str(numjob_wsdl)
+    status['num_unique_ip_str'] = str(status['num_unique_ip'])
+    status['num_unique_country_str'] = str(status['num_unique_country'])
+    status['num_seq_in_local_queue'] = num_seq_in_local_queue
+    status['num_seq_in_remote_queue'] = cntseq_in_remote_queue
+    status['activeuserli_nseq_header'] = activeuserli_nseq_header
+    status['activeuserli_njob_header'] = activeuserli_njob_header
+    status['li_countjob_country_header'] = li_countjob_country_header
+    status['li_countjob_country'] = li_countjob_country
+    status['activeuserli_njob_header'] = activeuserli_njob_header
+    status['activeuserli_nseq'] = activeuserli_nseq
+    status['activeuserli_njob'] = activeuserli_njob
+    status['li_longestruntime'] = li_longestruntime
+    status['li_longestseq'] = li_longestseq
+    status['li_mostTM'] = li_mostTM
+
+    status['startdate'] = startdate
     def server_usage_statistics_per_timeline(timeline):
         timeline_statistics = {}
         for item in timeline:
             file_path = f'{path_stat}/submit_{item}.stat.txt'
             stat_data = []
+            if not os.path.exists(file_path):
+                timeline_statistics[item] = stat_data
+                continue
             with open(file_path) as f:
                 for line in f:
                     if not line.startswith('Date'):
@@ -3211,8 +3480,80 @@ def get_serverstatus(request, g_params):#{{{
         return timeline_statistics
     timeline = ['day', 'week', 'month', 'year']
     timeline_statistics = server_usage_statistics_per_timeline(timeline)
-    info['statistics_timeline'] =timeline
-    info['statistics_per_timeline'] = json.dumps(timeline_statistics)
+    status['statistics_timeline'] =timeline
+    status['statistics_per_timeline'] = timeline_statistics
+    return status
+#}}}
+def WriteServerStatusSnapshot(path_static, g_params):#{{{
+    """Build the server status and write it to the snapshot file
+    log/serverstatus.json, the file is replaced atomically so that the web
+    pages never read a partial snapshot. Return the snapshot
+    """
+    snapshot = {}
+    snapshot['version'] = SERVERSTATUS_VERSION
+    snapshot['status'] = BuildServerStatus(path_static, g_params)
+    snapshot['created_epoch'] = time.time()
+    outfile = os.path.join(path_static, "log", "serverstatus.json")
+    errmsg = myfunc.WriteFileAtomic(json.dumps(snapshot), outfile)
+    if errmsg != "":
+        loginfo(errmsg, g_params['gen_errfile'])
+    return snapshot
+#}}}
+def ReadServerStatusSnapshot(path_log):#{{{
+    """Return the server status snapshot written by WriteServerStatusSnapshot,
+    None if it does not exist or is of another version
+    """
+    infile = os.path.join(path_log, "serverstatus.json")
+    try:
+        with open(infile, "r") as fpin:
+            snapshot = json.load(fpin)
+    except (IOError, OSError, ValueError):
+        return None
+    if (not isinstance(snapshot, dict)
+            or snapshot.get('version', None) != SERVERSTATUS_VERSION):
+        return None
+    return snapshot
+#}}}
+def UpdateServerStatusSnapshot(path_static, g_params, interval):#{{{
+    """Rewrite the server status snapshot if it is older than interval
+    seconds. Return True if it is rewritten
+    """
+    snapshot = ReadServerStatusSnapshot(os.path.join(path_static, "log"))
+    if (snapshot is not None
+            and time.time() - snapshot.get('created_epoch', 0) < interval):
+        return False
+    WriteServerStatusSnapshot(path_static, g_params)
+    return True
+#}}}
+def get_serverstatus(request, g_params):#{{{
+    """Show the server status from the snapshot built in the background
+    info['serverstatus_age'] is the age of the snapshot in seconds,
+    info['serverstatus_date'] the time it was built, and
+    info['isServerStatusStale'] is True if it is older than
+    g_params['SERVERSTATUS_MAX_AGE'] (default: SERVERSTATUS_MAX_AGE).
+    The status is built in the request only when there is no snapshot yet
+    """
+    info = {}
+    set_basic_config(request, info, g_params)
+    path_static = os.path.join(g_params['SITE_ROOT'], 'static')
+    path_log = os.path.join(path_static, 'log')
+
+    snapshot = ReadServerStatusSnapshot(path_log)
+    if snapshot is None:
+        snapshot = WriteServerStatusSnapshot(path_static, g_params)
+    if 'SERVERSTATUS_MAX_AGE' in g_params:
+        max_age = g_params['SERVERSTATUS_MAX_AGE']
+    else:
+        max_age = SERVERSTATUS_MAX_AGE
+    created_epoch = snapshot['created_epoch']
+
+    info.update(snapshot['status'])
+    info['statistics_per_timeline'] = json.dumps(info['statistics_per_timeline'])
+    info['serverstatus_age'] = int(time.time() - created_epoch)
+    info['serverstatus_date'] = datetime.fromtimestamp(created_epoch,
+            timezone(TZ)).strftime(FORMAT_DATETIME)
+    info['isServerStatusStale'] = (info['serverstatus_age'] > max_age)
+    info['jobcounter'] = GetJobCounter(info)
     return info
 #}}}
 def get_results_eachseq(request, name_resultfile, name_nicetopfile, jobid, seqindex, g_params):#{{{
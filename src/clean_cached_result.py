@@ -3,15 +3,12 @@
 import sys
 import os
 import sqlite3
-import shutil
 import argparse
 import fcntl
+import time
 
-from datetime import datetime
-from pytz import timezone
-import tempfile
-from libpredweb import myfunc
 from libpredweb import webserver_common as webcom
+from libpredweb import resultcache
 
 TZ = webcom.TZ
 
@@ -19,102 +16,120 @@ progname = os.path.basename(sys.argv[0])
 rootname_progname = os.path.splitext(progname)[0]
 
 
+def backfill_finish_epoch(con, tablename, logfile, chunk_size=1000):  # {{{
+    """Set finish_epoch for records written before the column was added, the
+    date is parsed once from date_finish, and the current time is used if it
+    can not be parsed, so that the record is kept for another MAX_KEEP_DAYS
+    """
+    cnt = 0
+    while True:
+        rows = con.execute(f"SELECT md5, date_finish FROM {tablename}"
+                           f" WHERE finish_epoch IS NULL LIMIT {chunk_size}").fetchall()
+        if not rows:
+            break
+        dataList = []
+        for (md5_key, finish_date_str) in rows:
+            finish_date = webcom.datetime_str_to_time(finish_date_str)
+            dataList.append((int(finish_date.timestamp()), md5_key))
+        with con:
+            con.execute("BEGIN IMMEDIATE")
+            con.executemany(f"UPDATE {tablename} SET finish_epoch = ?"
+                            f" WHERE md5 = ? AND finish_epoch IS NULL", dataList)
+        cnt += len(rows)
+    if cnt > 0:
+        webcom.loginfo(f"Set finish_epoch for {cnt} records", logfile)
+# }}}
+
+
 def clean_cached_result(MAX_KEEP_DAYS, g_params):  # {{{
-    """Clean out-dated cached result"""
+    """Clean out-dated cached result
+
+    The database is cleaned in place, it is safe to run this while GetResult
+    is inserting new records. The cached result is evicted first and the
+    record is deleted only when the eviction succeeded, so that a failed
+    eviction is tried again in the next run. Records are deleted in batches in
+    short transactions, and a record that is updated with a newer finish date
+    meanwhile is kept together with its cached result.
+    """
     path_log = g_params['path_log']
     path_cache = g_params['path_cache']
     logfile = f"{path_log}/{progname}.log"
     errfile = f"{path_log}/{progname}.err"
 
     db = f"{path_log}/cached_job_finished_date.sqlite3"
-    tmpdb = tempfile.mktemp(prefix=f"{db}_")
+    tablename = "data"
+    chunk_size = 1000
+    # a result is out-dated when it is older than MAX_KEEP_DAYS full days
+    cutoff_epoch = int(time.time()) - (MAX_KEEP_DAYS+1)*86400
 
-    webcom.loginfo(f"copy db {db} to tmpdb {tmpdb}", logfile)
+    con = None
+    cache = None
     try:
-        shutil.copyfile(db, tmpdb)
-    except OSError:
-        webcom.loginfo(f"Failed to copy {db} to {tmpdb}.", errfile)
-        return 1
-
-    md5listfile = f"{path_log}/cache_to_delete.md5list"
-    try: 
-        con = sqlite3.connect(tmpdb)
-        webcom.loginfo(f"output the outdated md5 list to {md5listfile}", logfile)
-
-        tablename = "data"
-
-        with con:
-            cur = con.cursor()
-            fpout = open(md5listfile, "w")
-            nn_mag = cur.execute(f"SELECT md5, date_finish FROM {tablename}")
-            cnt = 0
-            chunk_size = 1000
-            while True:
-                result = nn_mag.fetchmany(chunk_size)
-                if not result:
-                    break
-                else:
-                    for row in result:
-                        cnt += 1
-                        md5_key = row[0]
-                        finish_date_str = row[1]
-                        finish_date = webcom.datetime_str_to_time(finish_date_str)
-                        current_time = datetime.now(timezone(TZ))
-                        timeDiff = current_time - finish_date
-                        if timeDiff.days > MAX_KEEP_DAYS:
-                            fpout.write(f"{md5_key}\n")
-            fpout.close()
-
-            # delete cached result folder and delete the record
-            webcom.loginfo("Delete cached result folder and delete the record", logfile)
-
-            hdl = myfunc.ReadLineByBlock(md5listfile)
-            lines = hdl.readlines()
-            cnt = 0
-            while lines is not None:
-                for line in lines:
-                    line = line.strip()
-                    if line != "":
-                        cnt += 1
-                        md5_key = line
-                        subfoldername = md5_key[:2]
-                        cachedir = os.path.join(path_cache, subfoldername, md5_key)
-                        zipfile_cache = cachedir + ".zip"
-                        if os.path.exists(zipfile_cache):
-                            try:
-                                os.remove(zipfile_cache)
-                                webcom.loginfo(f"rm {zipfile_cache}", logfile)
-                                cmd_d = f"DELETE FROM {tablename} WHERE md5 = '{md5_key}'"
-                                cur.execute(cmd_d)
-                            except Exception as e:
-                                webcom.loginfo(f"Failed to delete with errmsg {e}", errfile)
-                                pass
-
-                lines = hdl.readlines()
-            hdl.close()
-
-            webcom.loginfo(f"VACUUM the database {tmpdb}", logfile)
-            cur.execute("VACUUM")
+        con = sqlite3.connect(db, timeout=60, isolation_level=None)
+        webcom.InitFinishDateDB(con, tablename)
+        if con.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            # switch an old database to incremental vacuum, needs one VACUUM
+            webcom.loginfo(f"Enable incremental vacuum for {db}", logfile)
+            con.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            con.execute("VACUUM")
+
+        backfill_finish_epoch(con, tablename, logfile, chunk_size)
+
+        # delete cached result folder and delete the record
+        webcom.loginfo("Delete cached result folder and delete the record", logfile)
+        cache = resultcache.ResultCache(path_cache)
+        cnt = 0
+        (last_epoch, last_md5) = (None, "")
+        while True:
+            # walk through the out-dated records in the order of
+            # (finish_epoch, md5), records that failed to be evicted are
+            # skipped and kept for the next run
+            if last_epoch is None:
+                rows = con.execute(f"SELECT md5, finish_epoch FROM {tablename}"
+                                   f" WHERE finish_epoch <= ?"
+                                   f" ORDER BY finish_epoch, md5 LIMIT {chunk_size}",
+                                   (cutoff_epoch,)).fetchall()
+            else:
+                rows = con.execute(f"SELECT md5, finish_epoch FROM {tablename}"
+                                   f" WHERE finish_epoch <= ? AND (finish_epoch > ?"
+                                   f" OR (finish_epoch = ? AND md5 > ?))"
+                                   f" ORDER BY finish_epoch, md5 LIMIT {chunk_size}",
+                                   (cutoff_epoch, last_epoch, last_epoch,
+                                    last_md5)).fetchall()
+            if not rows:
+                break
+            (last_md5, last_epoch) = rows[-1]
+            evicted_list = []
+            for row in rows:
+                md5_key = row[0]
+                # skip the record if GetResult has cached it again meanwhile
+                row2 = con.execute(f"SELECT finish_epoch FROM {tablename}"
+                                   f" WHERE md5 = ?", (md5_key,)).fetchone()
+                if row2 is None or row2[0] is None or row2[0] > cutoff_epoch:
+                    continue
+                try:
+                    if cache.evict(md5_key):
+                        webcom.loginfo(f"evict {md5_key}", logfile)
+                    evicted_list.append(md5_key)
+                except Exception as e:
+                    webcom.loginfo(f"Failed to delete {md5_key} with errmsg {e}", errfile)
+                    pass
+            with con:
+                con.execute("BEGIN IMMEDIATE")
+                con.executemany(f"DELETE FROM {tablename}"
+                                f" WHERE md5 = ? AND finish_epoch <= ?",
+                                [(md5_key, cutoff_epoch) for md5_key in evicted_list])
+            cnt += len(evicted_list)
+            con.execute("PRAGMA incremental_vacuum")
+        webcom.loginfo(f"Deleted {cnt} out-dated records from {db}", logfile)
     except Exception as e:
         webcom.loginfo(f"Failed to clean cached result with {e}", g_params['gen_logfile'])
+        return 1
     finally:
+        if cache is not None:
+            cache.close()
         if con is not None:
-            con.close() 
-
-    # copy back
-    webcom.loginfo(f"cp tmpdb {tmpdb} -> db {db}", logfile)
-    try:
-        shutil.copyfile(tmpdb, db)
-    except Exception as e:
-        webcom.loginfo(f"Failed to copy {tmpdb} to {db} with {e}", errfile)
-        return 1
-
-    webcom.loginfo(f"delete tmpdb {tmpdb}", logfile)
-    try:
-        os.remove(tmpdb)
-    except Exception as e:
-        webcom.loginfo(f"Failed to delete {tmpdb} with {e}", errfile)
-        return 1
+            con.close()
 
     return 0
 # }}}
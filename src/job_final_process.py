@@ -84,11 +84,11 @@ def JobFinalProcess(g_params):#{{{
         elif name_server.lower() == "frag1d":
             resultfile_text = os.path.join(outpath_result, "query.frag1d.txt")
 
-        (seqIDList, seqAnnoList, seqList) = myfunc.ReadFasta(seqfile)
         maplist = []
-        for i in range(len(seqIDList)):
-            maplist.append("%s\t%d\t%s\t%s"%("seq_%d"%i, len(seqList[i]),
-                seqAnnoList[i].replace('\t', ' '), seqList[i]))
+        with myfunc.FastaFile(seqfile) as hdl_seqfile:
+            for i, (seqid, seqanno, seq) in enumerate(hdl_seqfile):
+                maplist.append("%s\t%d\t%s\t%s"%("seq_%d"%i, len(seq),
+                    seqanno.replace('\t', ' '), seq))
         start_date_str = myfunc.ReadFile(starttagfile).strip()
         start_date_epoch = webcom.datetime_str_to_epoch(start_date_str)
         all_runtime_in_sec = float(date_str_epoch_now) - float(start_date_epoch)
@@ -28,6 +28,13 @@ def run_statistics(g_params):  # {{{
     run_statistics_basic(webserver_root, logfile, errfile)
     if name_server.lower() == "topcons2":
         run_statistics_topcons2(webserver_root, logfile, errfile)
+    # rebuild the server status snapshot with the new statistics
+    path_static = os.path.join(webserver_root, "proj", "pred", "static")
+    webcom.loginfo("Write server status snapshot...\n", logfile)
+    try:
+        webcom.WriteServerStatusSnapshot(path_static, g_params)
+    except Exception as e:
+        webcom.loginfo(f"Failed to write the server status snapshot with errmsg={e}", errfile)
     return 0
 # }}}
 